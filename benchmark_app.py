@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# ── Banco de pruebas de las etapas del mapa ───────────────────────
+# Mide cada etapa de la cadena (lectura del Excel y del GeoJSON, detección
+# del campo, agregación, construcción Folium, render HTML, captura PNG y
+# codificación GIF), más el arranque (importar el módulo, levantar el pool de
+# render), sobre los datos de datos/ y, si se pide, sobre una copia
+# sintética ampliada (más días, más filas de origen, geometría más fina).
+# El resultado es un JSON para comparar versiones, p. ej.:
+#
+#   python benchmark_app.py --ciudad sevilla --mes 4 --sintetico --dias 90 --filas 10
+
+import sys
+import json
+import time
+import shutil
+import argparse
+import subprocess
+import multiprocessing
+import platform
+import statistics
+import tracemalloc
+from pathlib import Path
+from datetime import datetime, timezone
+from tempfile import TemporaryDirectory
+from importlib import metadata
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import resource                  # sólo Unix
+except ImportError:
+    resource = None
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+import funciones_app as fa
+
+PAQUETES = ("pandas", "numpy", "geopandas", "shapely", "folium", "pyarrow",
+            "matplotlib", "pillow", "selenium")
+
+
+def _rss_pico_mb():
+    """
+    Pico de memoria residente del proceso desde que arrancó (MB), no el de
+    una etapa: sólo sube si la etapa supera el pico de todo lo anterior.
+    Sin el módulo resource (Windows) se usa psutil si está; si no, None.
+    """
+    if resource is not None:
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss / 2**20 if sys.platform == "darwin" else rss / 2**10
+    try:
+        import psutil
+    except ImportError:
+        return None
+    pico = getattr(psutil.Process().memory_info(), "peak_wset", None)
+    return pico / 2**20 if pico is not None else None
+
+
+def _tamano(salida):
+    if isinstance(salida, (bytes, bytearray)):
+        return len(salida)
+    if isinstance(salida, str):
+        return len(salida.encode("utf-8"))
+    if isinstance(salida, Path) and salida.exists():
+        return salida.stat().st_size
+    return None
+
+
+def medir(etapa, funcion, repeticiones=3, memoria=True):
+    """
+    Ejecuta 'funcion' 'repeticiones' veces y devuelve un dict con los
+    tiempos (s), su mediana y mínimo, el pico de memoria Python de la etapa
+    (tracemalloc), el pico RSS del proceso desde su arranque (ver
+    _rss_pico_mb) y el tamaño de la salida.
+    """
+    tiempos, pico, salida = [], 0, None
+    for _ in range(repeticiones):
+        if memoria:
+            tracemalloc.start()
+        inicio = time.perf_counter()
+        salida = funcion()
+        tiempos.append(time.perf_counter() - inicio)
+        if memoria:
+            pico = max(pico, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+    rss = _rss_pico_mb()
+    return {
+        "etapa": etapa,
+        "segundos": [round(t, 5) for t in tiempos],
+        "mediana_s": round(statistics.median(tiempos), 5),
+        "min_s": round(min(tiempos), 5),
+        "pico_python_mb": round(pico / 2**20, 2) if memoria else None,
+        "rss_pico_desde_inicio_mb": round(rss, 1) if rss is not None else None,
+        "bytes_salida": _tamano(salida),
+    }
+
+
+def _primero(gen):
+    return next(ch for ch in gen if not isinstance(ch, int))
+
+
+def _captura(ciudad, dia, mes, motor):
+    """
+    Un PNG 1920×1080 del día: con Chrome si hay, si no con matplotlib.
+    """
+    if motor == "navegador":
+        mapa = _primero(fa.graficaTransportesDia(ciudad, dia, mes, teselas=fa.teselas_captura()))
+        png, _, _ = fa.obtener_pool(1920, 1080, 1).capturar(mapa.get_root().render(),
+                                                           fa.ESPERA_MAX_CAPTURA)
+        return png
+    return fa.rasterizar_mapa(ciudad, dia, mes, ancho=1920, alto=1080, escala=1)
+
+
+def _motor_disponible(motor):
+    if motor != "auto":
+        return motor
+    try:
+        with fa.obtener_pool(1920, 1080, 1).navegador():
+            return "navegador"
+    except Exception:
+        return "matplotlib"
+
+
+def escenario(ciudad, mes, opc):
+    """
+    Mide todas las etapas para datos/<ciudad>-<mes>.xlsx en fa.DATOS_DIR.
+    """
+    excel = fa._excel_ciudad(ciudad, mes)
+    georef = fa._georef_file()
+    for ruta in (excel, georef):
+        if not ruta.exists():
+            raise FileNotFoundError(ruta)
+    rep, mem = opc.repeticiones, not opc.sin_memoria
+    etapas = []
+
+    # Lectura y preparación (sin cachés del proceso)
+    etapas.append(medir("pd.read_excel", lambda: pd.read_excel(excel), rep, mem))
+    fa.leer_excel_cacheado(excel, fa.TIPOS_TRANSPORTE)            # deja el parquet listo
+    etapas.append(medir("leer_excel_cacheado (parquet)", lambda: fa._leer_excel_tabla.__wrapped__(
+        str(excel.resolve()), excel.stat().st_mtime_ns, excel.stat().st_size,
+        tuple(sorted(fa.TIPOS_TRANSPORTE.items()))), rep, mem))
+    etapas.append(medir("gpd.read_file", lambda: gpd.read_file(georef), rep, mem))
+    gdf = gpd.read_file(georef)
+    referencia = fa._provincias_referencia()
+    etapas.append(medir("detectar_campo_provincia",
+                        lambda: fa.detectar_campo_provincia(gdf, referencia) and None, rep, mem))
+    etapas.append(medir("agregación (cubo)", lambda: fa._cubo_transporte.__wrapped__(
+        *fa._firma_fichero(excel)), rep, mem))
+
+    # Mapa de un día (con las cachés ya calientes, como en la app)
+    cubo = fa.cubo_transporte(ciudad, mes)
+    registro = fa.cargar_provincias()
+    dia = int(cubo.dias[0])
+    etapas.append(medir("geometria(zoom=6)", lambda: fa._geometria_nivel.__wrapped__(registro, 6),
+                        rep, mem))
+    etapas.append(medir("folium (graficaTransportesDia)",
+                        lambda: _primero(fa.graficaTransportesDia(ciudad, dia, mes)), rep, mem))
+    mapa = _primero(fa.graficaTransportesDia(ciudad, dia, mes))
+    etapas.append(medir("get_root().render()", lambda: mapa.get_root().render(), rep, mem))
+
+    # Captura PNG y codificación GIF
+    pngs = []
+    if not opc.sin_captura:
+        motor = _motor_disponible(opc.motor)
+        etapa = medir(f"captura PNG ({motor})", lambda: _captura(ciudad, dia, mes, motor), rep, mem)
+        etapas.append(etapa)
+        dias = cubo.dias[:opc.frames].tolist()
+        pngs = [_captura(ciudad, d, mes, motor) for d in dias]
+
+        def gif():
+            with TemporaryDirectory() as tmp:
+                ruta = Path(tmp) / "bench.gif"
+                with fa.CodificadorAnimacion(ruta, "gif", 10, 960) as cod:
+                    for png in pngs:
+                        cod.añadir(png)
+                return ruta.stat().st_size
+        etapa = medir(f"codificación GIF ({len(pngs)} frames)", gif, rep, mem)
+        etapa["bytes_salida"] = gif()
+        etapas.append(etapa)
+
+    # Mes completo en modo ligero (un solo mapa + matriz)
+    def mes_ligero():
+        with TemporaryDirectory() as tmp:
+            ruta = Path(tmp) / "mes.html"
+            for _ in fa._exportar_mes_ligero(ciudad, mes, 3, 6, ruta):
+                pass
+            return ruta.read_bytes()
+    etapas.append(medir("mes ligero (exportación)", mes_ligero, rep, mem))
+
+    return {
+        "ciudad": ciudad, "mes": int(mes),
+        "entradas": {
+            "excel_bytes": excel.stat().st_size,
+            "filas": int(len(fa.leer_excel_cacheado(excel, fa.TIPOS_TRANSPORTE))),
+            "dias": int(len(cubo.dias)),
+            "geojson_bytes": georef.stat().st_size,
+            "vertices": int(shapely.get_num_coordinates(registro.gdf.geometry.values).sum()),
+        },
+        "etapas": etapas,
+    }
+
+
+def arranque(opc):
+    """
+    Lo que se paga antes de generar nada: importar funciones_app en un
+    intérprete nuevo y arrancar un pool de render de 'opc.workers' procesos
+    con spawn (Windows, macOS: cada proceso importa funciones_app) y con el
+    método por defecto de la plataforma; y reutilizar el pool de la app.
+    """
+    rep = opc.repeticiones
+    etapas = [medir("import funciones_app (intérprete nuevo)", lambda: subprocess.run(
+        [sys.executable, "-c", "import funciones_app"], cwd=fa.BASE_DIR, check=True),
+        rep, memoria=False)]
+
+    def pool(contexto):
+        with ProcessPoolExecutor(opc.workers, mp_context=contexto, initializer=fa._iniciar_worker,
+                                 initargs=(str(fa.DATOS_DIR),)) as ex:
+            list(ex.map(abs, range(opc.workers)))
+    contextos = {"spawn": multiprocessing.get_context("spawn"), "por defecto": None}
+    for nombre, contexto in contextos.items():
+        etapas.append(medir(f"pool de render ({nombre}, {opc.workers} procesos)",
+                            lambda: pool(contexto), rep, memoria=False))
+    etapas.append(medir(f"pool de render reutilizado ({opc.workers} procesos)",
+                        lambda: list(fa.obtener_pool_render(opc.workers).map(abs, range(opc.workers))),
+                        rep, memoria=False))
+    return {
+        "entradas": {"workers": opc.workers,
+                     "importacion_en_proceso_s": round(fa.TIEMPO_IMPORTACION, 5)},
+        "etapas": etapas,
+    }
+
+
+def datos_sinteticos(destino, ciudad, mes, dias=None, filas=1, densificar=None):
+    """
+    Copia ampliada de los datos de (ciudad, mes) en 'destino':
+      - dias:       número de días (se repiten los reales con ruido ±10 %),
+      - filas:      cada fila de origen se reparte en 'filas' filas,
+      - densificar: longitud máxima de segmento (grados) de la geometría.
+    """
+    destino = Path(destino)
+    rng = np.random.default_rng(0)
+    df = pd.read_excel(fa._excel_ciudad(ciudad, mes))
+    if dias:
+        reales = sorted(df["dia"].unique())
+        trozos = []
+        for nuevo in range(1, dias + 1):
+            base = df[df["dia"] == reales[(nuevo - 1) % len(reales)]].copy()
+            base["dia"] = nuevo
+            base["viajes"] = np.rint(base["viajes"] * rng.uniform(0.9, 1.1, len(base))).astype(int)
+            trozos.append(base)
+        df = pd.concat(trozos, ignore_index=True)
+    if filas > 1:
+        df = df.loc[df.index.repeat(filas)].copy()
+        df["viajes"] = np.ceil(df["viajes"] / filas).astype(int)
+    df.to_excel(destino / f"{ciudad.lower()}-{int(mes):02}.xlsx", index=False)
+
+    gdf = gpd.read_file(fa._georef_file())
+    if densificar:
+        gdf["geometry"] = shapely.segmentize(gdf.geometry.values, densificar)
+    gdf.to_file(destino / fa._georef_file().name, driver="GeoJSON")
+    pob = fa.DATOS_DIR / "poblaciones_provincias.xlsx"
+    if pob.exists():
+        shutil.copy2(pob, destino / pob.name)
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Mide las etapas de la generación de mapas.")
+    p.add_argument("--ciudad", default="sevilla")
+    p.add_argument("--mes", type=int, default=4)
+    p.add_argument("--repeticiones", type=int, default=3)
+    p.add_argument("--frames", type=int, default=5, help="frames para la etapa GIF")
+    p.add_argument("--workers", type=int, default=4, help="procesos para medir el arranque del pool")
+    p.add_argument("--motor", choices=["auto", *fa.MOTORES_CAPTURA], default="auto")
+    p.add_argument("--sin-captura", action="store_true", help="omite captura PNG y GIF")
+    p.add_argument("--sin-memoria", action="store_true",
+                   help="no mide el pico de memoria Python (tracemalloc ralentiza)")
+    p.add_argument("--sintetico", action="store_true", help="añade el escenario ampliado")
+    p.add_argument("--dias", type=int, default=None, help="días del escenario sintético")
+    p.add_argument("--filas", type=int, default=1, help="multiplicador de filas de origen")
+    p.add_argument("--densificar", type=float, default=None,
+                   help="longitud máxima de segmento (grados) de la geometría sintética")
+    p.add_argument("--salida", type=Path, default=None,
+                   help="JSON de resultados (por defecto resultados/benchmark_<fecha>.json)")
+    opc = p.parse_args(argv)
+
+    resultado = {
+        "fecha": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "version_resultados": fa.VERSION_RESULTADOS,
+        "python": platform.python_version(),
+        "plataforma": platform.platform(),
+        "paquetes": {},
+        "opciones": {k: (str(v) if isinstance(v, Path) else v) for k, v in vars(opc).items()},
+        "escenarios": {},
+    }
+    for paquete in PAQUETES:
+        try:
+            resultado["paquetes"][paquete] = metadata.version(paquete)
+        except metadata.PackageNotFoundError:
+            pass
+
+    resultado["escenarios"]["arranque"] = arranque(opc)
+    resultado["escenarios"]["datos"] = escenario(opc.ciudad, opc.mes, opc)
+    if opc.sintetico:
+        datos_dir = fa.DATOS_DIR
+        with TemporaryDirectory() as tmp:
+            datos_sinteticos(tmp, opc.ciudad, opc.mes, opc.dias, opc.filas, opc.densificar)
+            fa.DATOS_DIR = Path(tmp)
+            try:
+                resultado["escenarios"]["sintetico"] = escenario(opc.ciudad, opc.mes, opc)
+            finally:
+                fa.DATOS_DIR = datos_dir
+
+    for nombre, esc in resultado["escenarios"].items():
+        print(f"\n== {nombre}: {esc['entradas']}")
+        for e in esc["etapas"]:
+            tam = f"{e['bytes_salida'] / 2**10:10.1f} KB" if e["bytes_salida"] else " " * 13
+            rss = e["rss_pico_desde_inicio_mb"]
+            print(f"  {e['etapa']:<36} {e['mediana_s'] * 1000:9.1f} ms {tam}"
+                  + (f"  pico RSS desde el inicio {rss:.0f} MB" if rss is not None else ""))
+
+    salida = opc.salida or fa.RESULTADOS_DIR / \
+        f"benchmark_{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    salida.parent.mkdir(parents=True, exist_ok=True)
+    salida.write_text(json.dumps(resultado, indent=1, ensure_ascii=False), encoding="utf-8")
+    print(f"\nResultados en {salida}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
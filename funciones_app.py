@@ -13,27 +13,46 @@ import sys
 import time
 import json
 import base64
+import gzip
+import hashlib
+import uuid
 import webbrowser
 from pathlib import Path
 from tempfile import TemporaryDirectory
 import unicodedata
+import atexit
+import logging
+import shutil
+import inspect
+import io
+import sqlite3
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from functools import lru_cache, wraps
+from dataclasses import dataclass
+from types import SimpleNamespace
+
+log = logging.getLogger(__name__)
+_INICIO_IMPORTACION = time.perf_counter()         # ver TIEMPO_IMPORTACION al final
 
 # ── Third-party ───────────────────────────────
+# Sólo lo que necesita cualquier mapa. Selenium (capturas con navegador),
+# imageio (MP4), Pillow (frames y animaciones) y matplotlib (motor sin
+# navegador) se importan la primera vez que se usan, así Streamlit y cada
+# proceso del pool arrancan antes.
+# Los helpers de Jupyter (IPython.display, ipywidgets) se importan en el notebook.
+import numpy as np
 import pandas as pd
 import geopandas as gpd
 import folium
-from folium.plugins import MarkerCluster          # quítalo si no lo usas
-from shapely.geometry import Point
+import shapely
 from branca.element import Template, MacroElement
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-import imageio.v2 as imageio
 from jinja2 import Template                       # ya importada arriba; borra si no la necesitas duplicada
 
-# ── Jupyter helpers (solo si trabajas en notebook) ──
-from IPython.display import display, IFrame, clear_output
-from ipywidgets import interact, widgets
-
 
 # In[47]:
 
@@ -48,8 +67,286 @@ else:                                              # modo desarrollo o Jupyter
         BASE_DIR = Path.cwd()
 
 DATOS_DIR     = BASE_DIR / "datos"                 # Excel, geojson, etc.
-RESULTADOS_DIR = BASE_DIR / "resultados"           # salidas generadas
-RESULTADOS_DIR.mkdir(exist_ok=True)
+RESULTADOS_DIR = BASE_DIR / "resultados"           # salidas generadas (se crea al escribir)
+
+
+# In[48]:
+
+
+# ── Caché columnar (Parquet) de los Excel de datos/ ─────────────
+TIPOS_TRANSPORTE = {"provincia origen": "category", "dia": "int16", "viajes": "int64"}
+
+
+def _sha256_fichero(path):
+    """
+    Calcula el SHA-256 de un fichero leyéndolo por bloques.
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for bloque in iter(lambda: f.read(1 << 20), b""):
+            h.update(bloque)
+    return h.hexdigest()
+
+
+def _temporal_junto_a(destino, sufijo=".tmp"):
+    """
+    Ruta temporal única junto a 'destino' (distinta en cada llamada, así
+    que dos hilos del mismo proceso tampoco comparten temporal).
+    """
+    return destino.with_name(f".{destino.name}.{uuid.uuid4().hex}{sufijo}")
+
+
+def _escribir_atomico(destino, escribir):
+    """
+    Escribe en un temporal junto a 'destino' y lo renombra al terminar,
+    de modo que otro proceso o hilo nunca lea un fichero a medio escribir.
+    """
+    tmp = _temporal_junto_a(Path(destino))
+    try:
+        escribir(tmp)
+        os.replace(tmp, destino)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+
+
+def _enlazar(origen, destino):
+    """
+    Deja en 'destino' el fichero 'origen' de forma atómica: enlace duro
+    (sin copiar datos) o copia si el sistema de ficheros no lo permite.
+    """
+    destino = Path(destino)
+    destino.parent.mkdir(parents=True, exist_ok=True)
+    tmp = _temporal_junto_a(destino)
+    try:
+        try:
+            os.link(origen, tmp)
+        except OSError:
+            shutil.copy2(origen, tmp)
+        os.replace(tmp, destino)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+
+
+def _reemplazar_carpeta(nueva, carpeta):
+    """
+    Pone la carpeta 'nueva' (junto a 'carpeta') en su lugar. La anterior se
+    aparta antes de borrarla, así nadie ve una carpeta a medio vaciar.
+    """
+    viejo = _temporal_junto_a(carpeta, ".viejo")
+    try:
+        os.replace(carpeta, viejo)
+    except FileNotFoundError:
+        pass
+    os.replace(nueva, carpeta)
+    shutil.rmtree(viejo, ignore_errors=True)
+
+
+# ── Artefactos comprimidos ───────────────────────────────────────
+#   "gzip" / "br"        → <nombre>.gz / .br (brotli sólo si está instalado),
+#   "autodescomprimible" → un HTML con el original en gzip+base64 que el
+#                          navegador descomprime al abrirlo (DecompressionStream).
+try:
+    import brotli                                  # opcional: compresión .br
+except ImportError:
+    brotli = None
+
+COMPRESIONES = {None: "", "gzip": ".gz", "autodescomprimible": ""}   # → sufijo añadido
+if brotli is not None:
+    COMPRESIONES["br"] = ".br"
+CALIDAD_BROTLI = 7                                 # 11 es demasiado lento para cientos de MB
+
+
+class _FicheroBrotli(io.RawIOBase):
+    """
+    Fichero binario de sólo escritura que comprime con brotli al vuelo.
+    """
+
+    def __init__(self, ruta, calidad=CALIDAD_BROTLI):
+        self._f = open(ruta, "wb")
+        self._compresor = brotli.Compressor(quality=calidad)
+
+    def writable(self):
+        return True
+
+    def write(self, datos):
+        self._f.write(self._compresor.process(bytes(datos)))
+        return len(datos)
+
+    def close(self):
+        if not self.closed:
+            self._f.write(self._compresor.finish())
+            self._f.close()
+        super().close()
+
+
+_VISOR_AUTODESCOMPRIMIBLE = ("""<!DOCTYPE html>
+<html lang="es"><head><meta charset="utf-8"/><title>{titulo}</title></head>
+<body><p style="font-family:sans-serif">Descomprimiendo…</p>
+<script id="datos" type="application/octet-stream">""", """</script>
+<script>
+(async function () {
+  var b64 = document.getElementById("datos").textContent;
+  var r = await fetch("data:application/gzip;base64," + b64);
+  var html = await new Response(r.body.pipeThrough(new DecompressionStream("gzip"))).text();
+  document.open(); document.write(html); document.close();
+})();
+</script></body></html>""")
+
+
+def _visor_autodescomprimible(origen_gz, destino, titulo):
+    """
+    Escribe en 'destino' el HTML autodescomprimible con el gzip 'origen_gz'
+    codificado en base64 por bloques (sin cargarlo entero en memoria).
+    """
+    inicio, fin = _VISOR_AUTODESCOMPRIMIBLE
+    with open(origen_gz, "rb") as gz, open(destino, "w", encoding="utf-8") as f:
+        f.write(inicio.format(titulo=titulo))
+        for bloque in iter(lambda: gz.read(3 << 18), b""):      # múltiplo de 3: sin relleno
+            f.write(base64.b64encode(bloque).decode("ascii"))
+        f.write(fin)
+
+
+def ruta_salida(destino, compresion=None):
+    """
+    Ruta final de 'destino' escrito con 'compresion' (clave de COMPRESIONES).
+    """
+    if compresion not in COMPRESIONES:
+        raise ValueError(f"Compresión desconocida: {compresion}")
+    destino = Path(destino)
+    return destino.with_name(destino.name + COMPRESIONES[compresion])
+
+
+@contextmanager
+def escribir_por_partes(destino, compresion=None):
+    """
+    Fichero de texto UTF-8 para escribir 'destino' a trozos, según se
+    genera, sin tenerlo entero en memoria. Como _escribir_atomico, se
+    escribe en un temporal que sólo se renombra si el bloque termina sin
+    error. Con 'compresion' (ver COMPRESIONES) se comprime al vuelo;
+    'destino' debe ser ruta_salida(..., compresion).
+    """
+    destino = Path(destino)
+    if compresion not in COMPRESIONES:
+        raise ValueError(f"Compresión desconocida: {compresion}")
+    tmp = _temporal_junto_a(destino, ".partes.tmp")
+    try:
+        if compresion == "br":
+            f = io.TextIOWrapper(io.BufferedWriter(_FicheroBrotli(tmp)), encoding="utf-8")
+        elif compresion in ("gzip", "autodescomprimible"):
+            f = gzip.open(tmp, "wt", encoding="utf-8")
+        else:
+            f = open(tmp, "w", encoding="utf-8")
+        with f:
+            yield f
+        if compresion == "autodescomprimible":
+            _escribir_atomico(destino, lambda final: _visor_autodescomprimible(
+                tmp, final, destino.stem))
+        else:
+            os.replace(tmp, destino)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+
+
+def version_comprimida(ruta, compresion="autodescomprimible"):
+    """
+    Copia comprimida de un artefacto de texto ya generado, junto a él:
+    <nombre>.gz / .br o, si es autodescomprimible, <stem>.comprimido<sufijo>.
+    Se crea la primera vez que se pide y se rehace si el original es más nuevo.
+    """
+    ruta = Path(ruta)
+    if compresion == "autodescomprimible":
+        cabecera = _VISOR_AUTODESCOMPRIMIBLE[0].split("{titulo}")[0].encode()
+        with ruta.open("rb") as f:
+            if f.read(len(cabecera)) == cabecera:         # ya lo es
+                return ruta
+        destino = ruta.with_name(f"{ruta.stem}.comprimido{ruta.suffix}")
+    else:
+        destino = ruta_salida(ruta, compresion)
+    if destino.exists() and destino.stat().st_mtime_ns >= ruta.stat().st_mtime_ns:
+        return destino
+    with ruta.open(encoding="utf-8") as origen, escribir_por_partes(destino, compresion) as f:
+        shutil.copyfileobj(origen, f, 1 << 20)
+    return destino
+
+
+@lru_cache(maxsize=64)
+def _leer_excel_tabla(ruta, mtime_ns, size, tipos):
+    """
+    Devuelve el contenido de un Excel desde su copia Parquet en '.cache/'.
+    La clave (mtime_ns, size) hace que la memoria se invalide sola si el
+    fichero cambia; en disco se comprueba además el SHA-256 del Excel.
+    """
+    path = Path(ruta)
+    cache_dir = path.parent / ".cache"
+    parquet = cache_dir / f"{path.stem}.parquet"
+    meta = cache_dir / f"{path.stem}.json"
+
+    info = {}
+    if parquet.exists() and meta.exists():
+        try:
+            info = json.loads(meta.read_text(encoding="utf-8"))
+        except ValueError:
+            info = {}
+    vigente = info.get("tipos") == [list(t) for t in tipos]
+
+    sha = None
+    if vigente and (info.get("mtime_ns"), info.get("size")) != (mtime_ns, size):
+        # Cambió la fecha (p. ej. un checkout): sólo se regenera si cambió el contenido
+        sha = _sha256_fichero(path)
+        vigente = info.get("sha256") == sha
+    if vigente:
+        try:
+            df = pd.read_parquet(parquet)
+        except Exception:
+            vigente = False
+    if not vigente:
+        df = pd.read_excel(path)
+        for col, tipo in tipos:
+            if col in df.columns:
+                try:
+                    df[col] = df[col].astype(tipo)
+                except (TypeError, ValueError):
+                    pass                       # se deja el tipo inferido por pandas
+        sha = sha or _sha256_fichero(path)
+
+    if not vigente or sha is not None:
+        info = {"sha256": sha, "mtime_ns": mtime_ns, "size": size,
+                "tipos": [list(t) for t in tipos]}
+        try:
+            cache_dir.mkdir(exist_ok=True)
+            if not vigente:
+                _escribir_atomico(parquet, lambda tmp: df.to_parquet(tmp, index=False))
+            _escribir_atomico(meta, lambda tmp: tmp.write_text(json.dumps(info), encoding="utf-8"))
+        except OSError:
+            pass                               # sin permisos de escritura: se lee sin caché
+    return df
+
+
+def leer_excel_cacheado(path, tipos=None):
+    """
+    Lee un Excel de datos/ a través de una copia Parquet tipada.
+    La primera lectura convierte el libro y lo guarda en datos/.cache/;
+    las siguientes leen el Parquet (o directamente la memoria del proceso).
+    Devuelve siempre una copia, así que el llamador puede modificarla.
+    """
+    path = Path(path)
+    st = path.stat()
+    tipos = tuple(sorted((tipos or {}).items()))
+    return _leer_excel_tabla(str(path.resolve()), st.st_mtime_ns, st.st_size, tipos).copy()
+
+
+def leer_transporte(ciudad, mes):
+    """
+    Devuelve el DataFrame de viajes de datos/<ciudad>-<mes>.xlsx
+    (columnas 'provincia origen', 'dia', 'viajes') ya tipado.
+    """
+    transporte_file = DATOS_DIR / f"{ciudad.lower()}-{int(mes):02}.xlsx"
+    if not transporte_file.exists():
+        raise FileNotFoundError(transporte_file)
+    return leer_excel_cacheado(transporte_file, TIPOS_TRANSPORTE)
 
 
 # In[119]:
@@ -61,40 +358,143 @@ RESULTADOS_DIR.mkdir(exist_ok=True)
 # In[51]:
 
 
+@lru_cache(maxsize=None)
+def _normalizar(s):
+    return unicodedata.normalize('NFKD', s).encode('ASCII', 'ignore').decode('utf-8').lower().strip()
+
+
 def normalize_string(s):
     """
     Normaliza una cadena eliminando acentos y transformándola a minúsculas.
+    El resultado se memoiza por valor distinto.
     """
     if pd.isna(s):
         return ""
-    return unicodedata.normalize('NFKD', str(s)).encode('ASCII', 'ignore').decode('utf-8').lower().strip()
+    return _normalizar(str(s))
 
 
 # In[53]:
 
 
+# ── Tabla de alias de provincias ──────────────────────────────────
+# Nombre estándar (el de los Excel de transporte, normalizado) → variantes
+# conocidas: nombres cooficiales, castellanizados, antiguos y abreviados.
+# Se comparan ya normalizadas (sin acentos y en minúsculas).
+ALIAS_PROVINCIAS = {
+    "a coruna": ("la coruna", "coruna", "coruna, a", "coruna (a)", "a coruna/la coruna"),
+    "alava": ("araba", "araba/alava", "alava/araba", "vitoria"),
+    "albacete": (),
+    "alicante": ("alacant", "alicante/alacant", "alacant/alicante"),
+    "almeria": (),
+    "asturias": ("principado de asturias", "asturies", "oviedo"),
+    "avila": (),
+    "badajoz": (),
+    "barcelona": (),
+    "bizkaia": ("vizcaya", "biscay"),
+    "burgos": (),
+    "caceres": (),
+    "cadiz": (),
+    "cantabria": ("santander",),
+    "castellon": ("castello", "castellon/castello", "castello/castellon",
+                  "castellon de la plana"),
+    "ceuta": (),
+    "ciudad real": (),
+    "cordoba": (),
+    "cuenca": (),
+    "gipuzkoa": ("guipuzcoa", "gipuzkoa/guipuzcoa"),
+    "girona": ("gerona",),
+    "granada": (),
+    "guadalajara": (),
+    "huelva": (),
+    "huesca": (),
+    "illes balears": ("islas baleares", "baleares", "balears", "balears, illes",
+                      "balears (illes)"),
+    "jaen": (),
+    "la rioja": ("rioja", "rioja, la", "rioja (la)", "logrono"),
+    "las palmas": ("palmas", "palmas, las", "palmas (las)", "las palmas de gran canaria"),
+    "leon": (),
+    "lleida": ("lerida",),
+    "lugo": (),
+    "madrid": (),
+    "malaga": (),
+    "melilla": (),
+    "murcia": ("region de murcia",),
+    "navarra": ("nafarroa", "navarra/nafarroa", "comunidad foral de navarra"),
+    "ourense": ("orense",),
+    "palencia": (),
+    "pontevedra": (),
+    "salamanca": (),
+    "santa cruz de tenerife": ("tenerife", "s.c. tenerife", "sta. cruz de tenerife",
+                               "s/c de tenerife"),
+    "segovia": (),
+    "sevilla": ("seville",),
+    "soria": (),
+    "tarragona": (),
+    "teruel": (),
+    "toledo": (),
+    "valencia": ("valencia/valencia",),
+    "valladolid": (),
+    "zamora": (),
+    "zaragoza": ("saragossa",),
+}
+
+# Orígenes que no son provincias (extranjero) y no se avisan como desconocidos
+NO_PROVINCIAS = frozenset({"ex", "fr", "pt", "portugal", "france", "francia", "extranjero"})
+
+_ALIAS = {alias: prov for prov, alias_prov in ALIAS_PROVINCIAS.items()
+          for alias in (prov, *alias_prov)}
+
+
+@lru_cache(maxsize=None)
+def _estandarizar(nombre):
+    norm = _normalizar(nombre)
+    if norm in _ALIAS:
+        return _ALIAS[norm]
+    for parte in norm.split("/"):           # "Valencia/València", "Araba/Álava"…
+        if parte.strip() in _ALIAS:
+            return _ALIAS[parte.strip()]
+    return norm
+
+
 def standardize_province_name(name):
     """
-    Estandariza el nombre de una provincia usando un diccionario de equivalencias.
-    Se pueden agregar o ajustar mapeos según las discrepancias encontradas.
-    """
-    norm_name = normalize_string(name)
-    mapping = {
-        "castellon": "castellon",
-        "castellon/castello": "castellon",
-        "castello": "castellon",  # Ejemplo de variante
-        "alicante": "alicante",
-        "alacant": "alicante",
-        "alicante/alacant": "alicante",
-        "araba": "alava",
-        "araba/alava": "alava",
-        "Araba/Álava": "alava",
-        "Vitoria": "alava",
-        "Álava": "alava",
-        "\u00c1lava": "alava"
-        # Puedes agregar aquí otros mapeos que sean necesarios
-    }
-    return mapping.get(norm_name, norm_name)
+    Estandariza el nombre de una provincia usando la tabla ALIAS_PROVINCIAS.
+    Los nombres que no están en la tabla se devuelven sólo normalizados.
+    """
+    if pd.isna(name):
+        return ""
+    return _estandarizar(str(name))
+
+
+def estandarizar_provincias(valores):
+    """
+    Versión vectorizada de standardize_province_name para una columna
+    (o categórica): estandariza una vez cada valor distinto y expande por
+    códigos. Devuelve una pd.Series con el mismo índice.
+    """
+    serie = valores if isinstance(valores, pd.Series) else pd.Series(valores)
+    codigos, distintos = pd.factorize(serie)
+    std = np.array([_estandarizar(str(v)) for v in distintos] + [""], dtype=object)
+    return pd.Series(std[codigos], index=serie.index, name=serie.name)
+
+
+def provincias_sin_emparejar(prov_std):
+    """
+    Nombres estandarizados de 'prov_std' que no son ninguna de las 52
+    provincias de ALIAS_PROVINCIAS (ni orígenes extranjeros conocidos).
+    """
+    distintos = set(pd.unique(pd.Series(prov_std, dtype=object).dropna()))
+    return sorted(distintos - ALIAS_PROVINCIAS.keys() - NO_PROVINCIAS - {""})
+
+
+def avisar_sin_emparejar(prov_std, origen):
+    """
+    Registra en el log los nombres de 'origen' que no casan con ninguna provincia.
+    """
+    sueltos = provincias_sin_emparejar(prov_std)
+    if sueltos:
+        log.warning("Provincias sin emparejar en %s: %s", origen, ", ".join(sueltos))
+    return sueltos
 
 
 # In[55]:
@@ -112,9 +512,8 @@ def get_fill_color(volume, max_volume, sensibilidad):
         diferencia entre 0 y 100.
     
     El parámetro 'sensibilidad' se utiliza para ajustar la curva de intensidad.
+    Para colorear muchas provincias a la vez usar colores_viajes().
     """
-    import pandas as pd
-    
     # Comprobaciones iniciales.
     if volume is None or pd.isna(volume) or max_volume == 0:
         return "#ffffff"
@@ -140,6 +539,110 @@ def get_fill_color(volume, max_volume, sensibilidad):
     return f"#{r:02x}{g:02x}{b:02x}"
 
 
+# In[56]:
+
+
+# ── Rampa de color vectorizada (un día o un mes en una operación) ─
+UMBRAL_VIAJES = 90
+COLOR_DESTINO = "#66f26a"
+_HEX = np.array([f"{i:02x}" for i in range(256)])
+
+
+def _hex_rgb(r, g, b):
+    """
+    Convierte arrays enteros r, g, b (0–255) en un array de códigos '#rrggbb'.
+    """
+    return np.char.add(np.char.add(np.char.add("#", _HEX[r]), _HEX[g]), _HEX[b])
+
+
+def colores_viajes(viajes, sensibilidad, max_viajes=None):
+    """
+    Versión vectorizada de get_fill_color con la misma rampa y el mismo umbral.
+    'viajes' puede ser 1D (provincias de un día) o 2D (días × provincias);
+    si no se indica 'max_viajes' se usa el máximo de cada día (última dimensión).
+    Devuelve un array de códigos hexadecimales con la forma de 'viajes'.
+    """
+    v = np.asarray(viajes, dtype=float)
+    if max_viajes is None:
+        max_v = np.nan_to_num(v).max(axis=-1, keepdims=True) if v.size else np.zeros(v.shape)
+    else:
+        max_v = np.asarray(max_viajes, dtype=float)
+        if max_v.ndim and max_v.ndim == v.ndim - 1:
+            max_v = max_v[..., None]
+
+    efectivo_max = np.where(max_v > UMBRAL_VIAJES, max_v - UMBRAL_VIAJES, 1)
+    blanco = np.isnan(v) | (max_v == 0) | (v < UMBRAL_VIAJES)
+    norm = np.where(blanco, 0, v - UMBRAL_VIAJES) / efectivo_max
+    intensidad = np.clip(norm, 0, 1) ** (1.0 / sensibilidad)
+
+    rg = 255 - (255 * intensidad).astype(int)
+    b = 255 - (140 * intensidad).astype(int)
+    return np.where(blanco, "#ffffff", _hex_rgb(rg, rg, b))
+
+
+def colores_relativos(relativo, sensibilidad, max_relativo=None):
+    """
+    Rampa del mapa relativo (viajes por mil habitantes): blanco si el valor
+    es <= 0 y hasta RGB(0,0,0) pasando por el amarillo oscuro de la leyenda.
+    Admite 1D o 2D igual que colores_viajes().
+    """
+    r = np.nan_to_num(np.asarray(relativo, dtype=float))
+    if max_relativo is None:
+        max_r = r.max(axis=-1, keepdims=True) if r.size else np.zeros(r.shape)
+    else:
+        max_r = np.asarray(max_relativo, dtype=float)
+        if max_r.ndim and max_r.ndim == r.ndim - 1:
+            max_r = max_r[..., None]
+    max_r = np.where(max_r > 0, max_r, 1)
+
+    intensidad = np.minimum(np.maximum(r, 0) / max_r, 1) ** (1.0 / sensibilidad)
+    rg = 255 - (255 * intensidad).astype(int)
+    b = 139 - (139 * intensidad).astype(int)
+    return np.where(r <= 0, "#ffffff", _hex_rgb(rg, rg, b))
+
+
+def marcar_destino(colores, prov_std, ciudad):
+    """
+    Pinta con COLOR_DESTINO las columnas cuya provincia es la ciudad estudiada.
+    'prov_std' debe estar alineado con la última dimensión de 'colores'.
+    """
+    colores = np.array(colores, copy=True)
+    colores[..., np.asarray(prov_std) == standardize_province_name(ciudad)] = COLOR_DESTINO
+    return colores
+
+
+@dataclass(frozen=True)
+class Medida:
+    """
+    Lo que pinta un mapa: rampa de color, etiqueta del tooltip y
+    texto de la leyenda (color de muestra, nombre del color y descripción).
+    """
+    colores: object
+    etiqueta: str
+    muestra: str
+    nombre_color: str
+    origen: str
+    intensidad: str
+
+
+# "viajes": viajes absolutos; "relativo": viajes por mil habitantes.
+MEDIDAS = {
+    "viajes":   Medida(colores_viajes, "Viajes", "#336699", "Azul",
+                       "Provincias de origen", "Más oscuro → más desplazamientos"),
+    "relativo": Medida(colores_relativos, "Viajes/mil hab.", "#FFCC00", "Amarillo",
+                       "Provincias origen", "Más oscuro → Más viajes/mil hab."),
+}
+
+
+def medida_mapa(medida):
+    """
+    Medida de MEDIDAS por nombre; ValueError si no existe.
+    """
+    if medida not in MEDIDAS:
+        raise ValueError(f"Medida desconocida: {medida}")
+    return MEDIDAS[medida]
+
+
 # In[57]:
 
 
@@ -160,7 +663,7 @@ def detectar_campo_provincia(gdf, df_transport):
     best_matches = 0
     for field in candidate_fields:
         try:
-            std_values = gdf[field].astype(str).apply(standardize_province_name)
+            std_values = estandarizar_provincias(gdf[field].astype(str))
         except Exception:
             continue
         count_matches = std_values.isin(transport_provinces).sum()
@@ -179,6 +682,945 @@ def detectar_campo_provincia(gdf, df_transport):
     return best_field
 
 
+# In[58]:
+
+
+# ── Registro de provincias (GeoJSON cargado una sola vez) ─────────
+@dataclass(frozen=True, eq=False)
+class RegistroProvincias:
+    """
+    Geometría provincial compartida por todos los mapas del proceso.
+      - gdf:      GeoDataFrame original con la columna 'prov_std' ya calculada.
+      - campo:    campo del GeoJSON que contiene el nombre de la provincia.
+      - centro:   (lat, lon) del centroide calculado en EPSG:3857.
+      - geojson:  geometría serializada (campo, 'prov_std' y 'geometry').
+    No debe modificarse: los mapas trabajan sobre copias o merges.
+    Se compara y se usa como clave de caché por identidad.
+    """
+    gdf: gpd.GeoDataFrame
+    campo: str
+    centro: tuple
+    geojson: str
+
+    @property
+    def prov_std(self):
+        return self.gdf["prov_std"]
+
+    def geometria(self, zoom=None):
+        """
+        Geometría para dibujar a 'zoom' (ver _geometria_nivel); None o un
+        zoom >= ZOOM_GEOMETRIA_COMPLETA devuelve la geometría original.
+        """
+        if zoom is None or zoom >= ZOOM_GEOMETRIA_COMPLETA:
+            return self.gdf.geometry
+        return _geometria_nivel(self, int(zoom))
+
+
+def _provincias_referencia():
+    """
+    Nombres estandarizados de las provincias españolas, usados para
+    detectar el campo del GeoJSON sin depender del Excel de cada ciudad.
+    """
+    pop_file = DATOS_DIR / "poblaciones_provincias.xlsx"
+    if not pop_file.exists():
+        return pd.DataFrame({"prov_std": []})
+    dfP = leer_excel_cacheado(pop_file)
+    return pd.DataFrame({"prov_std": estandarizar_provincias(dfP["provincia"])})
+
+
+@lru_cache(maxsize=4)
+def _registro_provincias(ruta, mtime_ns):
+    gdf = gpd.read_file(ruta)
+    campo = detectar_campo_provincia(gdf, _provincias_referencia())
+    if campo is None:
+        raise RuntimeError("No se detectó campo provincia válido")
+    gdf["prov_std"] = estandarizar_provincias(gdf[campo].astype(str))
+    avisar_sin_emparejar(gdf["prov_std"], Path(ruta).name)
+
+    centro = gdf.to_crs("EPSG:3857").geometry.centroid.unary_union.centroid
+    ctr_ll = gpd.GeoSeries([centro], crs="EPSG:3857").to_crs("EPSG:4326").iloc[0]
+    geojson = gdf[[campo, "prov_std", "geometry"]].to_json()
+    return RegistroProvincias(gdf=gdf, campo=campo, centro=(ctr_ll.y, ctr_ll.x), geojson=geojson)
+
+
+# ── Niveles de detalle de la geometría según el zoom ─────────────
+# A zoom z un píxel de tesela (256 px) mide 360 / (256·2^z) grados, así que
+# los vértices más cercanos que medio píxel no se ven. Cada nivel se
+# simplifica como cobertura (las fronteras compartidas se simplifican una
+# sola vez y no aparecen huecos) y se cuantiza a una rejilla decimal.
+ZOOM_GEOMETRIA_COMPLETA = 11
+
+
+def tolerancia_zoom(zoom):
+    """
+    Tolerancia de simplificación (grados) para un zoom: medio píxel.
+    """
+    return 180.0 / (256 * 2 ** int(zoom))
+
+
+@lru_cache(maxsize=16)
+def _geometria_nivel(registro, zoom):
+    """
+    GeoSeries simplificada y cuantizada de 'registro' para 'zoom'.
+    Con shapely < 2.1 (sin coverage_simplify) sólo se cuantiza: los vértices
+    compartidos caen en el mismo punto de la rejilla y los que colapsan
+    se eliminan, así las fronteras siguen encajando.
+    """
+    tol = tolerancia_zoom(zoom)
+    geoms = np.asarray(registro.gdf.geometry.array)
+    if hasattr(shapely, "coverage_simplify"):
+        try:
+            geoms = shapely.coverage_simplify(geoms, tol)
+        except shapely.errors.GEOSException:
+            log.warning("La geometría no es una cobertura válida; sólo se cuantiza")
+    rejilla = 10.0 ** -np.ceil(-np.log10(tol / 2))
+    geoms = shapely.set_precision(geoms, rejilla)
+    return gpd.GeoSeries(geoms, index=registro.gdf.index, crs=registro.gdf.crs)
+
+
+def cargar_provincias(georef_file=None):
+    """
+    Devuelve el RegistroProvincias de datos/georef-spain-provincia.geojson.
+    Se lee y prepara una vez por proceso (LRU por ruta y fecha de modificación).
+    """
+    georef_file = Path(georef_file or DATOS_DIR / "georef-spain-provincia.geojson")
+    if not georef_file.exists():
+        raise FileNotFoundError(georef_file)
+    return _registro_provincias(str(georef_file.resolve()), georef_file.stat().st_mtime_ns)
+
+
+# ── Capa GeoJSON de provincias con la geometría ya serializada ───
+# folium.GeoJson convierte el GeoDataFrame a dict, llama a style_function
+# por provincia y vuelve a serializarlo todo en cada render. Aquí la
+# geometría de cada nivel de zoom se pasa a texto una vez por proceso y en
+# cada mapa sólo se serializan las propiedades; el estilo lo calcula
+# Leaflet a partir de la propiedad "fill".
+try:
+    import orjson                                  # opcional: JSON más rápido
+except ImportError:
+    orjson = None
+
+ESTILO_PROVINCIAS = {"color": "blue", "weight": 1, "fillOpacity": 1}
+
+
+def json_compacto(obj):
+    """
+    JSON compacto de 'obj' (con orjson si está instalado). Admite escalares numpy.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False, default=lambda o: o.item())
+
+
+@lru_cache(maxsize=16)
+def _geometrias_json(registro, zoom):
+    """
+    Geometría de cada provincia de 'registro' a 'zoom' como texto GeoJSON
+    (tupla en el orden de registro.gdf), serializada una vez por proceso.
+    """
+    geoms = registro.geometria(zoom)
+    if geoms.crs is not None and geoms.crs.to_epsg() != 4326:
+        geoms = geoms.to_crs("EPSG:4326")
+    return tuple(g or "null" for g in shapely.to_geojson(np.asarray(geoms.array)).tolist())
+
+
+def geojson_provincias(registro, zoom, propiedades):
+    """
+    FeatureCollection (texto) con la geometría de 'registro' a 'zoom' y, en
+    cada feature, las propiedades de la fila correspondiente de
+    'propiedades' (DataFrame con las filas en el orden de registro.gdf).
+    """
+    geometrias = _geometrias_json(registro, zoom)
+    filas = propiedades.to_dict("records")
+    if len(filas) != len(geometrias):
+        raise ValueError("Las propiedades no están alineadas con las provincias")
+    features = ",".join(
+        f'{{"type":"Feature","id":"{i}","properties":{json_compacto(p)},"geometry":{g}}}'
+        for i, (p, g) in enumerate(zip(filas, geometrias)))
+    return '{"type":"FeatureCollection","features":[' + features + "]}"
+
+
+class CapaProvincias(folium.GeoJson):
+    """
+    Capa de provincias para los mapas Folium, equivalente a
+    folium.GeoJson(gdf, style_function=...) con relleno = propiedad "fill"
+    y el resto del estilo fijo ('estilo', por defecto ESTILO_PROVINCIAS).
+    Admite un GeoJsonTooltip con los campos de 'propiedades' y _capa_geojson
+    la encuentra como a cualquier folium.GeoJson.
+    """
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+        var {{ this.get_name() }} = L.geoJson(null, {
+            style: function(feature) {
+                return Object.assign({fillColor: feature.properties.fill}, {{ this.estilo }});
+            }
+        });
+        {{ this.get_name() }}.addData({{ this.datos }});
+        {% endmacro %}
+        """)
+
+    def __init__(self, registro, zoom, propiedades, estilo=None, tooltip=None):
+        # 'data' es sólo un feature sin geometría con los campos de 'propiedades'
+        # (GeoJsonTooltip valida sus campos con él); el GeoJSON real va en 'datos'
+        super().__init__({"type": "FeatureCollection",
+                          "features": [{"type": "Feature", "geometry": None,
+                                        "properties": dict.fromkeys(propiedades.columns)}]},
+                         tooltip=tooltip)
+        self.estilo = json_compacto(estilo or ESTILO_PROVINCIAS)
+        self.datos = geojson_provincias(registro, zoom, propiedades).replace("</", "<\\/")
+        self.registro, self.zoom = registro, zoom
+
+    def _get_self_bounds(self):
+        geoms = self.registro.geometria(self.zoom)
+        if geoms.crs is not None and geoms.crs.to_epsg() != 4326:
+            geoms = geoms.to_crs("EPSG:4326")
+        oeste, sur, este, norte = geoms.total_bounds
+        return [[sur, oeste], [norte, este]]
+
+
+# In[59]:
+
+
+# ── Cubo de viajes día × provincia por (ciudad, mes) ─────────────
+@dataclass(frozen=True)
+class CuboViajes:
+    """
+    Viajes de un (ciudad, mes) agregados en una sola pasada:
+      - dias:        array ordenado con los días que tienen datos.
+      - provincias:  pd.Index de provincias origen estandarizadas ('prov_std').
+      - viajes:      matriz float (len(dias) × len(provincias)).
+    Cualquier mapa diario, mensual, comparación o GIF lee una fila.
+    """
+    dias: np.ndarray
+    provincias: pd.Index
+    viajes: np.ndarray
+
+    def fila(self, dia):
+        """
+        Índice de la fila de 'dia'; ValueError si ese día no tiene datos.
+        """
+        i = int(np.searchsorted(self.dias, dia))
+        if i >= len(self.dias) or self.dias[i] != dia:
+            raise ValueError(f"No hay datos para el día {dia}")
+        return i
+
+    def serie_dia(self, dia):
+        """
+        Viajes de un día como pd.Series indexada por 'prov_std'.
+        """
+        return pd.Series(self.viajes[self.fila(dia)], index=self.provincias, name="viajes")
+
+    def alinear(self, prov_std):
+        """
+        Reordena las columnas según 'prov_std' (p. ej. las features del GeoJSON).
+        Devuelve una matriz (días × len(prov_std)) con 0 donde no hay datos.
+        """
+        idx = self.provincias.get_indexer(pd.Index(prov_std))
+        out = self.viajes[:, np.clip(idx, 0, None)] if len(self.provincias) else \
+              np.zeros((len(self.dias), len(idx)))
+        out[:, idx < 0] = 0
+        return out
+
+
+@lru_cache(maxsize=32)
+def _cubo_transporte(ruta, mtime_ns, size):
+    df = leer_excel_cacheado(ruta, TIPOS_TRANSPORTE)
+    for col in ("provincia origen", "dia", "viajes"):
+        if col not in df.columns:
+            raise ValueError(f"El Excel no contiene la columna '{col}'")
+    df = df[df["dia"].notna()]
+
+    # Estandarizar una vez por nombre distinto, no por fila
+    origen = df["provincia origen"].astype("category")
+    std_cat = estandarizar_provincias(origen.cat.categories.astype(str)).to_numpy()
+    avisar_sin_emparejar(std_cat, Path(ruta).name)
+    cod_cat, provincias = pd.factorize(std_cat, sort=True)
+    codigos = origen.cat.codes.to_numpy()
+    # Origen vacío (código -1) o sin nombre estándar: la fila no suma en ninguna provincia
+    cod_prov = np.where(codigos >= 0, cod_cat[codigos], -1)
+    validas = cod_prov >= 0
+
+    dias, cod_dia = np.unique(df["dia"].to_numpy().astype(int), return_inverse=True)
+    n_prov = len(provincias)
+    pesos = np.nan_to_num(df["viajes"].to_numpy(dtype=float))[validas]
+    viajes = np.bincount(cod_dia[validas] * n_prov + cod_prov[validas], weights=pesos,
+                         minlength=len(dias) * n_prov).reshape(len(dias), n_prov)
+    viajes.flags.writeable = False
+    return CuboViajes(dias=dias, provincias=pd.Index(provincias, name="prov_std"), viajes=viajes)
+
+
+def _firma_fichero(path):
+    st = path.stat()
+    return str(path.resolve()), st.st_mtime_ns, st.st_size
+
+
+def cubo_transporte(ciudad, mes):
+    """
+    Devuelve el CuboViajes de datos/<ciudad>-<mes>.xlsx (memoizado por proceso).
+    """
+    transporte_file = DATOS_DIR / f"{ciudad.lower()}-{int(mes):02}.xlsx"
+    if not transporte_file.exists():
+        raise FileNotFoundError(transporte_file)
+    return _cubo_transporte(*_firma_fichero(transporte_file))
+
+
+@lru_cache(maxsize=4)
+def _poblacion_provincias(ruta, mtime_ns, size):
+    dfP = leer_excel_cacheado(ruta)
+    prov_std = estandarizar_provincias(dfP["provincia"]).to_numpy()
+    avisar_sin_emparejar(prov_std, Path(ruta).name)
+    pob = pd.Series(dfP["población"].to_numpy(dtype=float),
+                    index=pd.Index(prov_std, name="prov_std"), name="población")
+    pob = pob[~pob.index.isin(["portugal", "france", "francia"])]
+    return pob.groupby(level=0).sum()
+
+
+def poblacion_provincias():
+    """
+    Población por 'prov_std' de datos/poblaciones_provincias.xlsx, ya
+    estandarizada y sin las filas de Portugal/Francia (memoizada por proceso).
+    """
+    pop_file = DATOS_DIR / "poblaciones_provincias.xlsx"
+    if not pop_file.exists():
+        raise FileNotFoundError(f"poblaciones no encontrado: {pop_file}")
+    return _poblacion_provincias(*_firma_fichero(pop_file))
+
+
+def por_mil_habitantes(viajes, poblacion):
+    """
+    Viajes por mil habitantes elemento a elemento (0 si la población es 0
+    o desconocida). 'poblacion' se alinea con la última dimensión de 'viajes'.
+    """
+    viajes = np.asarray(viajes, dtype=float)
+    poblacion = np.nan_to_num(np.asarray(poblacion, dtype=float))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(poblacion > 0, viajes / poblacion * 1_000, 0.0)
+
+
+@lru_cache(maxsize=32)
+def _cubo_relativo(transporte, poblacion):
+    cubo = _cubo_transporte(*transporte)
+    pob = _poblacion_provincias(*poblacion).reindex(cubo.provincias).to_numpy()
+    relativo = por_mil_habitantes(cubo.viajes, pob)
+    relativo.flags.writeable = False
+    return CuboViajes(dias=cubo.dias, provincias=cubo.provincias, viajes=relativo)
+
+
+def cubo_relativo(ciudad, mes):
+    """
+    CuboViajes con los viajes por mil habitantes de todo el mes, calculado
+    con una sola división de la matriz (memoizado por proceso).
+    """
+    transporte_file = DATOS_DIR / f"{ciudad.lower()}-{int(mes):02}.xlsx"
+    if not transporte_file.exists():
+        raise FileNotFoundError(transporte_file)
+    poblacion_provincias()                      # comprueba que existe
+    return _cubo_relativo(_firma_fichero(transporte_file),
+                          _firma_fichero(DATOS_DIR / "poblaciones_provincias.xlsx"))
+
+
+def cubo_medida(ciudad, mes, medida="viajes"):
+    """
+    Cubo de la medida pedida: cubo_transporte o cubo_relativo.
+    """
+    medida_mapa(medida)
+    return cubo_relativo(ciudad, mes) if medida == "relativo" else cubo_transporte(ciudad, mes)
+
+
+# In[122]:
+
+
+# ── Progreso y telemetría de los exportadores ────────────────────
+METRICAS_FICHERO = os.environ.get("MOVILIDAD_METRICAS")   # p. ej. textfile de node_exporter
+
+
+class Progreso(int):
+    """
+    Evento de progreso de los exportadores. Es un int (0–100), así que
+    quien sólo mira el porcentaje no nota la diferencia, pero además lleva:
+      - etapa:        etapa en curso ("datos", "render", "captura"…).
+      - transcurrido: segundos desde que empezó la exportación.
+      - bytes:        bytes producidos en la etapa hasta ahora (o None).
+      - hechos/total: elementos terminados de la etapa (días, frames…).
+    Los generadores pueden seguir emitiendo ints sueltos: instrumentar()
+    los convierte heredando la etapa y los contadores del evento anterior.
+    """
+
+    def __new__(cls, valor, etapa=None, transcurrido=None, bytes=None, hechos=None, total=None):
+        evento = super().__new__(cls, valor)
+        evento.etapa, evento.transcurrido = etapa, transcurrido
+        evento.bytes, evento.hechos, evento.total = bytes, hechos, total
+        return evento
+
+    def eta(self):
+        """
+        Segundos que faltan, extrapolando el ritmo medido hasta ahora
+        (None mientras no haya tiempo ni avance con que estimarlo).
+        """
+        if self.transcurrido is None or self <= 0:
+            return None
+        return max(self.transcurrido * (100 - int(self)) / int(self), 0.0)
+
+    def a_dict(self):
+        return {"progreso": int(self), "etapa": self.etapa, "transcurrido": self.transcurrido,
+                "bytes": self.bytes, "hechos": self.hechos, "total": self.total}
+
+    @classmethod
+    def desde_dict(cls, datos):
+        datos = dict(datos)
+        return cls(datos.pop("progreso"), **datos)
+
+    def __repr__(self):
+        return f"Progreso({int(self)}, etapa={self.etapa!r}, transcurrido={self.transcurrido!r})"
+
+
+_METRICAS = {}                      # (métrica, etiquetas) → valor acumulado
+_METRICAS_LOCK = threading.Lock()
+METRICAS_AYUDA = {
+    "movilidad_etapa_segundos": "Segundos dedicados a cada etapa de exportación.",
+    "movilidad_etapa_ejecuciones": "Veces que se ha completado cada etapa.",
+    "movilidad_etapa_bytes": "Bytes producidos en cada etapa.",
+    "movilidad_etapa_elementos": "Elementos (días, frames) procesados en cada etapa.",
+    "movilidad_exportaciones": "Exportaciones terminadas, por resultado.",
+    "movilidad_importacion_segundos": "Segundos que tardó en importarse funciones_app.",
+}
+
+
+def _sumar_metrica(metrica, valor, **etiquetas):
+    clave = (metrica, tuple(sorted(etiquetas.items())))
+    with _METRICAS_LOCK:
+        _METRICAS[clave] = _METRICAS.get(clave, 0) + valor
+
+
+def registrar_etapa(funcion, etapa, segundos, evento=None):
+    """
+    Apunta en el log y en los contadores una etapa terminada de 'funcion'
+    (con los bytes y elementos del último evento de la etapa, si los hay).
+    """
+    bytes_ = getattr(evento, "bytes", None)
+    hechos = getattr(evento, "hechos", None)
+    log.info("%s · %s: %.2f s%s%s", funcion, etapa, segundos,
+             f", {hechos} elementos" if hechos else "",
+             f", {bytes_ / 2**20:.1f} MB" if bytes_ else "")
+    _sumar_metrica("movilidad_etapa_segundos", segundos, funcion=funcion, etapa=etapa)
+    _sumar_metrica("movilidad_etapa_ejecuciones", 1, funcion=funcion, etapa=etapa)
+    if bytes_:
+        _sumar_metrica("movilidad_etapa_bytes", bytes_, funcion=funcion, etapa=etapa)
+    if hechos:
+        _sumar_metrica("movilidad_etapa_elementos", hechos, funcion=funcion, etapa=etapa)
+
+
+def metricas_openmetrics():
+    """
+    Contadores acumulados del proceso en formato de texto OpenMetrics.
+    """
+    with _METRICAS_LOCK:
+        valores = sorted(_METRICAS.items())
+    lineas, actual = [], None
+    for (metrica, etiquetas), valor in valores:
+        if metrica != actual:
+            actual = metrica
+            lineas += [f"# TYPE {metrica} counter", f"# HELP {metrica} {METRICAS_AYUDA[metrica]}"]
+        texto = ",".join(f'{k}="{v}"' for k, v in etiquetas)
+        lineas.append(f"{metrica}_total{{{texto}}} {valor:g}")
+    lineas.append("# EOF")
+    return "\n".join(lineas) + "\n"
+
+
+def volcar_metricas(ruta=None):
+    """
+    Escribe metricas_openmetrics() en 'ruta' (por defecto MOVILIDAD_METRICAS;
+    si no hay ninguna no hace nada).
+    """
+    ruta = ruta or METRICAS_FICHERO
+    if ruta:
+        texto = metricas_openmetrics()
+        _escribir_atomico(Path(ruta), lambda tmp: tmp.write_text(texto, encoding="utf-8"))
+
+
+def instrumentar(eventos, funcion):
+    """
+    Envuelve un generador de exportación: convierte cada progreso en un
+    Progreso con la etapa y el tiempo transcurrido, y al cambiar de etapa
+    (o terminar) la registra con registrar_etapa. Al final suma la
+    exportación a los contadores y vuelca las métricas.
+    """
+    inicio = time.perf_counter()
+    etapa, desde, anterior = None, inicio, None
+    resultado = "error"
+    try:
+        for chunk in eventos:
+            if isinstance(chunk, int):
+                ahora = time.perf_counter()
+                nueva = getattr(chunk, "etapa", None) or etapa
+                if nueva != etapa:
+                    if etapa is not None:
+                        registrar_etapa(funcion, etapa, ahora - desde, anterior)
+                    etapa, desde, anterior = nueva, ahora, None
+                previo = {k: getattr(anterior, k, None) for k in ("bytes", "hechos", "total")}
+                contadores = {k: getattr(chunk, k, None) for k in previo}
+                if all(v is None for v in contadores.values()):
+                    contadores = previo
+                chunk = anterior = Progreso(chunk, etapa, ahora - inicio, **contadores)
+            yield chunk
+        resultado = "ok"
+    except GeneratorExit:
+        resultado = "cancelada"
+        raise
+    finally:
+        if etapa is not None:
+            registrar_etapa(funcion, etapa, time.perf_counter() - desde, anterior)
+        _sumar_metrica("movilidad_exportaciones", 1, funcion=funcion, resultado=resultado)
+        volcar_metricas()
+
+
+# In[60]:
+
+
+# ── Caché de resultados direccionada por contenido (resultados/.cache) ──
+VERSION_RESULTADOS = 3         # subir cuando cambie cómo se dibujan los mapas
+CACHE_RESULTADOS_MAX = int(os.environ.get("MOVILIDAD_CACHE_MB", 2048)) * 2**20
+_PARAMS_SIN_EFECTO = ("open_browser", "workers")
+
+
+@lru_cache(maxsize=256)
+def _huella_entrada(ruta, mtime_ns, size):
+    return _sha256_fichero(ruta)
+
+
+def huella_entrada(path):
+    """
+    SHA-256 de un fichero de entrada, memoizado por (ruta, mtime, tamaño).
+    """
+    path = Path(path)
+    if not path.exists():
+        return None
+    st = path.stat()
+    return _huella_entrada(str(path.resolve()), st.st_mtime_ns, st.st_size)
+
+
+def clave_resultado(funcion, params, entradas):
+    """
+    Clave de un artefacto: función, parámetros y hash de cada fichero de entrada.
+    """
+    contenido = json.dumps(
+        {"v": VERSION_RESULTADOS, "f": funcion, "p": params, "t": TESELAS_CAPTURA,
+         "e": {Path(e).name: huella_entrada(e) for e in entradas}},
+        sort_keys=True, default=str)
+    return hashlib.sha256(contenido.encode("utf-8")).hexdigest()[:32]
+
+
+def _proceso_vivo(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, OSError):
+        return True
+    return True
+
+
+@contextmanager
+def _bloqueo_fichero(path, caducidad=2 * 3600):
+    """
+    Cerrojo entre procesos y hilos basado en crear 'path' en exclusiva.
+    Un cerrojo de un proceso muerto, o más viejo que 'caducidad', se descarta.
+    """
+    while True:
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                pid = int(path.read_text() or 0)
+                viejo = time.time() - path.stat().st_mtime > caducidad
+            except (OSError, ValueError):
+                time.sleep(0.1)
+                continue
+            if viejo or (pid and not _proceso_vivo(pid)):
+                path.unlink(missing_ok=True)
+                continue
+            time.sleep(0.5)
+    try:
+        os.write(fd, str(os.getpid()).encode())
+        yield
+    finally:
+        os.close(fd)
+        path.unlink(missing_ok=True)
+
+
+def _cache_resultados_dir():
+    d = RESULTADOS_DIR / ".cache"
+    d.mkdir(parents=True, exist_ok=True)
+    return d
+
+
+_salida = threading.local()
+
+
+def directorio_salida():
+    """
+    Carpeta donde los exportadores escriben su artefacto: RESULTADOS_DIR,
+    o la carpeta privada que les da resultado_cacheado mientras generan
+    (así dos llamadas con parámetros distintos pero el mismo nombre de
+    fichero no se pisan antes de guardarse en la caché y publicarse).
+    """
+    return getattr(_salida, "dir", None) or RESULTADOS_DIR
+
+
+def _generar_en(gen, directorio):
+    """
+    Recorre el generador 'gen' con directorio_salida() = 'directorio'.
+    Se fija sólo mientras avanza 'gen', así que otros generadores del
+    mismo hilo intercalados con él siguen viendo el suyo.
+    """
+    while True:
+        previo, _salida.dir = getattr(_salida, "dir", None), directorio
+        try:
+            chunk = next(gen)
+        except StopIteration:
+            return
+        finally:
+            _salida.dir = previo
+        yield chunk
+
+
+def _leer_entrada(clave):
+    entrada = _cache_resultados_dir() / clave
+    try:
+        info = json.loads((entrada / "entrada.json").read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None, None
+    return entrada, info
+
+
+def buscar_resultado(clave):
+    """
+    Ruta del artefacto guardado con 'clave' dentro de la caché o None.
+    Marca la entrada como usada.
+    """
+    entrada, info = _leer_entrada(clave)
+    if entrada is None:
+        return None
+    ruta = entrada / info["nombre"]
+    if not ruta.exists():
+        return None
+    os.utime(entrada / "entrada.json")            # último uso para el LRU
+    return ruta
+
+
+def publicar_resultado(clave):
+    """
+    Deja el artefacto de la entrada 'clave' (y sus adjuntos) en RESULTADOS_DIR
+    con su ruta de siempre (<nombre>.html, <nombre>/index.html…), enlazado
+    desde la caché de forma atómica. Devuelve esa ruta, o None si la entrada no está.
+    """
+    ruta = buscar_resultado(clave)
+    if ruta is None:
+        return None
+    entrada, info = _leer_entrada(clave)
+    relativa = Path(info.get("publicado", info["nombre"]))
+    destino = RESULTADOS_DIR / relativa
+    try:
+        if relativa.parent == Path("."):          # adjuntos primero, el artefacto al final
+            for f in entrada.iterdir():
+                if f.name not in ("entrada.json", ruta.name):
+                    _enlazar(f, RESULTADOS_DIR / f.name)
+            _enlazar(ruta, destino)
+        else:                                     # empaquetado "carpeta": se publica entera
+            carpeta = destino.parent
+            carpeta.parent.mkdir(parents=True, exist_ok=True)
+            tmp = _temporal_junto_a(carpeta)
+            tmp.mkdir()
+            try:
+                for f in entrada.iterdir():
+                    if f.name != "entrada.json":
+                        _enlazar(f, tmp / (relativa.name if f == ruta else f.name))
+                _reemplazar_carpeta(tmp, carpeta)
+            finally:
+                shutil.rmtree(tmp, ignore_errors=True)
+    except FileNotFoundError:                     # la entrada se expulsó mientras tanto
+        return None
+    return destino
+
+
+def guardar_resultado(clave, ruta, adjuntos=(), publicado=None):
+    """
+    Copia 'ruta' (y sus 'adjuntos', p. ej. el GIF que referencia un HTML)
+    a resultados/.cache/<clave>/ de forma atómica, lo publica en
+    RESULTADOS_DIR / 'publicado' (por defecto, con su nombre) y aplica
+    la expulsión LRU. Devuelve la ruta publicada.
+    """
+    cache = _cache_resultados_dir()
+    tmp = cache / f".tmp-{clave}-{os.getpid()}-{threading.get_ident()}"
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir()
+    for f in (ruta, *adjuntos):
+        _enlazar(f, tmp / Path(f).name)
+    publicado = Path(publicado or Path(ruta).name)
+    (tmp / "entrada.json").write_text(
+        json.dumps({"nombre": Path(ruta).name, "publicado": publicado.as_posix(),
+                    "creado": time.time()}), encoding="utf-8")
+    try:
+        os.replace(tmp, cache / clave)
+    except OSError:                               # otra sesión la guardó antes
+        shutil.rmtree(tmp, ignore_errors=True)
+    destino = publicar_resultado(clave)
+    podar_cache_resultados()
+    return destino or Path(ruta)
+
+
+_PROTECTORES = []
+
+
+def proteger_cache(funcion):
+    """
+    Registra 'funcion' (sin argumentos, devuelve claves de la caché) como
+    fuente de entradas que podar_cache_resultados no debe expulsar, p. ej.
+    las de los trabajos guardados. Se puede usar como decorador.
+    """
+    _PROTECTORES.append(funcion)
+    return funcion
+
+
+def clave_ultimo_resultado():
+    """
+    Clave de caché del último artefacto servido por un exportador en este hilo.
+    """
+    return getattr(_salida, "clave", None)
+
+
+def podar_cache_resultados(max_bytes=None):
+    """
+    Expulsa las entradas usadas hace más tiempo hasta que la caché
+    ocupe como mucho 'max_bytes' (por defecto MOVILIDAD_CACHE_MB).
+    Nunca expulsa las claves que devuelven los protectores (ver proteger_cache).
+    """
+    max_bytes = CACHE_RESULTADOS_MAX if max_bytes is None else max_bytes
+    protegidas = set()
+    for protector in _PROTECTORES:
+        try:
+            protegidas.update(protector())
+        except Exception:                         # sin saber qué se usa, no se expulsa nada
+            log.exception("No se pudieron leer las entradas protegidas de la caché")
+            return
+    cache = _cache_resultados_dir()
+    entradas = []
+    for d in cache.iterdir():
+        meta = d / "entrada.json"
+        if d.name.startswith(".") or d.name in protegidas or not meta.exists():
+            continue
+        try:
+            tam = sum(f.stat().st_size for f in d.iterdir())
+            entradas.append((meta.stat().st_mtime, tam, d))
+        except OSError:
+            continue
+    total = sum(t for _, t, _ in entradas)
+    for _, tam, d in sorted(entradas, key=lambda e: e[0]):
+        if total <= max_bytes:
+            break
+        basura = cache / f".borrar-{d.name}-{os.getpid()}"
+        try:
+            os.replace(d, basura)                 # desaparece de golpe para los lectores
+        except OSError:
+            continue
+        shutil.rmtree(basura, ignore_errors=True)
+        total -= tam
+
+
+def resultado_cacheado(entradas, adjuntos=None):
+    """
+    Decorador para los exportadores generadores (progreso int + ruta final).
+    La clave combina el nombre de la función, sus parámetros (salvo
+    open_browser y workers) y el hash de los ficheros de 'entradas(params)'.
+    Si el artefacto ya existe se devuelve al instante; si no, se genera
+    una sola vez aunque lo pidan varias sesiones a la vez (cerrojo por clave).
+    En ambos casos se publica en RESULTADOS_DIR (ver publicar_resultado) y
+    se devuelve esa ruta; la caché sólo sirve para encontrarlo.
+    'adjuntos(ruta, params)' lista ficheros extra que deben viajar con el artefacto.
+    El progreso sale como eventos Progreso (ver instrumentar).
+    """
+    def decorador(func):
+        firma = inspect.signature(func)
+
+        def servir(ba):
+            params = {k: v for k, v in ba.arguments.items() if k not in _PARAMS_SIN_EFECTO}
+            yield Progreso(0, etapa="caché")
+            clave = clave_resultado(func.__name__, params, entradas(params))
+
+            abrir = ba.arguments.get("open_browser")
+            ruta = publicar_resultado(clave)
+            if ruta is None:
+                with _bloqueo_fichero(_cache_resultados_dir() / f".{clave}.lock"):
+                    ruta = publicar_resultado(clave)  # quizá lo generó otra sesión
+                    if ruta is None:
+                        if abrir:                    # se abre la copia publicada
+                            ba.arguments["open_browser"] = False
+                        avance = 0
+                        with TemporaryDirectory(prefix=".generando-",
+                                                dir=_cache_resultados_dir()) as privado:
+                            for chunk in _generar_en(func(*ba.args, **ba.kwargs), Path(privado)):
+                                if isinstance(chunk, int):
+                                    avance = chunk
+                                    yield chunk
+                                else:
+                                    ruta = Path(chunk)
+                            yield Progreso(avance, etapa="guardado")
+                            extra = adjuntos(ruta, params) if adjuntos else ()
+                            try:
+                                publicado = ruta.relative_to(privado)
+                            except ValueError:
+                                publicado = ruta.name
+                            ruta = guardar_resultado(clave, ruta, extra, publicado)
+            _salida.clave = clave
+            if abrir:
+                webbrowser.open_new_tab(ruta.as_uri())
+            yield 100
+            yield ruta
+
+        @wraps(func)
+        def envoltura(*args, **kwargs):
+            ba = firma.bind(*args, **kwargs)
+            ba.apply_defaults()
+            yield from instrumentar(servir(ba), func.__name__)
+        return envoltura
+    return decorador
+
+
+def _georef_file():
+    return DATOS_DIR / "georef-spain-provincia.geojson"
+
+
+def _excel_ciudad(ciudad, mes):
+    return DATOS_DIR / f"{ciudad.lower()}-{int(mes):02}.xlsx"
+
+
+def _entradas_medida(params):
+    return [DATOS_DIR / "poblaciones_provincias.xlsx"] if params.get("medida") == "relativo" else []
+
+
+def _sufijo_medida(medida):
+    return "" if medida == "viajes" else f"_{medida}"
+
+
+# In[61]:
+
+
+# ── Teselas de fondo: online, sin mapa base o servidor local ──────
+# Valores admitidos para 'teselas':
+#   "OpenStreetMap" (u otro nombre de folium) → teselas online,
+#   "ninguna"                                  → sin mapa base (sólo coropletas),
+#   "http(s)://.../{z}/{x}/{y}.png"            → plantilla URL tal cual,
+#   ruta a carpeta {z}/{x}/{y}.png o .mbtiles  → servidor local en 127.0.0.1.
+# Las capturas PNG usan TESELAS_CAPTURA; los HTML que se descargan usan
+# siempre teselas online, porque el servidor local no es accesible fuera.
+TESELAS_CAPTURA = os.environ.get("MOVILIDAD_TESELAS_CAPTURA", "OpenStreetMap")
+TESELAS_ORIGEN  = os.environ.get("MOVILIDAD_TESELAS_ORIGEN",
+                                 "https://tile.openstreetmap.org/{z}/{x}/{y}.png")
+TESELAS_ATRIBUCION = "&copy; OpenStreetMap contributors"
+
+
+class _ManejadorTeselas(BaseHTTPRequestHandler):
+    """
+    Sirve /{z}/{x}/{y}.png desde una carpeta o un MBTiles. Con carpeta, una
+    tesela que falta se descarga de TESELAS_ORIGEN (si hay red) y se guarda.
+    """
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        try:
+            z, x, y = (int(p) for p in self.path.split("?")[0].strip("/").rsplit(".", 1)[0].split("/"))
+        except ValueError:
+            self.send_error(404)
+            return
+        datos = self.server.leer(z, x, y)
+        if datos is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(datos)))
+        self.send_header("Cache-Control", "max-age=86400")
+        self.end_headers()
+        self.wfile.write(datos)
+
+
+class ServidorTeselas(ThreadingHTTPServer):
+    """
+    Servidor HTTP local de teselas en un hilo de fondo (uno por origen y proceso).
+    """
+    daemon_threads = True
+
+    def __init__(self, origen, descargar=True):
+        super().__init__(("127.0.0.1", 0), _ManejadorTeselas)
+        self.origen = Path(origen)
+        self.descargar = descargar and self.origen.suffix != ".mbtiles"
+        self._local = threading.local()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/{{z}}/{{x}}/{{y}}.png"
+
+    def leer(self, z, x, y):
+        if self.origen.suffix == ".mbtiles":
+            if not hasattr(self._local, "con"):
+                self._local.con = sqlite3.connect(f"file:{self.origen}?mode=ro", uri=True)
+            fila = self._local.con.execute(
+                "SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?",
+                (z, x, (1 << z) - 1 - y)).fetchone()           # MBTiles usa filas TMS
+            return fila[0] if fila else None
+
+        tesela = self.origen / str(z) / str(x) / f"{y}.png"
+        if tesela.exists():
+            return tesela.read_bytes()
+        if not self.descargar:
+            return None
+        try:
+            req = urllib.request.Request(TESELAS_ORIGEN.format(z=z, x=x, y=y),
+                                         headers={"User-Agent": "movilidad-festividades"})
+            with urllib.request.urlopen(req, timeout=5) as r:
+                datos = r.read()
+        except OSError:
+            return None                                  # sin red: tesela vacía
+        tesela.parent.mkdir(parents=True, exist_ok=True)
+        _escribir_atomico(tesela, lambda tmp: tmp.write_bytes(datos))
+        return datos
+
+
+@lru_cache(maxsize=None)
+def servidor_teselas(origen):
+    """
+    Devuelve (arrancándolo una vez por proceso) el ServidorTeselas de 'origen'.
+    """
+    return ServidorTeselas(origen)
+
+
+def capa_base(teselas=None):
+    """
+    Traduce 'teselas' a los argumentos de folium.Map (tiles y attr).
+    """
+    teselas = "OpenStreetMap" if teselas is None else str(teselas)
+    if teselas.lower() in ("ninguna", "none", ""):
+        return {"tiles": None}
+    if teselas.startswith(("http://", "https://")):
+        return {"tiles": teselas, "attr": TESELAS_ATRIBUCION}
+    if teselas.endswith(".mbtiles") or os.sep in teselas or Path(teselas).is_dir():
+        return {"tiles": servidor_teselas(str(Path(teselas).resolve())).url,
+                "attr": TESELAS_ATRIBUCION}
+    return {"tiles": teselas}
+
+
+def teselas_captura():
+    """
+    'teselas' ya resuelto para las capturas PNG: si es local arranca el
+    servidor en este proceso y devuelve su URL, apta para los workers.
+    """
+    return capa_base(TESELAS_CAPTURA).get("tiles") or "ninguna"
+
+
 # In[79]:
 
 
@@ -188,9 +1630,6 @@ import pandas as pd
 import geopandas as gpd
 import folium
 from branca.element import Template, MacroElement
-from selenium import webdriver
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.chrome.options import Options
 import base64, json, time
 
 def graficaTransportesDia(
@@ -199,49 +1638,41 @@ def graficaTransportesDia(
         zoom: int = 6,
         dpi_scale: float = 1.0,
         legend_side: str = "left",
+        teselas: str = "OpenStreetMap",
+        medida: str = "viajes",
 ):
     """
     Genera un folium.Map.
     Progreso 0–100; al final devuelve el mapa.
     dpi_scale escala los textos al capturar PNG.
     legend_side "left" o "right" para mostrar leyenda, otro valor omite leyenda.
+    teselas: mapa base (ver capa_base); "ninguna" dibuja sólo las provincias.
+    medida: "viajes" o "relativo" (viajes por mil habitantes, ver MEDIDAS).
     """
     mes = int(mes)
     transporte_file = DATOS_DIR / f"{ciudad.lower()}-{mes:02}.xlsx"
-    georef_file     = DATOS_DIR / "georef-spain-provincia.geojson"
 
-    yield 0
-    if not georef_file.exists():
-        raise FileNotFoundError(georef_file)
+    yield Progreso(0, etapa="datos")
+    registro = cargar_provincias()
     if not transporte_file.exists():
         raise FileNotFoundError(transporte_file)
     yield 10
 
-    gdf_provincias = gpd.read_file(georef_file)
-    df_transporte  = pd.read_excel(transporte_file)
+    info = medida_mapa(medida)
+    cubo = cubo_medida(ciudad, mes, medida)
     yield 30
 
-    df_dia = df_transporte[df_transporte["dia"] == dia]
-    if df_dia.empty:
-        raise ValueError(f"No hay datos para el día {dia}")
-    df_agg = (
-        df_dia.groupby("provincia origen", as_index=False)["viajes"].sum()
-             .assign(prov_std=lambda d: d["provincia origen"]
-                                        .apply(standardize_province_name))
-    )
-    best_field = detectar_campo_provincia(gdf_provincias, df_agg)
-    if best_field is None:
-        raise RuntimeError("No se detectó campo provincia válido")
-    gdf_provincias["prov_std"] = gdf_provincias[best_field].apply(standardize_province_name)
-    gdf_merged = gdf_provincias.merge(df_agg[["prov_std","viajes"]], on="prov_std", how="left")
-    gdf_merged["viajes"] = gdf_merged["viajes"].fillna(0)
-    yield 50
-
-    max_viajes = gdf_merged["viajes"].max()
-    centro = gdf_merged.to_crs("EPSG:3857").geometry.centroid.unary_union.centroid
-    ctr_ll = gpd.GeoSeries([centro], crs="EPSG:3857")\
-                 .to_crs("EPSG:4326").iloc[0]
-    mapa = folium.Map(location=[ctr_ll.y, ctr_ll.x], zoom_start=zoom)
+    viajes_dia = cubo.serie_dia(dia)
+    best_field = registro.campo
+    props = pd.DataFrame({best_field: registro.gdf[best_field], "prov_std": registro.prov_std,
+                          "viajes": registro.prov_std.map(viajes_dia).fillna(0)})
+    yield Progreso(50, etapa="mapa")
+
+    props["fill"] = marcar_destino(
+        info.colores(props["viajes"].to_numpy(), sensibilidad_color), props["prov_std"], ciudad)
+    if medida != "viajes":
+        props["viajes"] = props["viajes"].round(4)
+    mapa = folium.Map(location=list(registro.centro), zoom_start=zoom, **capa_base(teselas))
     yield 60
 
     # Overlay superior
@@ -271,22 +1702,12 @@ def graficaTransportesDia(
     mapa.get_root().add_child(sup)
     yield 70
 
-    # GeoJSON
-    estudio_std = standardize_province_name(ciudad)
-    def style_function(feat):
-        prov = standardize_province_name(feat["properties"].get(best_field, ""))
-        if prov == estudio_std:
-            fill = "#66f26a"
-        else:
-            fill = get_fill_color(feat["properties"].get("viajes",0),
-                                  max_viajes, sensibilidad_color)
-        return {"fillColor": fill, "color":"blue", "weight":1, "fillOpacity":1}
-    folium.GeoJson(
-        gdf_merged,
-        style_function=style_function,
+    # GeoJSON (el color de cada provincia ya viene en la propiedad "fill")
+    CapaProvincias(
+        registro, zoom, props,
         tooltip=folium.features.GeoJsonTooltip(
             fields=[best_field, "viajes"],
-            aliases=["Provincia", "Viajes"]
+            aliases=["Provincia", info.etiqueta]
         )
     ).add_to(mapa)
     yield 90
@@ -311,9 +1732,9 @@ def graficaTransportesDia(
             z-index:9999;
         ">
           <b>🗺️ Leyenda</b><br><br>
-          <i style="background:#336699;width:12px;height:12px;display:inline-block;margin-right:5px;"></i>
-            <b>Azul</b>: Provincias de origen<br>
-          &nbsp;&nbsp;Más oscuro → más desplazamientos<br>
+          <i style="background:{info.muestra};width:12px;height:12px;display:inline-block;margin-right:5px;"></i>
+            <b>{info.nombre_color}</b>: {info.origen}<br>
+          &nbsp;&nbsp;{info.intensidad}<br>
           <i style="background:#66f26a;width:12px;height:12px;display:inline-block;margin-right:5px;"></i>
             <b>Verde</b>: Provincia destino<br>
         </div>
@@ -324,51 +1745,349 @@ def graficaTransportesDia(
     yield mapa
 
 
+# In[95]:
+
+
+# ── Almacén de días: HTML/PNG de cada día por su huella ──────────
+# La huella de un día combina los valores de ese día (ya alineados con las
+# provincias del GeoJSON), los parámetros de dibujo y la versión de los
+# mapas. Si en un Excel corregido sólo cambian unos días, al reexportar el
+# mes se reutiliza lo ya dibujado y sólo se renderizan/capturan esos días.
+ALMACEN_DIAS_MAX = int(os.environ.get("MOVILIDAD_CACHE_DIAS_MB", 1024)) * 2**20
+
+
+def _almacen_dias_dir():
+    d = RESULTADOS_DIR / ".cache" / "dias"
+    d.mkdir(parents=True, exist_ok=True)
+    return d
+
+
+def huellas_dias(tipo, lista_kwargs):
+    """
+    Huellas de los mapas de varios días, en el mismo orden: 'tipo' (qué se
+    guarda: HTML, PNG…) y los kwargs de graficaTransportesDia de cada día
+    (más los del tipo, p. ej. ancho/alto). Los kwargs omitidos cuentan con
+    su valor por defecto. La ciudad entra tal cual, porque el mapa la
+    muestra como se pasó. Cada cubo se alinea con el GeoJSON una sola vez.
+    """
+    defectos = {k: p.default for k, p in inspect.signature(graficaTransportesDia).parameters.items()
+                if p.default is not inspect.Parameter.empty}
+    prov_std = cargar_provincias().prov_std
+    georef = huella_entrada(_georef_file())
+    alineados = {}
+    huellas = []
+    for kwargs in lista_kwargs:
+        params = dict(defectos)
+        params.update(kwargs, dia=int(kwargs["dia"]), mes=int(kwargs["mes"]))
+        clave = (params["ciudad"].lower(), params["mes"], params["medida"])
+        if clave not in alineados:
+            cubo = cubo_medida(*clave)
+            alineados[clave] = (cubo, np.ascontiguousarray(cubo.alinear(prov_std), dtype=float))
+        cubo, matriz = alineados[clave]
+
+        h = hashlib.sha256()
+        h.update(json.dumps([VERSION_RESULTADOS, tipo, params, TESELAS_CAPTURA, georef],
+                            sort_keys=True, default=str).encode())
+        h.update(matriz[cubo.fila(params["dia"])].tobytes())
+        huellas.append(h.hexdigest())
+    return huellas
+
+
+def huella_dia(tipo, kwargs):
+    """
+    Huella del mapa de un día (ver huellas_dias).
+    """
+    return huellas_dias(tipo, [kwargs])[0]
+
+
+def leer_dia(huella):
+    """
+    HTML (str) o PNG (bytes) guardado con 'huella', o None. Marca el uso para el LRU.
+    """
+    for sufijo in (".html", ".png"):
+        ruta = _almacen_dias_dir() / f"{huella}{sufijo}"
+        try:
+            datos = ruta.read_bytes()
+        except OSError:
+            continue
+        os.utime(ruta)
+        return datos.decode("utf-8") if sufijo == ".html" else datos
+    return None
+
+
+def guardar_dia(huella, resultado):
+    """
+    Guarda el HTML (str) o PNG (bytes) de un día de forma atómica.
+    """
+    if isinstance(resultado, str):
+        ruta, datos = _almacen_dias_dir() / f"{huella}.html", resultado.encode("utf-8")
+    else:
+        ruta, datos = _almacen_dias_dir() / f"{huella}.png", resultado
+    _escribir_atomico(ruta, lambda tmp: tmp.write_bytes(datos))
+
+
+def podar_almacen_dias(max_bytes=None):
+    """
+    Borra los días usados hace más tiempo hasta que el almacén ocupe
+    como mucho 'max_bytes' (por defecto MOVILIDAD_CACHE_DIAS_MB).
+    """
+    max_bytes = ALMACEN_DIAS_MAX if max_bytes is None else max_bytes
+    ficheros = []
+    for f in _almacen_dias_dir().iterdir():
+        try:
+            st = f.stat()
+        except OSError:
+            continue
+        ficheros.append((st.st_mtime, st.st_size, f))
+    total = sum(t for _, t, _ in ficheros)
+    for _, tam, f in sorted(ficheros, key=lambda e: e[0]):
+        if total <= max_bytes:
+            break
+        f.unlink(missing_ok=True)
+        total -= tam
+
+
+# In[96]:
+
+
+# ── Render de días en paralelo (pool de procesos) ────────────────
+WORKERS_RENDER = int(os.environ.get("MOVILIDAD_WORKERS", 1))
+
+
+def _iniciar_worker(datos_dir):
+    """
+    Inicializador de cada proceso del pool: hereda la carpeta de datos del padre.
+    """
+    global DATOS_DIR
+    DATOS_DIR = Path(datos_dir)
+
+
+def _html_mapa(kwargs):
+    """
+    Ejecuta graficaTransportesDia(**kwargs) y devuelve el HTML del mapa.
+    Es una función de módulo para poder enviarla a otro proceso.
+    """
+    mapa = next(ch for ch in graficaTransportesDia(**kwargs) if not isinstance(ch, int))
+    return mapa.get_root().render()
+
+
+_POOLS_RENDER = {}
+_POOLS_RENDER_LOCK = threading.Lock()
+
+
+def obtener_pool_render(workers):
+    """
+    Devuelve (creándolo la primera vez) el pool de procesos del proceso para
+    'workers' procesos y la carpeta de datos actual. Se reutiliza entre
+    exportaciones, así que los procesos se arrancan una sola vez (con spawn,
+    en Windows y macOS, cada uno importa este módulo) y conservan sus
+    cachés (provincias, cubos) de una exportación a la siguiente.
+    """
+    with _POOLS_RENDER_LOCK:
+        clave = (workers, str(DATOS_DIR))
+        if clave not in _POOLS_RENDER:
+            _POOLS_RENDER[clave] = ProcessPoolExecutor(
+                max_workers=workers, initializer=_iniciar_worker, initargs=(str(DATOS_DIR),))
+        return _POOLS_RENDER[clave]
+
+
+@atexit.register
+def cerrar_pools_render():
+    with _POOLS_RENDER_LOCK:
+        for pool in _POOLS_RENDER.values():
+            pool.shutdown(wait=False, cancel_futures=True)
+        _POOLS_RENDER.clear()
+
+
+def _renderizar(kwargs_lista, workers, funcion):
+    workers = min(int(workers or WORKERS_RENDER), len(kwargs_lista))
+    if workers <= 1:
+        yield from map(funcion, kwargs_lista)
+        return
+    pool = obtener_pool_render(workers)
+    try:
+        yield from pool.map(funcion, kwargs_lista)
+    except BrokenProcessPool:
+        with _POOLS_RENDER_LOCK:             # un proceso murió: la próxima vez, pool nuevo
+            if _POOLS_RENDER.get((workers, str(DATOS_DIR))) is pool:
+                del _POOLS_RENDER[(workers, str(DATOS_DIR))]
+        raise
+
+
+def renderizar_dias(trabajos, workers=None, funcion=_html_mapa, reutilizar=True):
+    """
+    Renderiza a HTML los mapas descritos en 'trabajos', lista de
+    (clave, kwargs de graficaTransportesDia). Devuelve un iterador de
+    (clave, html) en el mismo orden que 'trabajos'.
+    Con workers > 1 los días se renderizan a la vez en un pool de procesos
+    (por defecto MOVILIDAD_WORKERS, 1 = en serie en este proceso).
+    'funcion' permite otro renderizador de módulo (p. ej. _png_mapa).
+    Con 'reutilizar' los días sin cambios salen del almacén de días
+    (huellas_dias) y sólo se renderizan los que faltan.
+    """
+    trabajos = list(trabajos)
+    huellas = (huellas_dias(funcion.__name__, [kw for _, kw in trabajos]) if reutilizar
+               else [None] * len(trabajos))
+    guardados = [leer_dia(h) if h else None for h in huellas]
+    nuevos = _renderizar([kw for (_, kw), g in zip(trabajos, guardados) if g is None],
+                         workers, funcion)
+    for (clave, _), huella, resultado in zip(trabajos, huellas, guardados):
+        if resultado is None:
+            resultado = next(nuevos)
+            if huella:
+                guardar_dia(huella, resultado)
+        yield clave, resultado
+    if reutilizar:
+        podar_almacen_dias()
+
+
 # In[97]:
 
 
-def exportar_mapa_interactivo_mes(ciudad, mes, sensibilidad_color=3):
+def _capa_geojson(mapa):
+    """
+    Devuelve la capa folium.GeoJson de provincias añadida por graficaTransportesDia.
+    """
+    for hijo in mapa._children.values():
+        if isinstance(hijo, folium.GeoJson):
+            return hijo
+    raise RuntimeError("El mapa no contiene capa GeoJson")
+
+
+def _valores_json(matriz):
+    """
+    Lista de listas para JSON; enteros si todos los valores lo son.
+    """
+    matriz = np.asarray(matriz)
+    if np.all(np.mod(matriz, 1) == 0):
+        return matriz.astype(np.int64).tolist()
+    return np.round(matriz, 4).tolist()
+
+
+def _exportar_mes_ligero(ciudad, mes, sensibilidad_color, zoom, output_html, medida="viajes",
+                        compresion=None):
+    """
+    Modo "ligero" de exportar_mapa_interactivo_mes: un único mapa Leaflet con
+    una sola copia de la geometría y una matriz compacta día × provincia.
+    El slider cambia el estilo (y el tooltip) de la capa sin recargar nada.
+    """
+    yield Progreso(0, etapa="datos")
+    cubo = cubo_medida(ciudad, mes, medida)
+    dias = cubo.dias.tolist()
+    if not dias:
+        raise ValueError("No hay días disponibles en el archivo")
+    yield Progreso(5, etapa="colores")
+
+    # ---------- valores y colores de todo el mes ----------
+    registro = cargar_provincias()
+    provs = pd.unique(registro.prov_std.to_numpy())
+    valores = cubo.alinear(provs)
+    colores = marcar_destino(medida_mapa(medida).colores(valores, sensibilidad_color), provs, ciudad)
+    paleta, codigos = np.unique(colores, return_inverse=True)
+    datos = {
+        "dias": dias,
+        "provs": provs.tolist(),
+        "paleta": paleta.tolist(),
+        "color": codigos.reshape(colores.shape).tolist(),
+        "viajes": _valores_json(valores),
+    }
+    yield Progreso(30, etapa="mapa")
+
+    # ---------- un solo mapa (el del primer día) ----------
+    mapa = None
+    for chunk in graficaTransportesDia(ciudad, dias[0], mes, sensibilidad_color, zoom=zoom,
+                                       medida=medida):
+        if not isinstance(chunk, int):
+            mapa = chunk
+    yield Progreso(70, etapa="ensamblado")
+
+    tpl = """
+    {% macro html(this, kwargs) %}
+    <div id="ctl" style="position:fixed;top:70px;right:20px;background:#fff;padding:10px;
+                border:2px solid grey;border-radius:8px;z-index:9999">
+      Día: <input type="range" id="slider" min="0" max="{{ this.n - 1 }}" value="0"
+                  oninput="chg(this.value)">
+      <span id="lbl"></span>
+    </div>
+    {% endmacro %}
+    {% macro script(this, kwargs) %}
+    (function(){
+      var capa = {{ this.capa }}, datos = {{ this.datos }}, col = {};
+      datos.provs.forEach(function(p, j){ col[p] = j; });
+      window.chg = function(k){
+        k = +k;
+        document.getElementById('lbl').textContent = datos.dias[k];
+        capa.eachLayer(function(l){
+          var p = l.feature.properties, j = col[p.prov_std];
+          if (j === undefined) return;
+          p.viajes = datos.viajes[k][j];
+          l.setStyle({fillColor: datos.paleta[datos.color[k][j]]});
+        });
+      };
+      chg(0);
+    })();
+    {% endmacro %}
+    """
+    ctl = MacroElement()
+    ctl._template = Template(tpl)
+    ctl.n = len(dias)
+    ctl.capa = _capa_geojson(mapa).get_name()
+    ctl.datos = json.dumps(datos, separators=(",", ":"))
+    mapa.add_child(ctl)
+    yield Progreso(90, etapa="escritura")
+
+    with escribir_por_partes(output_html, compresion) as f:
+        f.write(mapa.get_root().render())
+    yield Progreso(95, bytes=output_html.stat().st_size)
+    yield output_html
+
+
+@resultado_cacheado(lambda p: [_excel_ciudad(p["ciudad"], p["mes"]), _georef_file(),
+                                *_entradas_medida(p)])
+def exportar_mapa_interactivo_mes(ciudad, mes, sensibilidad_color=3, modo="iframes", zoom=6,
+                                  workers=None, medida="viajes", compresion=None):
     """
     Devuelve un único HTML con un slider para navegar por los días del mes.
     Progreso: 0-100; al final, ruta del HTML combinando todos los mapas.
 
+    modo="iframes": un mapa Folium completo por día (versión original, pesada).
+    modo="ligero":  un único mapa con la geometría una vez y los valores diarios
+                    en una matriz; el slider sólo recolorea la capa.
+    workers: procesos para renderizar los días a la vez (ver renderizar_dias).
+    medida: "viajes" o "relativo" (viajes por mil habitantes de todo el mes).
+    compresion: None o una clave de COMPRESIONES ("gzip" → .html.gz, "br" → .html.br,
+                "autodescomprimible" → .html que se descomprime al abrirlo).
+
     La nueva versión usa graficaTransportesDia() sin open_browser
-    y sin escribir mapas temporales en disco.
+    y sin escribir mapas temporales en disco. En modo "iframes" cada día
+    se escribe en el fichero en cuanto se renderiza (ver escribir_por_partes),
+    así la memoria no crece con el número de días.
     """
     transporte_file = DATOS_DIR / f"{ciudad.lower()}-{int(mes):02}.xlsx"
-    output_html     = RESULTADOS_DIR / f"interactivo_{ciudad}_{int(mes):02}.html"
+    output_html     = ruta_salida(directorio_salida() / f"interactivo_{ciudad}_{int(mes):02}"
+                                                      f"{_sufijo_medida(medida)}.html", compresion)
 
     if not transporte_file.exists():
         raise FileNotFoundError(f"No se encontró {transporte_file}")
+    if modo == "ligero":
+        yield from _exportar_mes_ligero(ciudad, mes, sensibilidad_color, zoom, output_html, medida,
+                                        compresion)
+        return
+    if modo != "iframes":
+        raise ValueError(f"Modo desconocido: {modo}")
 
     # ---------- leer días disponibles ----------
-    df = pd.read_excel(transporte_file)
-    dias = sorted(df["dia"].dropna().unique())
+    yield Progreso(0, etapa="datos")
+    dias = cubo_transporte(ciudad, mes).dias.tolist()
     if not dias:
         raise ValueError("No hay días disponibles en el archivo")
 
     total = len(dias)
-    yield 0      # inicio
-    yield 5      # días leídos
+    yield Progreso(5, etapa="render", hechos=0, total=total)
 
-    # ---------- generar mapas y recoger HTML ----------
-    mapas_html = {}
-    for idx, dia in enumerate(dias, start=1):
-        # consumir el generador hasta obtener el mapa final
-        gen = graficaTransportesDia(ciudad, dia, mes, sensibilidad_color, zoom=6)
-        mapa = None
-        for chunk in gen:
-            if not isinstance(chunk, int):
-                mapa = chunk
-
-        # renderizar el folium.Map a string HTML
-        mapas_html[dia] = mapa.get_root().render()
-
-        yield 5 + int(idx / total * 85)   # progreso 5-90 %
-
-    # ---------- ensamblar HTML con slider ----------
+    # ---------- cabecera con el slider ----------
     min_d, max_d = dias[0], dias[-1]
-    html_out = [f"""<!DOCTYPE html>
+    cabecera = f"""<!DOCTYPE html>
 <html lang="es"><head>
 <meta charset="utf-8"/>
 <title>Interactivo {ciudad} {mes}</title>
@@ -382,14 +2101,27 @@ def exportar_mapa_interactivo_mes(ciudad, mes, sensibilidad_color=3):
               value="{min_d}" oninput="chg(this.value)">
   <span id="lbl">{min_d}</span>
 </div>
-"""]
-
-    for dia, html in mapas_html.items():
-        esc = html.replace('"', "&quot;")
-        html_out.append(f'<iframe id="d{dia}" class="map" srcdoc="{esc}"></iframe>')
-
-    # script para el slider
-    html_out.append(f"""
+"""
+
+    # ---------- generar mapas y escribir cada iframe al llegar ----------
+    producidos = 0
+    trabajos = [(dia, dict(ciudad=ciudad, dia=dia, mes=mes,
+                           sensibilidad_color=sensibilidad_color, zoom=zoom, medida=medida))
+                for dia in dias]
+    with escribir_por_partes(output_html, compresion) as f:
+        f.write(cabecera)
+        for idx, (dia, html) in enumerate(renderizar_dias(trabajos, workers), start=1):
+            # folium.Map ya renderizado a string HTML (en orden de días)
+            esc = html.replace('"', "&quot;")
+            f.write(f'<iframe id="d{dia}" class="map" srcdoc="{esc}"></iframe>')
+            producidos += len(html)
+
+            yield Progreso(5 + int(idx / total * 85), etapa="render",   # progreso 5-90 %
+                           bytes=producidos, hechos=idx, total=total)
+        yield Progreso(90, etapa="ensamblado")
+
+        # script para el slider
+        f.write(f"""
 <script>
 function chg(v) {{
   document.getElementById('lbl').textContent=v;
@@ -399,42 +2131,718 @@ function chg(v) {{
 chg({min_d});
 </script>
 </body></html>""")
-
-    output_html.write_text("".join(html_out), encoding="utf-8")
-    yield 95  # ensamblado listo
+    yield Progreso(95, bytes=output_html.stat().st_size)  # ensamblado listo
 
     # devolver ruta y 100 %
     yield output_html
 
 
+# In[99]:
+
+
+# ── Pool de Chrome headless reutilizable entre exportaciones ─────
+@lru_cache(maxsize=None)
+def _selenium():
+    """
+    Selenium se importa la primera vez que hace falta un navegador.
+    """
+    from selenium import webdriver
+    from selenium.common.exceptions import WebDriverException
+    from selenium.webdriver.chrome.options import Options
+    from selenium.webdriver.chrome.service import Service
+    return SimpleNamespace(webdriver=webdriver, WebDriverException=WebDriverException,
+                           Options=Options, Service=Service)
+
+
+CHROMEDRIVER_PATH = "/usr/bin/chromedriver"
+MAX_NAVEGADORES   = int(os.environ.get("MOVILIDAD_NAVEGADORES", min(4, os.cpu_count() or 1)))
+ESPERA_MAX_CAPTURA = float(os.environ.get("MOVILIDAD_ESPERA_MAX", 10))   # s, red de seguridad
+# Tope de Chrome vivos entre todos los pools (cada tamaño de ventana tiene
+# el suyo) y segundos que uno puede quedarse libre antes de cerrarlo.
+MAX_NAVEGADORES_TOTAL = int(os.environ.get("MOVILIDAD_NAVEGADORES_TOTAL", 2 * MAX_NAVEGADORES))
+NAVEGADOR_OCIOSO = float(os.environ.get("MOVILIDAD_NAVEGADOR_OCIOSO", 300))
+
+# Espera a que la página esté lista para la captura: documento cargado,
+# fuentes listas, todas las teselas Leaflet cargadas y la red en reposo
+# (sin recursos nuevos durante 'quieto' ms). Devuelve {listo, ms}.
+_JS_ESPERAR_LISTO = """
+var limite = arguments[0] * 1000, quieto = arguments[1], done = arguments[arguments.length - 1];
+var t0 = performance.now(), nRec = -1, tRec = t0;
+function teselasListas() {
+  if (window.L && L.GridLayer) {
+    for (var k in window) {
+      var o = window[k];
+      if (o instanceof L.GridLayer && o._map && o._noTilesToLoad && !o._noTilesToLoad()) return false;
+    }
+  }
+  var imgs = document.querySelectorAll('img.leaflet-tile');
+  for (var i = 0; i < imgs.length; i++) { if (!imgs[i].complete) return false; }
+  return true;
+}
+function redQuieta(ahora) {
+  var n = performance.getEntriesByType('resource').length;
+  if (n !== nRec) { nRec = n; tRec = ahora; }
+  return ahora - tRec >= quieto;
+}
+function fin(listo) {
+  requestAnimationFrame(function () { requestAnimationFrame(function () {
+    done({listo: listo, ms: performance.now() - t0});
+  }); });
+}
+var fuentes = false;
+(document.fonts ? document.fonts.ready : Promise.resolve()).then(function () { fuentes = true; });
+(function sondear() {
+  var ahora = performance.now();
+  var listo = document.readyState === 'complete' && fuentes && teselasListas();
+  if (redQuieta(ahora) && listo) return fin(true);
+  if (ahora - t0 > limite) return fin(false);
+  setTimeout(sondear, 50);
+})();
+"""
+
+
+def esperar_pagina_lista(driver, espera_max=ESPERA_MAX_CAPTURA, quieto_ms=250):
+    """
+    Bloquea hasta que la página cargada en 'driver' esté lista para capturarla
+    (teselas, fuentes y red en reposo) o hasta 'espera_max' segundos.
+    Devuelve (listo, segundos_esperados).
+    """
+    driver.set_script_timeout(espera_max + 5)
+    t0 = time.perf_counter()
+    try:
+        res = driver.execute_async_script(_JS_ESPERAR_LISTO, espera_max, quieto_ms)
+        listo = bool(res and res.get("listo"))
+    except _selenium().WebDriverException:
+        listo = False
+    return listo, time.perf_counter() - t0
+
+
+_NAVEGADORES = threading.Condition()   # protege los libres de todos los pools y el recuento
+_navegadores_vivos = 0
+
+
+def _retirar_libres(caducidad=NAVEGADOR_OCIOSO, uno=False):
+    """
+    Saca de los pools los navegadores libres desde hace más de 'caducidad'
+    segundos (o, con 'uno', el libre más antiguo de todos) y los descuenta.
+    Hay que llamarla con _NAVEGADORES tomado; el llamante los cierra.
+    """
+    global _navegadores_vivos
+    pools = [p for p in list(_POOLS.values()) if p._libres]
+    if uno:
+        retirados = [min(pools, key=lambda p: p._libres[0][0])._libres.pop(0)[1]] if pools else []
+    else:
+        limite, retirados = time.monotonic() - caducidad, []
+        for pool in pools:
+            while pool._libres and pool._libres[0][0] < limite:
+                retirados.append(pool._libres.pop(0)[1])
+    _navegadores_vivos -= len(retirados)
+    return retirados
+
+
+class PoolNavegadores:
+    """
+    Conjunto de Chrome headless ya arrancados para un tamaño de ventana
+    (ancho × alto CSS px) y una escala de dispositivo concretos.
+    Se comparte entre exportaciones y sesiones de Streamlit del mismo proceso:
+    cada captura toma un navegador libre (o arranca uno, hasta 'maximo')
+    y lo devuelve al terminar. Si algo falla mientras se usa, el driver se
+    cierra en vez de devolverlo. Entre todos los pools hay como mucho
+    MAX_NAVEGADORES_TOTAL vivos: si no cabe otro se cierra el libre más
+    antiguo de cualquier pool, y los libres más de NAVEGADOR_OCIOSO s se cierran.
+    """
+
+    def __init__(self, ancho, alto, escala, maximo=MAX_NAVEGADORES):
+        self.ancho, self.alto, self.escala = ancho, alto, escala
+        self.maximo = max(1, int(maximo))
+        self._libres = []                    # (instante en que quedó libre, driver)
+        self._turnos = threading.BoundedSemaphore(self.maximo)
+        self._tmp = TemporaryDirectory(prefix="movilidad_capturas_")
+
+    def _nuevo_driver(self):
+        se = _selenium()
+        opts = se.Options()
+        opts.add_argument("--headless=new")
+        opts.add_argument("--no-sandbox")
+        opts.add_argument("--disable-dev-shm-usage")
+        opts.add_argument(f"--window-size={self.ancho},{self.alto}")
+        opts.add_argument(f"--force-device-scale-factor={self.escala}")
+        return se.webdriver.Chrome(service=se.Service(CHROMEDRIVER_PATH), options=opts)
+
+    @staticmethod
+    def _cerrar_driver(driver):
+        try:
+            driver.quit()
+        except Exception:
+            pass
+
+    def _tomar(self):
+        """
+        Un driver libre de este pool o uno nuevo si cabe en MAX_NAVEGADORES_TOTAL
+        (cerrando libres de otros pools o esperando a que se libere alguno).
+        """
+        global _navegadores_vivos
+        cerrar = []
+        try:
+            with _NAVEGADORES:
+                cerrar += _retirar_libres()
+                while not self._libres and _navegadores_vivos >= MAX_NAVEGADORES_TOTAL:
+                    viejo = _retirar_libres(uno=True)
+                    if viejo:
+                        cerrar += viejo
+                    else:
+                        _NAVEGADORES.wait()
+                if self._libres:
+                    return self._libres.pop()[1]
+                _navegadores_vivos += 1
+        finally:
+            for driver in cerrar:
+                self._cerrar_driver(driver)
+        try:
+            return self._nuevo_driver()
+        except BaseException:
+            self._descartar(None)
+            raise
+
+    def _descartar(self, driver):
+        global _navegadores_vivos
+        if driver is not None:
+            self._cerrar_driver(driver)
+        with _NAVEGADORES:
+            _navegadores_vivos -= 1
+            _NAVEGADORES.notify_all()
+
+    @contextmanager
+    def navegador(self):
+        """
+        Presta un driver del pool. Vuelve al pool sólo si el bloque termina
+        sin error; con cualquier excepción se cierra.
+        """
+        with self._turnos:
+            driver, bien = self._tomar(), False
+            try:
+                yield driver
+                bien = True
+            finally:
+                if bien:
+                    with _NAVEGADORES:
+                        self._libres.append((time.monotonic(), driver))
+                        _NAVEGADORES.notify_all()
+                else:
+                    self._descartar(driver)
+
+    def capturar(self, html, espera_max=ESPERA_MAX_CAPTURA, intentos=3):
+        """
+        Carga 'html' (texto de la página), espera a que esté lista y devuelve
+        (png_bytes, listo, segundos_esperados). 'listo' es False si se agotó
+        'espera_max'. Si el navegador se ha caído se reintenta con uno nuevo.
+        """
+        tmp_html = Path(self._tmp.name) / f"{threading.get_ident()}_{time.monotonic_ns()}.html"
+        tmp_html.write_text(html, encoding="utf-8")
+        try:
+            for intento in range(intentos):
+                try:
+                    with self.navegador() as driver:
+                        driver.get(tmp_html.as_uri())
+                        listo, espera = esperar_pagina_lista(driver, espera_max)
+                        return driver.get_screenshot_as_png(), listo, espera
+                except _selenium().WebDriverException:
+                    if intento == intentos - 1:
+                        raise
+        finally:
+            tmp_html.unlink(missing_ok=True)
+
+    def cerrar(self):
+        global _navegadores_vivos
+        with _NAVEGADORES:
+            libres, self._libres = self._libres, []
+            _navegadores_vivos -= len(libres)
+            _NAVEGADORES.notify_all()
+        for _, driver in libres:
+            self._cerrar_driver(driver)
+        self._tmp.cleanup()
+
+
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+
+def obtener_pool(ancho, alto, escala):
+    """
+    Devuelve (creándolo la primera vez) el PoolNavegadores del proceso
+    para esa configuración de ventana.
+    """
+    with _POOLS_LOCK:
+        clave = (ancho, alto, escala)
+        if clave not in _POOLS:
+            _POOLS[clave] = PoolNavegadores(ancho, alto, escala)
+        return _POOLS[clave]
+
+
+@atexit.register
+def cerrar_pools():
+    with _POOLS_LOCK:
+        for pool in _POOLS.values():
+            pool.cerrar()
+        _POOLS.clear()
+
+
+def resumen_esperas(esperas, agotadas=0):
+    """
+    Resume la latencia de espera por captura (segundos) para ajustar ESPERA_MAX_CAPTURA.
+    """
+    if not esperas:
+        return {"capturas": 0}
+    e = np.sort(np.asarray(esperas, dtype=float))
+    return {
+        "capturas": len(e),
+        "agotadas": int(agotadas),
+        "media_s": round(float(e.mean()), 3),
+        "p50_s": round(float(np.percentile(e, 50)), 3),
+        "p95_s": round(float(np.percentile(e, 95)), 3),
+        "max_s": round(float(e[-1]), 3),
+    }
+
+
+def capturar_en_paralelo(pool, paginas, espera_max=ESPERA_MAX_CAPTURA, progreso=(0, 100),
+                         al_capturar=None, agotadas_claves=None, total=None):
+    """
+    Captura en paralelo las páginas de 'paginas' (iterable de (clave, html)).
+    Las páginas se piden a 'paginas' según hay hueco: como mucho dos por
+    navegador del pool esperando o en captura, así el render del siguiente
+    día se solapa con las capturas en curso y el progreso avanza desde la
+    primera captura. Cada captura espera a que la página esté lista (máximo
+    'espera_max' s), no un tiempo fijo. 'total' es el número de páginas
+    (por defecto len(paginas), si lo tiene).
+    Emite progreso entre progreso[0] y progreso[1] y al final un dict {clave: png}.
+    La latencia de espera por frame se registra en el log (resumen_esperas).
+    Si se pasa 'al_capturar(clave, png)' cada PNG se entrega en cuanto llega
+    y no se acumula (el dict final queda vacío).
+    Si se pasa la lista 'agotadas_claves' se añaden (antes de entregar el PNG)
+    las claves cuya captura agotó la espera sin que la página estuviera lista.
+    """
+    ini, fin = progreso
+    if total is None and hasattr(paginas, "__len__"):
+        total = len(paginas)
+    pngs, esperas, agotadas, producidos, hechos = {}, [], 0, 0, 0
+    yield Progreso(ini, etapa="captura", hechos=0, total=total)
+    paginas, futuros = iter(paginas), {}
+    with ThreadPoolExecutor(max_workers=pool.maximo) as ex:
+        while True:
+            for clave, html in paginas:
+                futuros[ex.submit(pool.capturar, html, espera_max)] = clave
+                if len(futuros) >= 2 * pool.maximo:
+                    break
+            if not futuros:
+                break
+            listos, _ = wait(futuros, return_when=FIRST_COMPLETED)
+            for fut in listos:
+                clave = futuros.pop(fut)
+                png, listo, espera = fut.result()
+                if not listo and agotadas_claves is not None:
+                    agotadas_claves.append(clave)
+                if al_capturar:
+                    al_capturar(clave, png)
+                else:
+                    pngs[clave] = png
+                esperas.append(espera)
+                agotadas += not listo
+                producidos += len(png)
+                hechos += 1
+                avance = hechos / total if total else 0
+                yield Progreso(ini + int(avance * (fin - ini)), etapa="captura",
+                               bytes=producidos, hechos=hechos, total=total)
+    log.info("Espera por captura (%dx%d): %s", pool.ancho, pool.alto,
+             resumen_esperas(esperas, agotadas))
+    yield pngs
+
+
+# In[100]:
+
+
+# ── Rasterizado sin navegador (matplotlib/Agg) ───────────────────
+# matplotlib se importa dentro de las funciones: sólo lo paga quien rasteriza.
+MOTORES_CAPTURA = ("navegador", "matplotlib")
+_M_POR_PX_Z0 = 156543.03392804097          # metros por px CSS a zoom 0 (Web Mercator)
+
+
+@lru_cache(maxsize=4)
+def _trayectos_mpl(registro):
+    """
+    Polígonos del registro en EPSG:3857 como matplotlib.path.Path
+    (uno por provincia, con huecos) y el centro del mapa en metros.
+    """
+    from matplotlib.path import Path as MplPath
+
+    def anillos(geom):
+        polys = geom.geoms if geom.geom_type == "MultiPolygon" else [geom]
+        for poly in polys:
+            for anillo in (poly.exterior, *poly.interiors):
+                yield np.asarray(anillo.coords)[:, :2]
+
+    trayectos = []
+    for geom in registro.gdf.geometry.to_crs("EPSG:3857"):
+        partes = list(anillos(geom)) if geom is not None and not geom.is_empty else []
+        if not partes:
+            trayectos.append(MplPath(np.zeros((1, 2)), [MplPath.MOVETO]))
+            continue
+        codigos = [np.r_[MplPath.MOVETO, np.full(len(a) - 2, MplPath.LINETO), MplPath.CLOSEPOLY]
+                   for a in partes]
+        trayectos.append(MplPath(np.concatenate(partes), np.concatenate(codigos).astype(np.uint8)))
+    centro = gpd.GeoSeries.from_xy([registro.centro[1]], [registro.centro[0]], crs="EPSG:4326")\
+                 .to_crs("EPSG:3857").iloc[0]
+    return trayectos, (centro.x, centro.y)
+
+
+_lienzos_mpl = threading.local()
+
+
+def _lienzo_mpl(registro, ciudad, mes, sensibilidad_color, zoom, dpi_scale, legend_side,
+                ancho, alto, escala, medida):
+    """
+    Figura de rasterizar_mapa con todo lo que no depende del día (encuadre,
+    provincias, recuadro y leyenda) y la colección de provincias, cuyos
+    colores son lo único que cambia de un día a otro. Cada hilo guarda la
+    última y la reutiliza mientras sólo cambie el día.
+    """
+    clave = (registro, ciudad, int(mes), sensibilidad_color, zoom, dpi_scale, legend_side,
+             ancho, alto, escala, medida)
+    previo = getattr(_lienzos_mpl, "lienzo", None)
+    if previo is not None and previo[0] == clave:
+        return previo[1:]
+
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.collections import PathCollection
+    from matplotlib.figure import Figure
+    from matplotlib.patches import Patch
+
+    info = medida_mapa(medida)
+    trayectos, (cx, cy) = _trayectos_mpl(registro)
+    fig = Figure(figsize=(ancho / 96, alto / 96), dpi=96 * escala)
+    FigureCanvasAgg(fig)
+    ax = fig.add_axes((0, 0, 1, 1))
+    ax.set_axis_off()
+    res = _M_POR_PX_Z0 / 2 ** zoom
+    ax.set_xlim(cx - ancho / 2 * res, cx + ancho / 2 * res)
+    ax.set_ylim(cy - alto / 2 * res, cy + alto / 2 * res)
+    provincias = PathCollection(trayectos, facecolors="white", edgecolors="blue", linewidths=0.75)
+    ax.add_collection(provincias)
+    pt = 0.75                                   # 1 px CSS = 0.75 pt
+
+    # Recuadro superior
+    fig.text(0.5, 1 - 10 / alto, f"Ciudad: {ciudad} | Mes: {int(mes)} | Sensibilidad: {sensibilidad_color}",
+             ha="center", va="top", fontsize=14 * dpi_scale * pt,
+             bbox=dict(boxstyle="round,pad=0.5", fc="white", ec="grey", lw=2 * pt))
+
+    # Leyenda opcional
+    if legend_side in ("left", "right"):
+        scale = dpi_scale * 0.8
+        ax.legend(
+            handles=[Patch(fc=info.muestra, label=f"{info.nombre_color}: {info.origen}\n"
+                                                  f"{info.intensidad}"),
+                     Patch(fc=COLOR_DESTINO, label="Verde: Provincia destino")],
+            title="Leyenda", loc=f"lower {legend_side}", fontsize=13 * scale * pt,
+            title_fontproperties={"weight": "bold", "size": 13 * scale * pt},
+            frameon=True, fancybox=True, framealpha=1, edgecolor="grey",
+            borderaxespad=10 / (13 * scale))      # 10 px CSS del borde, en unidades de fuente
+
+    _lienzos_mpl.lienzo = (clave, fig, provincias)
+    return fig, provincias
+
+
+def rasterizar_mapa(ciudad, dia, mes, sensibilidad_color=3, zoom=6, dpi_scale=1.0,
+                    legend_side="left", ancho=1920, alto=1080, escala=1, medida="viajes", **_):
+    """
+    Dibuja el mapa del día directamente a PNG (bytes) sin navegador:
+    mismas provincias, rampa de color, recuadro superior y leyenda que
+    graficaTransportesDia, con el mismo encuadre (centro y zoom Leaflet)
+    para una ventana de ancho × alto px CSS a 'escala' px por px CSS.
+    No dibuja mapa base. Los días seguidos de un mismo mapa reutilizan la
+    figura (ver _lienzo_mpl) y sólo cambian los colores de las provincias.
+    """
+    registro = cargar_provincias()
+    info = medida_mapa(medida)
+    cubo = cubo_medida(ciudad, mes, medida)
+    valores = cubo.alinear(registro.prov_std)[cubo.fila(dia)]
+    colores = marcar_destino(info.colores(valores, sensibilidad_color), registro.prov_std, ciudad)
+    fig, provincias = _lienzo_mpl(registro, ciudad, mes, sensibilidad_color, zoom, dpi_scale,
+                                  legend_side, ancho, alto, escala, medida)
+    provincias.set_facecolor(list(colores))
+
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png", facecolor="white", pil_kwargs={"compress_level": 1})
+    return buf.getvalue()
+
+
+def _png_mapa(kwargs):
+    """
+    Igual que _html_mapa pero rasterizando con rasterizar_mapa (para el pool de procesos).
+    """
+    return rasterizar_mapa(**kwargs)
+
+
+def capturar_dias(trabajos, ancho, alto, escala, motor="navegador", workers=None,
+                  progreso=(0, 100), al_capturar=None):
+    """
+    Obtiene un PNG por cada trabajo (clave, kwargs de graficaTransportesDia)
+    para una ventana de ancho × alto px CSS a 'escala'.
+      - motor="navegador":  Folium → HTML → Chrome headless del pool.
+      - motor="matplotlib": rasterizado en proceso, sin Chrome ni teselas.
+    Emite progreso entre progreso[0] y progreso[1] y al final un dict {clave: png}
+    (vacío si se pasa 'al_capturar', ver capturar_en_paralelo).
+    Los días cuya huella ya está en el almacén de días no se vuelven a capturar.
+    """
+    if motor not in MOTORES_CAPTURA:
+        raise ValueError(f"Motor desconocido: {motor}")
+    trabajos = list(trabajos)
+    if motor == "matplotlib":
+        ini, fin = progreso
+        trabajos = [(clave, dict(kw, ancho=ancho, alto=alto, escala=escala))
+                    for clave, kw in trabajos]
+        pngs, producidos = {}, 0
+        yield Progreso(ini, etapa="rasterizado", hechos=0, total=len(trabajos))
+        for hechos, (clave, png) in enumerate(renderizar_dias(trabajos, workers, _png_mapa), 1):
+            if al_capturar:
+                al_capturar(clave, png)
+            else:
+                pngs[clave] = png
+            producidos += len(png)
+            yield Progreso(ini + int(hechos / len(trabajos) * (fin - ini)), etapa="rasterizado",
+                           bytes=producidos, hechos=hechos, total=len(trabajos))
+        yield pngs
+        return
+
+    # Capturas ya hechas de días sin cambios (almacén de días)
+    ini, fin = progreso
+    yield Progreso(ini, etapa="almacén de días")
+    huellas = dict(zip((clave for clave, _ in trabajos),
+                       huellas_dias("captura", [dict(kw, ancho=ancho, alto=alto, escala=escala)
+                                                for _, kw in trabajos])))
+    pngs, faltan = {}, []
+    for clave, kw in trabajos:
+        png = leer_dia(huellas[clave])
+        if png is None:
+            faltan.append((clave, kw))
+        elif al_capturar:
+            al_capturar(clave, png)
+        else:
+            pngs[clave] = png
+    medio = ini + int((len(trabajos) - len(faltan)) / max(len(trabajos), 1) * (fin - ini))
+    yield Progreso(medio, etapa="almacén de días", hechos=len(trabajos) - len(faltan),
+                   total=len(trabajos))
+    if faltan:
+        agotadas = []
+
+        def guardar(clave, png):
+            if clave not in agotadas:           # no se guardan capturas a medio cargar
+                guardar_dia(huellas[clave], png)
+            if al_capturar:
+                al_capturar(clave, png)
+            else:
+                pngs[clave] = png
+
+        pool = obtener_pool(ancho, alto, escala)
+        teselas = teselas_captura()             # local/offline si así se configura
+        paginas = renderizar_dias([(clave, dict(kw, teselas=teselas)) for clave, kw in faltan],
+                                  workers, reutilizar=False)
+        for chunk in capturar_en_paralelo(pool, paginas, progreso=(medio, fin), al_capturar=guardar,
+                                          agotadas_claves=agotadas, total=len(faltan)):
+            if isinstance(chunk, int):
+                yield chunk
+        podar_almacen_dias()
+    yield pngs
+
+
+# In[102]:
+
+
+import zipfile
+
+# ── Empaquetado de frames de las exportaciones por imágenes ──────────
+# "base64"  → un único HTML con cada frame embebido como data URI,
+# "carpeta" → carpeta con index.html (visor) + un fichero por frame,
+# "zip"     → lo mismo que "carpeta" dentro de un .zip (lo que se descarga).
+# En "carpeta" y "zip" el visor sólo carga el día visible y precarga los
+# vecinos, así que ni la memoria al generar ni la carga crecen con el mes.
+EMPAQUETADOS = ("base64", "carpeta", "zip")
+FORMATOS_FRAME = {"webp": ("WEBP", "image/webp"),
+                  "jpeg": ("JPEG", "image/jpeg"),
+                  "png":  ("PNG",  "image/png")}
+
+
+@lru_cache(maxsize=None)
+def _pil():
+    """
+    Pillow se importa la primera vez que hace falta codificar una imagen.
+    """
+    from PIL import Image, ImageChops, GifImagePlugin, features
+    return SimpleNamespace(Image=Image, ImageChops=ImageChops,
+                           GifImagePlugin=GifImagePlugin, features=features)
+
+
+@lru_cache(maxsize=None)
+def formatos_frame():
+    """
+    FORMATOS_FRAME más "avif" si el Pillow instalado sabe escribirlo.
+    """
+    formatos = dict(FORMATOS_FRAME)
+    if _pil().features.check("avif"):
+        formatos["avif"] = ("AVIF", "image/avif")
+    return formatos
+
+
+def codificar_frame(png, formato="png", calidad=85):
+    """
+    Recodifica la captura PNG 'png' (bytes) al 'formato' de formatos_frame().
+    """
+    if formato == "png":
+        return png
+    pil, _ = formatos_frame()[formato]
+    with _pil().Image.open(io.BytesIO(png)) as im:
+        buf = io.BytesIO()
+        im.convert("RGB").save(buf, pil, quality=calidad)
+    return buf.getvalue()
+
+
+class PaqueteFrames:
+    """
+    Destino de los frames de una exportación por imágenes.
+    'nombre' es el nombre base en directorio_salida(); cada frame se escribe
+    (o se embebe, en "base64") al llegar con añadir(), que devuelve el src
+    que debe usar el visor. cerrar(html) escribe el visor y devuelve la ruta:
+    <nombre>.html, <nombre>/index.html o <nombre>.zip según 'empaquetado'.
+    """
+
+    def __init__(self, nombre, empaquetado="base64", formato="png", calidad=85):
+        if empaquetado not in EMPAQUETADOS:
+            raise ValueError(f"Empaquetado desconocido: {empaquetado}")
+        if formato not in formatos_frame():
+            raise ValueError(f"Formato de imagen no disponible: {formato}")
+        self.empaquetado, self.formato, self.calidad = empaquetado, formato, calidad
+        self.ext = "jpg" if formato == "jpeg" else formato
+        self._zip = None
+        salida = directorio_salida()
+        if empaquetado == "base64":
+            self.ruta = salida / f"{nombre}.html"
+        elif empaquetado == "carpeta":
+            self.ruta = salida / nombre / "index.html"
+            self._tmp = _temporal_junto_a(self.ruta.parent)     # carpeta propia de esta exportación
+            self._tmp.mkdir(parents=True)
+        else:
+            self.ruta = salida / f"{nombre}.zip"
+            self._tmp = _temporal_junto_a(self.ruta)
+            self._zip = zipfile.ZipFile(self._tmp, "w", zipfile.ZIP_STORED)
+
+    def añadir(self, nombre, png):
+        datos = codificar_frame(png, self.formato, self.calidad)
+        if self.empaquetado == "base64":
+            mime = formatos_frame()[self.formato][1]
+            return f"data:{mime};base64," + base64.b64encode(datos).decode()
+        fichero = f"{nombre}.{self.ext}"
+        if self._zip is not None:
+            self._zip.writestr(fichero, datos)
+        else:
+            (self._tmp / fichero).write_bytes(datos)
+        return fichero
+
+    def cerrar(self, html):
+        if self.empaquetado == "base64":
+            self.ruta.write_text(html, encoding="utf-8")
+        elif self._zip is not None:
+            self._zip.writestr("index.html", html, zipfile.ZIP_DEFLATED)
+            self._zip.close()
+            os.replace(self._tmp, self.ruta)
+        else:
+            (self._tmp / "index.html").write_text(html, encoding="utf-8")
+            _reemplazar_carpeta(self._tmp, self.ruta.parent)
+        return self.ruta
+
+    def descartar(self):
+        if self._zip is not None:
+            self._zip.close()
+            self._tmp.unlink(missing_ok=True)
+        elif self.empaquetado == "carpeta":
+            shutil.rmtree(self._tmp, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, tipo, *_):
+        if tipo is not None:
+            self.descartar()
+
+
+def _adjunto_frames(ruta, params):
+    """
+    Frames sueltos que acompañan al index.html en el empaquetado "carpeta".
+    """
+    if params.get("empaquetado") != "carpeta":
+        return []
+    return [f for f in ruta.parent.iterdir() if f != ruta and f.name != "entrada.json"]
+
+
+def _script_visor(dias, fuentes):
+    """
+    <script> del slider de los visores por imágenes. 'fuentes' asocia el id
+    de cada <img> con la lista de src por día (en el orden de 'dias').
+    El slider recorre índices; al cambiar de día se precargan los vecinos.
+    """
+    return f"""<script>
+const dias={json.dumps([int(d) for d in dias])}, fuentes={json.dumps(fuentes)}, vistos={{}};
+function precargar(k){{
+  if(k<0||k>=dias.length) return;
+  for(const id in fuentes){{
+    const s=fuentes[id][k];
+    if(!vistos[s]){{vistos[s]=new Image();vistos[s].src=s;}}
+  }}
+}}
+function chg(k){{
+  k=+k;
+  document.getElementById('lbl').textContent=dias[k];
+  for(const id in fuentes) document.getElementById(id).src=fuentes[id][k];
+  for(const d of [1,-1,2,-2]) precargar(k+d);
+}}
+chg(0);
+</script>"""
+
+
 # In[101]:
 
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.chrome.options import Options
 import base64, json, time
 from tempfile import TemporaryDirectory
 
+@resultado_cacheado(lambda p: [_excel_ciudad(p["ciudad"], p["mes"]), _georef_file(),
+                                *_entradas_medida(p)],
+                    adjuntos=_adjunto_frames)
 def exportar_mapa_con_imagenes_mes(ciudad, mes,
                                    sensibilidad_color: int = 3,
-                                   zoom: int = 7):
+                                   zoom: int = 7,
+                                   workers=None,
+                                   motor: str = "navegador",
+                                   empaquetado: str = "base64",
+                                   formato_imagen: str = "png",
+                                   medida: str = "viajes"):
     """
-    Genera un HTML con una imagen PNG Hi-DPI por cada día disponible
-    y un slider para alternar. Devuelve la ruta del HTML final.
+    Genera un visor HTML con una imagen Hi-DPI por cada día disponible
+    y un slider para alternar. Devuelve la ruta del HTML (o del .zip).
+    workers: procesos para renderizar los mapas a la vez (ver renderizar_dias).
+    motor: "navegador" (Chrome headless) o "matplotlib" (sin navegador).
+    empaquetado: "base64", "carpeta" o "zip" (ver PaqueteFrames).
+    formato_imagen: clave de formatos_frame(); "png" (sin recodificar) por
+    defecto, "webp", "jpeg" o "avif" para frames más ligeros.
+    medida: "viajes" o "relativo" (viajes por mil habitantes).
     Progreso emitido: 0-100.
     """
 
     xls = DATOS_DIR / f"{ciudad.lower()}-{int(mes):02}.xlsx"
-    out = RESULTADOS_DIR / f"imagenes_{ciudad}_{int(mes):02}.html"
 
     # ── 0 % : comprobaciones ────────────────────────────────────────────
-    yield 0
+    yield Progreso(0, etapa="datos")
     if not xls.exists():
         raise FileNotFoundError(xls)
-    df   = pd.read_excel(xls)
-    dias = sorted(df["dia"].dropna().unique())
+    dias = cubo_transporte(ciudad, mes).dias.tolist()
     if not dias:
         raise ValueError("No hay días en el Excel")
-    total = len(dias)
     yield 5
 
     # ── parámetros de captura Hi-DPI ──────────────────────────────────────
@@ -445,52 +2853,24 @@ def exportar_mapa_con_imagenes_mes(ciudad, mes,
     base_scale = (WINDOW_W * DEVICE_SCALE) / TARGET_DISPLAY_WIDTH  # ≈ 2.67
     dpi_scale  = base_scale * 0.6          # ≈ 1.60
 
-    # ── Selenium headless ───────────────────────────────────────────────
-    opts = Options()
-    opts.add_argument("--headless=new")
-    opts.add_argument("--no-sandbox")
-    opts.add_argument("--disable-dev-shm-usage")
-    opts.add_argument(f"--window-size={WINDOW_W},{WINDOW_H}")
-    opts.add_argument(f"--force-device-scale-factor={DEVICE_SCALE}")
-    service = Service("/usr/bin/chromedriver")
-    driver  = webdriver.Chrome(service=service, options=opts)
-
-    imgs_b64 = {}
-    with TemporaryDirectory() as tmpdir:
-        tmpdir = Path(tmpdir)
-
-        for idx, dia in enumerate(dias, 1):
-            # ── generar mapa Folium con escalado de fuentes ────────────
-            mapa = None
-            for chunk in graficaTransportesDia(ciudad, dia, mes,
-                                               sensibilidad_color, zoom,
-                                               dpi_scale=dpi_scale):
-                if not isinstance(chunk, int):
-                    mapa = chunk
-
-            # guardar HTML temporal
-            tmp_html = tmpdir / f"{ciudad}_{mes}_{dia}.html"
-            tmp_html.write_text(mapa.get_root().render(), encoding="utf-8")
-
-            # capturar PNG
-            driver.get(tmp_html.as_uri())
-            time.sleep(3)      # espera tiles/fonts
-            png_path = tmpdir / f"{ciudad}_{mes}_{dia}.png"
-            driver.save_screenshot(str(png_path))
-
-            # Base-64 para embebido
-            imgs_b64[dia] = base64.b64encode(png_path.read_bytes()).decode("utf-8")
-
-            # progreso (5 → 95)
-            yield 5 + int(idx / total * 90)
-
-    driver.quit()
-
-    # ── construir HTML con slider ───────────────────────────────────────
-    min_d, max_d = dias[0], dias[-1]
-    imgs_json    = json.dumps({str(k): v for k, v in imgs_b64.items()})
-
-    html_final = f"""<!DOCTYPE html>
+    # ── mapas con escalado de fuentes, cada frame se guarda al llegar (5 → 95)
+    trabajos = [(dia, dict(ciudad=ciudad, dia=dia, mes=mes, sensibilidad_color=sensibilidad_color,
+                           zoom=zoom, dpi_scale=dpi_scale, medida=medida))
+                for dia in dias]
+    fuentes = {}
+    with PaqueteFrames(f"imagenes_{ciudad}_{int(mes):02}{_sufijo_medida(medida)}",
+                       empaquetado, formato_imagen) as paquete:
+        def al_capturar(dia, png):
+            fuentes[dia] = paquete.añadir(f"dia_{int(dia):02}", png)
+
+        for chunk in capturar_dias(trabajos, WINDOW_W, WINDOW_H, DEVICE_SCALE,
+                                   motor, workers, progreso=(5, 95), al_capturar=al_capturar):
+            if isinstance(chunk, int):
+                yield chunk
+        yield Progreso(95, etapa="empaquetado")
+
+        # ── construir HTML con slider ───────────────────────────────────
+        html_final = f"""<!DOCTYPE html>
 <html lang="es"><head>
 <meta charset="utf-8"/>
 <title>Mapas – {ciudad.capitalize()} {mes}</title>
@@ -503,111 +2883,87 @@ def exportar_mapa_con_imagenes_mes(ciudad, mes,
 </style></head><body>
 <div id="ctl">
   Día:
-  <input type="range" id="slider" min="{min_d}" max="{max_d}" value="{min_d}"
+  <input type="range" id="slider" min="0" max="{len(dias) - 1}" value="0"
          oninput="chg(this.value)">
-  <span id="lbl">{min_d}</span>
+  <span id="lbl">{dias[0]}</span>
 </div>
-<img id="map-img" src="data:image/png;base64,{imgs_b64[min_d]}" alt="Mapa"/>
-<script>
-const imgs={imgs_json};
-function chg(v){{
-  document.getElementById('lbl').textContent=v;
-  document.getElementById('map-img').src='data:image/png;base64,'+imgs[v];
-}}
-</script></body></html>"""
+<img id="map-img" decoding="async" alt="Mapa"/>
+{_script_visor(dias, {"map-img": [fuentes[d] for d in dias]})}
+</body></html>"""
 
-    out.write_text(html_final, encoding="utf-8")
+        out = paquete.cerrar(html_final)
     yield 100
     yield out
 
 
 # In[85]:
 
-def comparar_mapas(ciudad_1, mes_1, sensibilidad_1,
-                   ciudad_2, mes_2, sensibilidad_2,
-                   zoom: int = 6):
+def _comparar(series, nombre, zoom=6, workers=None, motor="navegador",
+              empaquetado="base64", formato_imagen="png", medida="viajes"):
     """
-    Captura dos series de mapas diarios (960×1080 CSS px, escala 2×)
-    SIN leyenda en las capturas y genera un HTML responsive con slider
-    y ambos mapas lado a lado. Añade UNA sola leyenda global en el HTML.
-    Progreso 0–100; al final devuelve el Path al HTML.
-    """
-    yield 0
-    f1 = DATOS_DIR / f"{ciudad_1.lower()}-{int(mes_1):02}.xlsx"
-    f2 = DATOS_DIR / f"{ciudad_2.lower()}-{int(mes_2):02}.xlsx"
-    out = RESULTADOS_DIR / f"comparar_{ciudad_1}_{mes_1}_{ciudad_2}_{mes_2}.html"
-    if not f1.exists() or not f2.exists():
-        raise FileNotFoundError("Falta algún Excel")
+    Motor de comparar_mapas / comparar_series. 'series' es una lista de
+    (ciudad, mes, sensibilidad): un panel por serie, lado a lado.
+    Cada (ciudad, mes) se carga una vez (cubo memoizado) y los paneles
+    repetidos comparten capturas; todos los frames de todos los paneles
+    se capturan a la vez con el pool (ver capturar_dias).
+    """
+    yield Progreso(0, etapa="datos")
+    series = [(ciudad, int(mes), int(sens)) for ciudad, mes, sens in series]
+    if not series:
+        raise ValueError("No hay series que comparar")
+    for ciudad, mes, _ in series:
+        if not _excel_ciudad(ciudad, mes).exists():
+            raise FileNotFoundError("Falta algún Excel")
     yield 5
 
-    d1 = sorted(pd.read_excel(f1)["dia"].dropna().unique())
-    d2 = sorted(pd.read_excel(f2)["dia"].dropna().unique())
-    s_min, s_max = max(d1[0], d2[0]), min(d1[-1], d2[-1])
-    if s_min > s_max:
+    # Días con datos en todas las series (un cubo por (ciudad, mes) distinto)
+    comunes = None
+    for ciudad, mes in dict.fromkeys((c.lower(), m) for c, m, _ in series):
+        dias_serie = set(cubo_medida(ciudad, mes, medida).dias.tolist())
+        comunes = dias_serie if comunes is None else comunes & dias_serie
+    dias = sorted(comunes)
+    if not dias:
         raise ValueError("No hay días comunes")
-    dias = list(range(int(s_min), int(s_max) + 1))
     yield 15
 
-    # Selenium headless 960×1080 CSS px, escala 2×
-    CSS_W, CSS_H = 960, 1080
+    # Capturas 1920/N × 1080 CSS px, escala 2× (Chrome del pool o matplotlib)
+    n = len(series)
+    CSS_W, CSS_H = 1920 // n, 1080
     DEV_SCALE    = 2
     dpi_scale    = 0.90
-
-    opts = Options()
-    opts.add_argument("--headless=new")
-    opts.add_argument("--no-sandbox")
-    opts.add_argument("--disable-dev-shm-usage")
-    opts.add_argument(f"--window-size={CSS_W},{CSS_H}")
-    opts.add_argument(f"--force-device-scale-factor={DEV_SCALE}")
-    driver = webdriver.Chrome(service=Service("/usr/bin/chromedriver"), options=opts)
     yield 20
 
-    L, R = {}, {}
-    total = len(dias) * 2
-    step  = 0
-
-    with TemporaryDirectory() as tmp:
-        tmp = Path(tmp)
-        for dia in dias:
-            # Mapa izquierdo SIN leyenda
-            mapa1 = next(ch for ch in
-                         graficaTransportesDia(
-                             ciudad_1, dia, mes_1,
-                             sensibilidad_1, zoom,
-                             dpi_scale=dpi_scale,
-                             legend_side=None
-                         )
-                         if not isinstance(ch, int))
-            h1 = tmp / f"L_{dia}.html"
-            h1.write_text(mapa1.get_root().render(), encoding="utf-8")
-            driver.get(h1.as_uri()); time.sleep(2.2)
-            p1 = tmp / f"L_{dia}.png"
-            driver.save_screenshot(str(p1))
-            L[str(dia)] = base64.b64encode(p1.read_bytes()).decode()
-            step += 1; yield 20 + int(step / total * 75)
-
-            # Mapa derecho SIN leyenda
-            mapa2 = next(ch for ch in
-                         graficaTransportesDia(
-                             ciudad_2, dia, mes_2,
-                             sensibilidad_2, zoom,
-                             dpi_scale=dpi_scale,
-                             legend_side=None
-                         )
-                         if not isinstance(ch, int))
-            h2 = tmp / f"R_{dia}.html"
-            h2.write_text(mapa2.get_root().render(), encoding="utf-8")
-            driver.get(h2.as_uri()); time.sleep(2.2)
-            p2 = tmp / f"R_{dia}.png"
-            driver.save_screenshot(str(p2))
-            R[str(dia)] = base64.b64encode(p2.read_bytes()).decode()
-            step += 1; yield 20 + int(step / total * 75)
-
-    driver.quit()
-    yield 95
-
-    # Construir HTML final con UNA sola leyenda
-    legend_html = f"""
+    # Mapas de cada panel SIN leyenda; los paneles iguales se capturan una vez
+    # Clave sin mayúsculas para no capturar dos veces; se muestra el nombre original
+    paneles = {}
+    for c, m, s in series:
+        paneles.setdefault((c.lower(), m, s), (c, m, s))
+    claves = list(paneles)
+    letras = [chr(ord("A") + i) for i in range(len(paneles))]
+    trabajos = [((i, dia), dict(ciudad=ciudad, dia=dia, mes=mes, sensibilidad_color=sens,
+                                zoom=zoom, dpi_scale=dpi_scale, legend_side=None,
+                                medida=medida))
+                for dia in dias
+                for i, (ciudad, mes, sens) in enumerate(paneles.values())]
+    paquete = PaqueteFrames(nombre, empaquetado, formato_imagen)
+    fuentes = {}
+
+    def al_capturar(clave, png):
+        i, dia = clave
+        fuentes[clave] = paquete.añadir(f"{letras[i]}_{int(dia):02}", png)
+
+    with paquete:
+        for chunk in capturar_dias(trabajos, CSS_W, CSS_H, DEV_SCALE, motor, workers,
+                                   progreso=(20, 95), al_capturar=al_capturar):
+            if isinstance(chunk, int):
+                yield chunk
+        panel = [claves.index((c.lower(), m, s)) for c, m, s in series]
+        columnas = {f"p{k}": [fuentes[(i, d)] for d in dias] for k, i in enumerate(panel)}
+        yield Progreso(95, etapa="empaquetado")
+
+        # Construir HTML final con UNA sola leyenda
+        info = medida_mapa(medida)
+        legend_html = f"""
     <div style="
         position:fixed;
         bottom:10px;
@@ -621,64 +2977,111 @@ def comparar_mapas(ciudad_1, mes_1, sensibilidad_1,
         z-index:9999;
     ">
       <b>🗺️ Leyenda</b><br><br>
-      <i style="background:#336699;width:12px;height:12px;display:inline-block;margin-right:5px;"></i>
-        <b>Azul</b>: Provincias de origen<br>
-      &nbsp;&nbsp;Más oscuro → más desplazamientos<br>
+      <i style="background:{info.muestra};width:12px;height:12px;display:inline-block;margin-right:5px;"></i>
+        <b>{info.nombre_color}</b>: {info.origen}<br>
+      &nbsp;&nbsp;{info.intensidad}<br>
       <i style="background:#66f26a;width:12px;height:12px;display:inline-block;margin-right:5px;"></i>
         <b>Verde</b>: Provincia destino
     </div>
     """
 
-    html = f"""<!DOCTYPE html>
+        celdas = "\n".join(f' <div class="cell"><img id="{id_}" decoding="async"></div>'
+                           for id_ in columnas)
+        titulo = " vs ".join(dict.fromkeys(c for c, _, _ in series))
+        html = f"""<!DOCTYPE html>
 <html lang="es"><head><meta charset="utf-8"/>
-<title>Comparación {ciudad_1} vs {ciudad_2}</title>
+<title>Comparación {titulo}</title>
 <style>
  html,body{{margin:0;padding:0;width:100vw;height:100vh;overflow:hidden}}
  #ctl{{position:fixed;top:10px;left:50%;transform:translateX(-50%);
        background:#fff;padding:6px 10px;border-radius:8px;
        box-shadow:0 0 6px #0004;font-family:sans-serif;font-size:14px;z-index:9}}
  .row{{display:flex;width:100vw;height:100vh}}
- .cell{{flex:0 0 50vw;height:100vh;overflow:hidden;position:relative}}
+ .cell{{flex:1 1 0;height:100vh;overflow:hidden;position:relative}}
  .cell img{{position:absolute;top:0;left:0;width:100%;height:100%;object-fit:cover}}
 </style></head><body>
 <div id="ctl">
  Día:
- <input type="range" id="sl" min="{s_min}" max="{s_max}" value="{s_min}"
+ <input type="range" id="sl" min="0" max="{len(dias) - 1}" value="0"
         oninput="chg(this.value)">
- <span id="lbl">{s_min}</span>
+ <span id="lbl">{dias[0]}</span>
 </div>
 <div class="row">
- <div class="cell"><img id="L" src="data:image/png;base64,{L[str(s_min)]}"></div>
- <div class="cell"><img id="R" src="data:image/png;base64,{R[str(s_min)]}"></div>
+{celdas}
 </div>
 {legend_html}
-<script>
-const Limg=document.getElementById('L'),
-      Rimg=document.getElementById('R'),
-      lbl=document.getElementById('lbl'),
-      L={json.dumps(L)}, R={json.dumps(R)};
-function chg(v){{lbl.textContent=v;Limg.src='data:image/png;base64,'+L[v];
-                 Rimg.src='data:image/png;base64,'+R[v];}}
-</script></body></html>"""
-
-    out.write_text(html, encoding="utf-8")
+{_script_visor(dias, columnas)}
+</body></html>"""
+
+        out = paquete.cerrar(html)
     yield 100
     yield out
 
+
+@resultado_cacheado(lambda p: [_excel_ciudad(p["ciudad_1"], p["mes_1"]),
+                                _excel_ciudad(p["ciudad_2"], p["mes_2"]), _georef_file(),
+                                *_entradas_medida(p)],
+                    adjuntos=_adjunto_frames)
+def comparar_mapas(ciudad_1, mes_1, sensibilidad_1,
+                   ciudad_2, mes_2, sensibilidad_2,
+                   zoom: int = 6,
+                   workers=None,
+                   motor: str = "navegador",
+                   empaquetado: str = "base64",
+                   formato_imagen: str = "png",
+                   medida: str = "viajes"):
+    """
+    Captura dos series de mapas diarios (960×1080 CSS px, escala 2×)
+    SIN leyenda en las capturas y genera un HTML responsive con slider
+    y ambos mapas lado a lado. Añade UNA sola leyenda global en el HTML.
+    empaquetado / formato_imagen / medida: como en exportar_mapa_con_imagenes_mes.
+    Progreso 0–100; al final devuelve el Path al HTML (o al .zip).
+    """
+    yield from _comparar([(ciudad_1, mes_1, sensibilidad_1), (ciudad_2, mes_2, sensibilidad_2)],
+                         f"comparar_{ciudad_1}_{mes_1}_{ciudad_2}_{mes_2}{_sufijo_medida(medida)}",
+                         zoom, workers, motor, empaquetado, formato_imagen, medida)
+
+
+@resultado_cacheado(lambda p: [*(_excel_ciudad(c, m) for c, m, _ in p["series"]), _georef_file(),
+                                *_entradas_medida(p)],
+                    adjuntos=_adjunto_frames)
+def comparar_series(series,
+                    zoom: int = 6,
+                    workers=None,
+                    motor: str = "navegador",
+                    empaquetado: str = "base64",
+                    formato_imagen: str = "png",
+                    medida: str = "viajes"):
+    """
+    Como comparar_mapas pero con N paneles: 'series' es una lista de
+    (ciudad, mes, sensibilidad), p. ej. varias ciudades o varios meses.
+    Cada panel se captura a 1920/N × 1080 CSS px.
+    Progreso 0–100; al final devuelve el Path al HTML (o al .zip).
+    """
+    series = [tuple(s) for s in series]
+    nombre = "comparar_" + "_".join(f"{c}_{int(m)}" for c, m, _ in series)
+    yield from _comparar(series, nombre + _sufijo_medida(medida),
+                         zoom, workers, motor, empaquetado, formato_imagen, medida)
+
+
 # In[115]:
 
 
-def mapa_transportes_relativo(ciudad, dia, mes, sensibilidad=3, open_browser=True):
+@resultado_cacheado(lambda p: [_excel_ciudad(p["ciudad"], p["mes"]), _georef_file(),
+                                DATOS_DIR / "poblaciones_provincias.xlsx"])
+def mapa_transportes_relativo(ciudad, dia, mes, sensibilidad=3, open_browser=True,
+                              teselas="OpenStreetMap"):
     """
     Mapa Folium con viajes por mil habitantes.
+    teselas: mapa base (ver capa_base); "ninguna" dibuja sólo las provincias.
     Funciona como generator: emite progreso (0–100) y al final la ruta al HTML.
     """
     geojson_path = DATOS_DIR / "georef-spain-provincia.geojson"
     trans_file   = DATOS_DIR / f"{ciudad.lower()}-{int(mes):02}.xlsx"
     pop_file     = DATOS_DIR / "poblaciones_provincias.xlsx"
-    html_path    = RESULTADOS_DIR / f"relativo_{ciudad}_{mes}_{dia}.html"
+    html_path    = directorio_salida() / f"relativo_{ciudad}_{mes}_{dia}.html"
 
-    yield 0
+    yield Progreso(0, etapa="datos")
 
     # Comprobaciones
     for path,label in [(geojson_path,"georef"),(trans_file,"transporte"),(pop_file,"poblaciones")]:
@@ -686,62 +3089,27 @@ def mapa_transportes_relativo(ciudad, dia, mes, sensibilidad=3, open_browser=Tru
             raise FileNotFoundError(f"{label} no encontrado: {path}")
     yield 10
 
-    # Carga
-    gdf = gpd.read_file(geojson_path)
-    dfT = pd.read_excel(trans_file)
-    dfP = pd.read_excel(pop_file)
+    # Carga (cubo de viajes por mil habitantes de todo el mes, memoizado)
+    registro = cargar_provincias(geojson_path)
+    cubo = cubo_relativo(ciudad, mes)
     yield 25
 
     # Filtrar
-    df_d = dfT[dfT["dia"]==dia]
-    if df_d.empty:
-        raise ValueError(f"No hay datos para día {dia}")
-    yield 35
-
-    # Agregar viajes
-    df_agg = (
-        df_d.groupby("provincia origen", as_index=False)["viajes"]
-            .sum()
-            .assign(prov_std=lambda d: d["provincia origen"].apply(standardize_province_name))
-    )
+    relativo_dia = cubo.serie_dia(dia)
     yield 45
 
-    # Poblaciones
-    dfP["prov_std"] = dfP["provincia"].apply(standardize_province_name)
-    dfP = dfP[~dfP["prov_std"].isin(["portugal","france","francia"])]
-    yield 55
-
-    # Merge viajes+población
-    df_rel = df_agg.merge(dfP[["prov_std","población"]], on="prov_std", how="left")
-    df_rel["población"] = df_rel["población"].fillna(0)
-    df_rel["relativo"] = df_rel.apply(
-        lambda r: (r["viajes"]/r["población"])*1_000 if r["población"]>0 else 0, axis=1
-    )
-    df_rel["relativo_fmt"] = df_rel["relativo"].apply(lambda x: f"{x:.4f}")
+    # Campo provincia (detectado una vez en el registro)
+    best = registro.campo
     yield 65
 
-    # Detectar campo
-    campos = [c for c in gdf.columns if c.lower()!="geometry"]
-    provs  = set(df_rel["prov_std"])
-    best, maxm = None, 0
-    for c in campos:
-        m = gdf[c].astype(str).apply(standardize_province_name).isin(provs).sum()
-        if m > maxm:
-            best, maxm = c, m
-    if best is None:
-        raise RuntimeError("No se detectó campo provincia en el geojson")
-    yield 75
-
-    # Merge con geodataframe
-    gdf["prov_std"] = gdf[best].astype(str).apply(standardize_province_name)
-    gdfm = gdf.merge(df_rel[["prov_std","relativo","relativo_fmt"]], on="prov_std", how="left")
-    gdfm["relativo"] = gdfm["relativo"].fillna(0)
-    yield 85
+    # Valores por provincia del GeoJSON
+    relativo = registro.prov_std.map(relativo_dia).fillna(0).to_numpy()
+    props = pd.DataFrame({best: registro.gdf[best], "prov_std": registro.prov_std,
+                          "relativo": relativo, "relativo_fmt": np.char.mod("%.4f", relativo)})
+    yield Progreso(85, etapa="mapa")
 
     # Crear mapa y centrar
-    center = gdfm.to_crs("EPSG:3857").geometry.centroid.unary_union.centroid
-    ctr_ll = gpd.GeoSeries([center], crs="EPSG:3857").to_crs("EPSG:4326").iloc[0]
-    m = folium.Map(location=[ctr_ll.y, ctr_ll.x], zoom_start=6)
+    m = folium.Map(location=list(registro.centro), zoom_start=6, **capa_base(teselas))
     yield 90
 
     # Overlay superior
@@ -760,23 +3128,10 @@ def mapa_transportes_relativo(ciudad, dia, mes, sensibilidad=3, open_browser=Tru
     m.get_root().add_child(mc)
 
     # ======== AQUÍ REINSERTAMOS LA CAPA GeoJson =========
-    estudio_std = standardize_province_name(ciudad)
-    max_rel     = gdfm["relativo"].max() or 1
-    def style_f(feat):
-        prov = standardize_province_name(feat["properties"].get(best,""))
-        if prov == estudio_std:
-            return {"fillColor":"#66f26a","color":"blue","weight":1,"fillOpacity":1}
-        r = feat["properties"].get("relativo",0)
-        if r<=0:
-            return {"fillColor":"#ffffff","color":"blue","weight":1,"fillOpacity":1}
-        norm  = min(r/max_rel,1)
-        inten = norm**(1/sensibilidad)
-        R = 255-int(255*inten); G = 255-int(255*inten); B = 139-int(139*inten)
-        return {"fillColor":f"#{R:02x}{G:02x}{B:02x}","color":"blue","weight":1,"fillOpacity":1}
-
-    folium.GeoJson(
-        gdfm,
-        style_function=style_f,
+    props["fill"] = marcar_destino(colores_relativos(relativo, sensibilidad),
+                                   props["prov_std"], ciudad)
+    CapaProvincias(
+        registro, 6, props,
         tooltip=folium.features.GeoJsonTooltip(
             fields=[best,"relativo_fmt"],
             aliases=["Provincia","Viajes/mil hab."]
@@ -811,13 +3166,164 @@ def mapa_transportes_relativo(ciudad, dia, mes, sensibilidad=3, open_browser=Tru
     yield html_path  # 100% final
 
 
-# In[121]:
+# In[120]:
+
+
+# ── Codificador de animaciones en streaming (GIF / WebP / MP4) ────
+FORMATOS_ANIMACION = ("gif", "webp", "mp4")
+MEMORIA_MAX_WEBP = int(os.environ.get("MOVILIDAD_WEBP_MB", 1024)) * 2**20
+
+
+@lru_cache(maxsize=None)
+def mp4_disponible():
+    """
+    True si imageio-ffmpeg (dependencia opcional) está instalado y trae su ffmpeg.
+    """
+    try:
+        import imageio_ffmpeg
+        imageio_ffmpeg.get_ffmpeg_exe()
+    except (ImportError, RuntimeError):
+        return False
+    return True
+
+
+def formatos_animacion():
+    """
+    Formatos de FORMATOS_ANIMACION que se pueden generar en esta instalación.
+    """
+    return tuple(f for f in FORMATOS_ANIMACION if f != "mp4" or mp4_disponible())
+
+
+class CodificadorAnimacion:
+    """
+    Recibe los frames (PNG en bytes, ndarray o PIL.Image) según se generan y
+    los reduce a 'ancho_max' px al vuelo, sin pasar por disco:
+      - gif:  cada frame se cuantiza a paleta de 256 colores y se escribe en
+              el fichero al llegar, recortado a la zona que cambió respecto al
+              anterior (sólo se guarda ese frame anterior: memoria constante).
+              Usa GifImagePlugin.getheader/getdata, que no son API pública:
+              por eso requirements.txt fija la versión mayor de Pillow.
+      - webp: animación WebP con pérdida ('calidad'), frames reducidos en RGB.
+              Pillow sólo escribe WebP animado con todos los frames a la vez,
+              así que se acumulan hasta cerrar, con un tope de MOVILIDAD_WEBP_MB.
+      - mp4:  H.264 mediante imageio-ffmpeg (opcional, ver mp4_disponible); cada
+              frame se envía al codificador y se descarta (memoria constante).
+    """
+
+    def __init__(self, ruta, formato="gif", fps=10, ancho_max=1920, calidad=80):
+        if formato not in FORMATOS_ANIMACION:
+            raise ValueError(f"Formato desconocido: {formato}")
+        self.ruta, self.formato, self.fps = Path(ruta), formato, fps
+        self.ancho_max, self.calidad = ancho_max, calidad
+        self._frames, self._video, self._bytes = [], None, 0
+        self._gif, self._anterior = None, None
+        if formato == "gif":
+            self._gif = open(self.ruta, "wb")
+        elif formato == "mp4":
+            try:
+                import imageio.v2 as imageio          # sólo para MP4
+                self._video = imageio.get_writer(str(self.ruta), format="FFMPEG", fps=fps,
+                                                 codec="libx264", quality=calidad / 10,
+                                                 macro_block_size=2, pixelformat="yuv420p")
+            except (ImportError, ValueError, RuntimeError) as e:
+                raise RuntimeError("MP4 requiere imageio-ffmpeg con libx264") from e
+
+    def _preparar(self, frame):
+        Image = _pil().Image
+        if isinstance(frame, (bytes, bytearray)):
+            img = Image.open(io.BytesIO(frame))
+        elif isinstance(frame, np.ndarray):
+            img = Image.fromarray(frame)
+        else:
+            img = frame
+        img = img.convert("RGB")
+        if self.ancho_max and img.width > self.ancho_max:
+            alto = round(img.height * self.ancho_max / img.width)
+            img = img.resize((self.ancho_max, alto), Image.Resampling.LANCZOS, reducing_gap=2.0)
+        if self.formato == "mp4" and (img.width % 2 or img.height % 2):
+            img = img.crop((0, 0, img.width - img.width % 2, img.height - img.height % 2))
+        return img
+
+    def _añadir_gif(self, img):
+        pil = _pil()
+        duracion = round(1000 / self.fps)
+        if self._anterior is None:
+            caja = (0, 0, *img.size)
+        else:                           # sólo la zona que cambió (disposal=1 conserva el resto)
+            caja = pil.ImageChops.difference(self._anterior, img).getbbox() or (0, 0, 1, 1)
+        trozo = img.crop(caja).quantize(colors=256, method=pil.Image.Quantize.MEDIANCUT,
+                                        dither=pil.Image.Dither.NONE)
+        if self._anterior is None:
+            cabecera, _ = pil.GifImagePlugin.getheader(trozo, info={"loop": 0, "duration": duracion})
+            self._gif.write(b"".join(cabecera))
+        for datos in pil.GifImagePlugin.getdata(trozo, caja[:2], duration=duracion, disposal=1,
+                                            include_color_table=True):
+            self._gif.write(datos)
+        self._anterior = img
+
+    def añadir(self, frame):
+        img = self._preparar(frame)
+        if self.formato == "mp4":
+            self._video.append_data(np.asarray(img))
+        elif self.formato == "gif":
+            self._añadir_gif(img)
+        else:
+            self._bytes += img.width * img.height * 3
+            if self._bytes > MEMORIA_MAX_WEBP:
+                raise MemoryError("La animación WebP supera MOVILIDAD_WEBP_MB; "
+                                  "usa gif o mp4, o un ancho_max menor")
+            self._frames.append(img)
+
+    def cerrar(self):
+        if self._video is not None:
+            self._video.close()
+            return self.ruta
+        if self._gif is not None:
+            vacio = self._anterior is None
+            self._gif.write(b";")       # fin del GIF
+            self._gif.close()
+            if vacio:
+                raise ValueError("No se ha añadido ningún frame")
+            return self.ruta
+        if not self._frames:
+            raise ValueError("No se ha añadido ningún frame")
+        duracion = round(1000 / self.fps)
+        primero, resto = self._frames[0], self._frames[1:]
+        primero.save(self.ruta, save_all=True, append_images=resto, duration=duracion,
+                     loop=0, quality=self.calidad, method=4)
+        self._frames = []
+        return self.ruta
+
+    def descartar(self):
+        if self._video is not None:
+            self._video.close()
+        if self._gif is not None:
+            self._gif.close()
+        self._frames = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, tipo, *_):
+        if tipo is None:
+            self.cerrar()
+        else:
+            self.descartar()
+
+
+def _adjunto_animacion(ruta, params):
+    """
+    Animación que referencia el HTML envoltorio de exportar_mapa_gif.
+    """
+    return [ruta.with_suffix("." + params["formato"])] if ruta.suffix == ".html" else []
+
 
+# In[121]:
 
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.chrome.options import Options
-import imageio.v2 as imageio
 
+@resultado_cacheado(lambda p: [_excel_ciudad(p["ciudad"], p["mes"]), _georef_file(),
+                                *_entradas_medida(p)],
+                  adjuntos=_adjunto_animacion)
 def exportar_mapa_gif(
     ciudad,
     mes,
@@ -826,92 +3332,79 @@ def exportar_mapa_gif(
     duracion_segundos=0.1,
     open_browser=True,
     html_wrapper=True,
+    workers=None,
+    motor="navegador",
+    formato="gif",
+    ancho_max=1920,
+    medida="viajes",
 ):
     """
     Genera un GIF animado tomando screenshots de los mapas Folium diarios:
       - Captura con Selenium en 1920×1080 CSS px a escala 2× para alta resolución.
       - Usa graficaTransportesDia con leyenda a la izquierda.
-      - Junta todas las PNG en un GIF (antes de borrar el tmpdir).
+      - Captura los días en paralelo con el pool de navegadores compartido.
+      - Codifica cada frame en cuanto está listo y le toca por orden de día
+        (CodificadorAnimacion), sin guardar las PNG en disco.
+      - formato: "gif", "webp" o "mp4"; ancho_max: ancho final en px (None = sin reducir).
       - Opcionalmente envuelve el GIF en un HTML.
-    Progreso: 0–100; devuelve Path al .gif o al HTML que lo envuelve.
+      - workers: procesos para renderizar los mapas a la vez (ver renderizar_dias).
+      - motor: "navegador" (Chrome headless) o "matplotlib" (sin navegador).
+      - medida: "viajes" o "relativo" (viajes por mil habitantes).
+    Progreso: 0–100; devuelve Path a la animación o al HTML que la envuelve.
     """
+    yield Progreso(0, etapa="datos")
     excel_path = DATOS_DIR / f"{ciudad.lower()}-{int(mes):02}.xlsx"
     if not excel_path.exists():
         raise FileNotFoundError(excel_path)
-    df = pd.read_excel(excel_path)
-    if "dia" not in df.columns:
-        raise ValueError("El Excel no contiene la columna 'dia'")
-    dias = sorted(df["dia"].dropna().unique())
+    dias = cubo_transporte(ciudad, mes).dias.tolist()
     if not dias:
         raise ValueError("No hay días disponibles en el Excel")
-    total = len(dias)
-    yield 0
-
-    gif_path = RESULTADOS_DIR / f"gif_{ciudad}_{int(mes):02}.gif"
-
-    # Selenium headless hi-DPI
-    opts = Options()
-    opts.add_argument("--headless=new")
-    opts.add_argument("--no-sandbox")
-    opts.add_argument("--disable-dev-shm-usage")
-    opts.add_argument("--window-size=1920,1080")
-    opts.add_argument("--force-device-scale-factor=2")
-    driver = webdriver.Chrome(service=Service("/usr/bin/chromedriver"), options=opts)
+
+    gif_path = directorio_salida() / f"gif_{ciudad}_{int(mes):02}{_sufijo_medida(medida)}.{formato}"
+    fps = 1 / duracion_segundos
     yield 5
 
-    png_files = []
-    with TemporaryDirectory() as tmpdir:
-        tmpdir = Path(tmpdir)
-
-        # 1) Capturar todos los PNG
-        for idx, dia in enumerate(dias, start=1):
-            # generar mapa con leyenda a la izquierda
-            mapa = None
-            for chunk in graficaTransportesDia(
-                ciudad, dia, mes, sensibilidad_color, zoom,
-                dpi_scale=1.0, legend_side="left"
-            ):
-                if not isinstance(chunk, int):
-                    mapa = chunk
-
-            # guardar HTML temporal
-            tmp_html = tmpdir / f"{ciudad}_{mes:02d}_{dia:02d}.html"
-            tmp_html.write_text(mapa.get_root().render(), encoding="utf-8")
-
-            # screenshot
-            driver.get(tmp_html.as_uri())
-            time.sleep(2.5)
-            tmp_png = tmpdir / f"{ciudad}_{mes:02d}_{dia:02d}.png"
-            driver.save_screenshot(str(tmp_png))
-            png_files.append(tmp_png)
-
-            yield 5 + int(idx / total * 80)
-
-        # 2) Ensamblar GIF *dentro* del with para que los PNG existan
-        fps = 1 / duracion_segundos
-        with imageio.get_writer(str(gif_path), mode="I", fps=fps, loop=0) as writer:
-            for png in png_files:
-                writer.append_data(imageio.imread(str(png)))
-        yield 90
-
-    # 3) Ya fuera del tmpdir, podemos cerrar el driver
-    driver.quit()
-    yield 95
+    # 1) Capturar los PNG (hi-DPI, leyenda a la izquierda) y 2) codificarlos
+    #    en orden de días según llegan; sólo esperan los que llegan adelantados.
+    trabajos = [(dia, dict(ciudad=ciudad, dia=dia, mes=mes, sensibilidad_color=sensibilidad_color,
+                           zoom=zoom, dpi_scale=1.0, legend_side="left", medida=medida))
+                for dia in dias]
+    with CodificadorAnimacion(gif_path, formato, fps, ancho_max) as codificador:
+        pendientes, siguiente = {}, iter(dias)
+        toca = [next(siguiente)]
+
+        def al_capturar(dia, png):
+            pendientes[dia] = png
+            while toca[0] in pendientes:
+                codificador.añadir(pendientes.pop(toca[0]))
+                toca[0] = next(siguiente, None)
+
+        for chunk in capturar_dias(trabajos, 1920, 1080, 2, motor, workers,
+                                   progreso=(5, 85), al_capturar=al_capturar):
+            if isinstance(chunk, int):
+                yield chunk
+        yield Progreso(85, etapa="codificación")
+    yield Progreso(90, bytes=gif_path.stat().st_size)
+    yield Progreso(95, etapa="envoltorio")
 
     # 4) HTML wrapper opcional
     if html_wrapper:
-        html_file = RESULTADOS_DIR / f"gif_{ciudad}_{int(mes):02}.html"
+        html_file = gif_path.with_suffix(".html")
+        if formato == "mp4":
+            media = f'<video src="{gif_path.name}" autoplay loop muted playsinline></video>'
+        else:
+            media = f'<img src="{gif_path.name}" alt="GIF de {ciudad} mes {mes}">'
         html_code = f"""<!DOCTYPE html>
 <html lang="es"><head><meta charset="utf-8"/>
 <title>GIF – {ciudad.capitalize()} {mes}</title>
 <style>
   body {{ margin:0; display:flex; justify-content:center; align-items:center;
          height:100vh; background:#000; }}
-  img  {{ max-width:100%; height:auto; }}
+  img, video {{ max-width:100%; height:auto; }}
 </style>
 </head>
 <body>
-  <img src="{gif_path.name}" alt="GIF de {ciudad} mes {mes}">
+  {media}
 </body>
 </html>"""
         html_file.write_text(html_code, encoding="utf-8")
@@ -933,4 +3426,10 @@ def exportar_mapa_gif(
 # In[ ]:
 
 
+# ── Coste de importar el módulo (lo paga también cada proceso del pool) ──
+TIEMPO_IMPORTACION = time.perf_counter() - _INICIO_IMPORTACION
+_sumar_metrica("movilidad_importacion_segundos", TIEMPO_IMPORTACION)
+log.debug("funciones_app importado en %.3f s", TIEMPO_IMPORTACION)
+
+
 
@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# ── Exportación por lotes desde la línea de comandos ──────────────
+# Genera de una vez la matriz ciudades × meses × modos, p. ej.:
+#
+#   python lote_app.py --ciudades sevilla valencia --meses 3-5 --modos mes gif
+#
+# Antes de empezar se prepara lo que comparten todas las tareas (provincias,
+# cubos de cada (ciudad, mes), población) y luego las tareas se reparten en
+# un pool de hilos. Cada tarea terminada se apunta en un fichero de control,
+# así que si el lote se interrumpe basta con relanzarlo para continuar (las
+# tareas cuyos Excel cambiaron desde entonces se rehacen).
+
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import funciones_app as fa
+
+log = logging.getLogger("lote_app")
+
+
+# ── Tareas: generadores con el protocolo de los exportadores ──────
+# (progreso int y al final la ruta o una lista de rutas)
+
+def _tarea_dias(ciudad, mes, opc, salida):
+    """
+    Un HTML por día con graficaTransportesDia (renderizados en el pool de procesos).
+    """
+    dias = fa.cubo_transporte(ciudad, mes).dias.tolist()
+    trabajos = [(dia, dict(ciudad=ciudad, dia=dia, mes=mes, sensibilidad_color=opc.sensibilidad,
+                           zoom=opc.zoom, medida=opc.medida))
+                for dia in dias]
+    rutas = []
+    for i, (dia, html) in enumerate(fa.renderizar_dias(trabajos, opc.workers), 1):
+        ruta = salida / f"mapa_{ciudad}_{int(mes):02}_{int(dia):02}{fa._sufijo_medida(opc.medida)}.html"
+        fa._escribir_atomico(ruta, lambda tmp: tmp.write_text(html, encoding="utf-8"))
+        rutas.append(ruta)
+        yield int(i / len(dias) * 100)
+    yield rutas
+
+
+def _tarea_relativo(ciudad, mes, opc, salida):
+    """
+    El mapa relativo (viajes por mil habitantes) de cada día del mes.
+    mapa_transportes_relativo no admite zoom ni medida: sólo cuenta la
+    sensibilidad (ver OPCIONES_MODO).
+    """
+    dias = fa.cubo_relativo(ciudad, mes).dias.tolist()
+    rutas = []
+    for i, dia in enumerate(dias, 1):
+        for chunk in fa.mapa_transportes_relativo(ciudad, dia, mes, opc.sensibilidad,
+                                                  open_browser=False):
+            if not isinstance(chunk, int):
+                rutas.append(chunk)
+        yield int(i / len(dias) * 100)
+    yield rutas
+
+
+MODOS = {
+    "dia": _tarea_dias,
+    "mes": lambda ciudad, mes, opc, salida: fa.exportar_mapa_interactivo_mes(
+        ciudad, mes, opc.sensibilidad, modo=opc.formato_mes, zoom=opc.zoom,
+        workers=opc.workers, medida=opc.medida, compresion=opc.compresion),
+    "imagenes": lambda ciudad, mes, opc, salida: fa.exportar_mapa_con_imagenes_mes(
+        ciudad, mes, opc.sensibilidad, zoom=opc.zoom, workers=opc.workers, motor=opc.motor,
+        empaquetado="zip", medida=opc.medida),
+    "gif": lambda ciudad, mes, opc, salida: fa.exportar_mapa_gif(
+        ciudad, mes, opc.sensibilidad, zoom=opc.zoom, open_browser=False, html_wrapper=False,
+        workers=opc.workers, motor=opc.motor, formato=opc.formato_gif, medida=opc.medida),
+    "relativo": _tarea_relativo,
+}
+
+# Opciones de la línea de comandos que cambian el resultado de cada modo
+OPCIONES_MODO = {
+    "dia": ("sensibilidad", "zoom", "medida"),
+    "mes": ("sensibilidad", "zoom", "medida", "formato_mes", "compresion"),
+    "imagenes": ("sensibilidad", "zoom", "medida", "motor"),
+    "gif": ("sensibilidad", "zoom", "medida", "formato_gif", "motor"),
+    "relativo": ("sensibilidad",),
+}
+
+
+# ── Plan ──────────────────────────────────────────────────────────
+
+def _meses(valores):
+    """
+    Admite meses sueltos y rangos: ["3", "5-7"] → [3, 5, 6, 7].
+    """
+    meses = []
+    for v in valores:
+        ini, _, fin = str(v).partition("-")
+        meses.extend(range(int(ini), int(fin or ini) + 1))
+    return sorted(set(meses))
+
+
+def _ciudades(valores):
+    """
+    Ciudades pedidas; "todas" = todas las que tienen algún Excel en datos/.
+    """
+    if [v.lower() for v in valores] == ["todas"]:
+        return sorted({p.stem.rsplit("-", 1)[0] for p in fa.DATOS_DIR.glob("*-[0-9][0-9].xlsx")})
+    return [v.lower() for v in valores]
+
+
+def planificar(ciudades, meses, modos):
+    """
+    Lista de tareas (clave, modo, ciudad, mes) de la matriz pedida,
+    saltando las combinaciones sin Excel (con aviso en el log).
+    """
+    tareas = []
+    for ciudad in ciudades:
+        for mes in meses:
+            if not fa._excel_ciudad(ciudad, mes).exists():
+                log.warning("Sin datos para %s-%02d; se omite", ciudad, mes)
+                continue
+            for modo in modos:
+                tareas.append((f"{modo}:{ciudad}:{mes:02}", modo, ciudad, mes))
+    return tareas
+
+
+def huella_tarea(modo, ciudad, mes, opc):
+    """
+    Lo que determina el resultado de una tarea: las opciones de su modo
+    (OPCIONES_MODO) y las huellas (SHA-256) de sus ficheros de entrada, el
+    Excel del mes, la geometría y, con la medida relativa, la tabla de población.
+    """
+    opciones = {k: getattr(opc, k) for k in OPCIONES_MODO[modo]}
+    entradas = [fa._excel_ciudad(ciudad, mes), fa._georef_file()]
+    if opciones.get("medida") == "relativo" or modo == "relativo":
+        entradas.append(fa.DATOS_DIR / "poblaciones_provincias.xlsx")
+    return {"opciones": opciones, "entradas": [fa.huella_entrada(e) for e in entradas]}
+
+
+def preparar(tareas, opc):
+    """
+    Trabajo compartido por todas las tareas, hecho una sola vez antes de
+    repartirlas: geometría provincial, cubos de cada (ciudad, mes) y, si
+    hace falta, población y cubos relativos. Quedan en las cachés del proceso.
+    """
+    fa.cargar_provincias()
+    relativo = opc.medida == "relativo" or any(modo == "relativo" for _, modo, _, _ in tareas)
+    for ciudad, mes in dict.fromkeys((c, m) for _, _, c, m in tareas):
+        fa.cubo_transporte(ciudad, mes)
+        if relativo:
+            fa.cubo_relativo(ciudad, mes)
+
+
+# ── Fichero de control para reanudar ──────────────────────────────
+
+class Control:
+    """
+    Tareas terminadas de un lote (clave → rutas de salida y huella de sus
+    opciones y entradas, ver huella_tarea), guardadas en JSON tras cada
+    tarea. Una tarea cuenta como hecha si sus salidas existen y ni sus
+    opciones ni sus entradas han cambiado.
+    """
+
+    def __init__(self, ruta):
+        self.ruta = Path(ruta)
+        self._cerrojo = threading.Lock()
+        self.hechas = {}
+        if self.ruta.exists():
+            self.hechas = json.loads(self.ruta.read_text(encoding="utf-8")).get("hechas", {})
+
+    def hecha(self, clave, huella):
+        hecha = self.hechas.get(clave)
+        if not isinstance(hecha, dict) or hecha.get("huella") != huella:
+            return False
+        return bool(hecha["rutas"]) and all(Path(r).exists() for r in hecha["rutas"])
+
+    def apuntar(self, clave, rutas, huella):
+        with self._cerrojo:
+            self.hechas[clave] = {"rutas": [str(r) for r in rutas], "huella": huella}
+            texto = json.dumps({"hechas": self.hechas}, indent=1)
+            fa._escribir_atomico(self.ruta, lambda tmp: tmp.write_text(texto, encoding="utf-8"))
+
+
+# ── Ejecución ─────────────────────────────────────────────────────
+
+def ejecutar_tarea(clave, modo, ciudad, mes, opc, salida):
+    """
+    Ejecuta una tarea y copia a 'salida' los artefactos que el exportador
+    dejó en la caché de resultados. Devuelve las rutas finales.
+    """
+    inicio = time.perf_counter()
+    resultado = None
+    for chunk in MODOS[modo](ciudad, mes, opc, salida):
+        if not isinstance(chunk, int):
+            resultado = chunk
+    rutas = []
+    for ruta in (resultado if isinstance(resultado, list) else [resultado]):
+        ruta = Path(ruta)
+        if ruta.parent != salida:
+            destino = salida / ruta.name
+            fa._escribir_atomico(destino, lambda tmp: shutil.copy2(ruta, tmp))
+            ruta = destino
+        rutas.append(ruta)
+    log.info("%s terminada en %.1f s (%d fichero(s))", clave, time.perf_counter() - inicio, len(rutas))
+    return rutas
+
+
+def ejecutar_lote(tareas, opc, salida, control):
+    """
+    Reparte las tareas pendientes en 'opc.paralelo' hilos. Devuelve el
+    número de tareas fallidas (los errores se registran y no paran el lote).
+    """
+    huellas = {t[0]: huella_tarea(*t[1:], opc) for t in tareas}
+    pendientes = [t for t in tareas if not control.hecha(t[0], huellas[t[0]])]
+    log.info("%d tareas, %d ya hechas, %d pendientes",
+             len(tareas), len(tareas) - len(pendientes), len(pendientes))
+    fallidas = 0
+    with ThreadPoolExecutor(max_workers=opc.paralelo) as ex:
+        futuros = {ex.submit(ejecutar_tarea, *t, opc, salida): t[0] for t in pendientes}
+        for hechas, fut in enumerate(as_completed(futuros), 1):
+            clave = futuros[fut]
+            try:
+                control.apuntar(clave, fut.result(), huellas[clave])
+            except Exception:
+                fallidas += 1
+                log.exception("%s fallida", clave)
+            log.info("[%d/%d] %s", hechas, len(pendientes), clave)
+    return fallidas
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Exporta mapas de movilidad por lotes.")
+    p.add_argument("--ciudades", nargs="+", required=True,
+                   help='ciudades (nombre del Excel) o "todas"')
+    p.add_argument("--meses", nargs="+", required=True, help="meses o rangos, p. ej. 3 5-7")
+    p.add_argument("--modos", nargs="+", choices=sorted(MODOS), default=["mes"])
+    p.add_argument("--sensibilidad", type=int, default=3)
+    p.add_argument("--zoom", type=int, default=6)
+    p.add_argument("--medida", choices=sorted(fa.MEDIDAS), default="viajes")
+    p.add_argument("--formato-mes", choices=["ligero", "iframes"], default="ligero")
+    p.add_argument("--compresion", choices=[c for c in fa.COMPRESIONES if c], default=None,
+                   help="compresión del HTML mensual (modo mes)")
+    p.add_argument("--formato-gif", choices=list(fa.formatos_animacion()), default="gif")
+    p.add_argument("--motor", choices=list(fa.MOTORES_CAPTURA), default="navegador")
+    p.add_argument("--paralelo", type=int, default=2, help="tareas a la vez")
+    p.add_argument("--workers", type=int, default=None,
+                   help="procesos de render por tarea (MOVILIDAD_WORKERS)")
+    p.add_argument("--salida", type=Path, default=fa.RESULTADOS_DIR / "lote")
+    p.add_argument("--control", type=Path, default=None,
+                   help="fichero de control (por defecto <salida>/lote.json)")
+    p.add_argument("--desde-cero", action="store_true", help="ignora el fichero de control")
+    p.add_argument("--metricas", type=Path, default=None,
+                   help="fichero donde dejar los tiempos por etapa en formato OpenMetrics")
+    opc = p.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    salida = opc.salida
+    salida.mkdir(parents=True, exist_ok=True)
+    tareas = planificar(_ciudades(opc.ciudades), _meses(opc.meses), opc.modos)
+    if not tareas:
+        log.error("No hay nada que exportar")
+        return 1
+
+    ruta_control = opc.control or salida / "lote.json"
+    if opc.desde_cero and ruta_control.exists():
+        ruta_control.unlink()
+    control = Control(ruta_control)
+
+    inicio = time.perf_counter()
+    preparar(tareas, opc)
+    log.info("Datos compartidos preparados en %.1f s", time.perf_counter() - inicio)
+    fallidas = ejecutar_lote(tareas, opc, salida, control)
+    log.info("Lote terminado en %.1f s; %d fallida(s)", time.perf_counter() - inicio, fallidas)
+    if opc.metricas:
+        fa.volcar_metricas(opc.metricas)
+    return 1 if fallidas else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
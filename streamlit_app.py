@@ -14,7 +14,11 @@ from funciones_app import (
     comparar_mapas,
     mapa_transportes_relativo,
     exportar_mapa_gif,
+    formatos_animacion,
+    COMPRESIONES,
+    version_comprimida,
 )
+from trabajos_app import lanzar, seguir, listar, ruta_resultado
 
 
 # -------- Soporte PyInstaller (ignorado en Cloud) --------
@@ -42,6 +46,7 @@ menu = [
     "🆚 Comparar dos mapas",
     "📊 Mapa relativo de un día",
     "🎞️ GIF de un mes",
+    "🗂️ Trabajos",
 ]
 titles = {
     menu[0]: "Transporte Día",
@@ -50,41 +55,97 @@ titles = {
     menu[3]: "Comparación de Ciudades",
     menu[4]: "Transporte Relativo por Habitante",
     menu[5]: "GIF Animado del Mes",
+    menu[6]: "Trabajos en segundo plano",
 }
 descs = {
     menu[0]: "Colorea las provincias según volumen de viajes en un día concreto.",
     menu[1]: """Genera un HTML con todos los días y un slider para navegar entre ellos.
-    Ten en cuenta que puede tardar un rato y puede pesar alrededor de 600MB""",
-    menu[2]: """Toma capturas PNG diarias e incrústalas en un HTML con slider.
-    Ten en cuenta que puede tardar un rato y puede pesar alrededor de 300MB""",
+    El formato ligero usa un único mapa y pesa unos pocos MB; el completo
+    incrusta un mapa por día y puede pesar alrededor de 600MB""",
+    menu[2]: """Toma capturas diarias y muéstralas en un visor HTML con slider.
+    El ZIP guarda cada día como imagen aparte y el visor sólo carga el día visible;
+    el HTML único las incrusta todas y puede pesar más de 100MB""",
     menu[3]: """Muestra lado a lado dos provincias para un rango de días común.
-    Ten en cuenta que puede tardar un rato y puede pesar alrededor de 600MB""",
+    El ZIP guarda cada día como imagen aparte y el visor sólo carga el día visible;
+    el HTML único las incrusta todas y puede pesar más de 200MB""",
     menu[4]: "Colorea según viajes por mil habitantes, resaltando la provincia destino.",
     menu[5]: """Crea un GIF animado con la evolución diaria del mes.
     Ten en cuenta que puede tardar un rato.""",
+    menu[6]: """Las exportaciones largas siguen en marcha aunque cierres la página.
+    Aquí puedes ver su progreso y descargar las terminadas.""",
 }
 
 # -------- Utilidades --------
+def _segundos(s):
+    s = int(round(s))
+    return f"{s // 60} min {s % 60:02} s" if s >= 60 else f"{s} s"
+
+
+def texto_progreso(evento):
+    """
+    Texto para la barra: etapa, elementos hechos y tiempo restante
+    (sólo si el evento es un Progreso; con un int suelto no hay texto).
+    """
+    partes = []
+    if getattr(evento, "etapa", None):
+        partes.append(evento.etapa.capitalize())
+    if getattr(evento, "total", None):
+        partes.append(f"{evento.hechos or 0}/{evento.total}")
+    if getattr(evento, "transcurrido", None) is not None:
+        eta = evento.eta()
+        partes.append(_segundos(evento.transcurrido)
+                      + (f" · quedan ~{_segundos(eta)}" if eta else ""))
+    return " · ".join(partes) or None
+
+
 def show_progress(gen):
     bar = st.progress(0)
     res = None
     for chunk in gen:
         if isinstance(chunk, int):
-            bar.progress(chunk)
+            bar.progress(int(chunk), text=texto_progreso(chunk))
         else:
             res = chunk
     bar.empty()
     return res
 
+def ejecutar_trabajo(funcion, **params):
+    trabajo = lanzar(funcion, **params)
+    st.caption(f"Trabajo {trabajo}: puedes cerrar la página y descargarlo luego en «Trabajos».")
+    return show_progress(seguir(trabajo))
+
 def embed_folium(m, w=760, h=560):
     components.html(m.get_root().render(), width=w, height=h, scrolling=False)
 
-def download_button_from_path(path: Path, label: str):
+DESCARGA_DIFERIDA = 20 * 2**20     # ficheros mayores se leen sólo al pedir la descarga
+COMPRIMIR_DESDE   = 5 * 2**20      # HTML mayores pueden descargarse autodescomprimibles
+
+def download_button_from_path(path: Path, label: str, key=None, diferido=False,
+                              comprimir=False):
+    """
+    Botón de descarga del fichero 'path'. No es una descarga por trozos:
+    st.download_button lee el fichero entero en memoria en cada rerun en
+    que se dibuja. Por eso, con 'diferido', los ficheros grandes muestran
+    antes un botón «Preparar» y no se leen mientras nadie los pida.
+    Con 'comprimir', un HTML mayor de COMPRIMIR_DESDE se envía como HTML
+    autodescomprimible (mismo nombre, se abre igual, pesa varias veces menos).
+    """
     if not path or not path.exists():
         return
-    mime, _ = mimetypes.guess_type(path.name)
-    mime = mime or "application/octet-stream"
-    st.download_button(label, path.read_bytes(), file_name=path.name, mime=mime)
+    tam = path.stat().st_size
+    lista = f"{key or path}_lista"
+    if diferido and tam > DESCARGA_DIFERIDA and not st.session_state.get(lista):
+        if st.button(f"Preparar: {label} ({tam / 2**20:.0f} MB)", key=f"{key or path}_preparar"):
+            st.session_state[lista] = True
+            st.rerun()
+        return
+    enviado = path
+    if comprimir and path.suffix == ".html" and tam > COMPRIMIR_DESDE:
+        enviado = version_comprimida(path)
+    mime, codificacion = mimetypes.guess_type(path.name)
+    mime = "application/octet-stream" if codificacion or not mime else mime
+    with enviado.open("rb") as f:
+        st.download_button(label, f, file_name=path.name, mime=mime, key=key)
 
 def download_button_from_html(html: str, filename: str, label: str):
     st.download_button(label, html.encode("utf-8"), file_name=filename, mime="text/html")
@@ -125,8 +186,17 @@ elif choice == menu[1]:
     c = "cuenca" if provincia_label == "Cuenca (prueba con enero de tres días)" else provincia_label
     m_ = st.number_input("Mes", 1, 12, 1)
     s = st.number_input("Sensibilidad color", 1, 10, 3)
+    formato = st.radio("Formato", ["Ligero (un solo mapa)", "Completo (un mapa por día)"])
+    modo = "ligero" if formato.startswith("Ligero") else "iframes"
+    relativo = st.checkbox("Viajes por mil habitantes")
+    medida = "relativo" if relativo else "viajes"
+    compresiones = {"Sin comprimir": None, "HTML autodescomprimible": "autodescomprimible",
+                    "gzip (.html.gz)": "gzip", "brotli (.html.br)": "br"}
+    etiqueta = st.radio("Compresión", [k for k, v in compresiones.items() if v in COMPRESIONES])
     if st.button("Generar HTML"):
-        ruta = Path(show_progress(exportar_mapa_interactivo_mes(c, m_, s)))
+        ruta = Path(ejecutar_trabajo("exportar_mapa_interactivo_mes", ciudad=c, mes=m_,
+                                     sensibilidad_color=s, modo=modo, medida=medida,
+                                     compresion=compresiones[etiqueta]))
         st.success("HTML generado ✔")
         download_button_from_path(ruta, "Descargar HTML")
 
@@ -137,10 +207,21 @@ elif choice == menu[2]:
     m_ = st.number_input("Mes", 1, 12, 1)
     s = st.number_input("Sensibilidad color", 1, 10, 3)
     z = st.number_input("Zoom", 4, 10, 7)
+    paquete = st.radio("Empaquetado", ["ZIP (imágenes + visor)", "HTML único"])
+    empaquetado = "zip" if paquete.startswith("ZIP") else "base64"
+    sin_navegador = st.checkbox("Renderizar sin navegador (más rápido, sin mapa base)")
+    relativo = st.checkbox("Viajes por mil habitantes")
+    medida = "relativo" if relativo else "viajes"
     if st.button("Generar HTML imágenes"):
-        ruta = Path(show_progress(exportar_mapa_con_imagenes_mes(c, m_, s, z)))
-        st.success("HTML generado ✔")
-        download_button_from_path(ruta, "Descargar HTML")
+        ruta = Path(ejecutar_trabajo(
+            "exportar_mapa_con_imagenes_mes",
+            ciudad=c, mes=m_, sensibilidad_color=s, zoom=z,
+            motor="matplotlib" if sin_navegador else "navegador",
+            empaquetado=empaquetado,
+            medida=medida,
+        ))
+        st.success("Visor generado ✔")
+        download_button_from_path(ruta, f"Descargar {ruta.suffix[1:].upper()}")
 
 # -------- 4) Comparar dos mapas --------
 elif choice == menu[3]:
@@ -153,10 +234,22 @@ elif choice == menu[3]:
     m2 = st.number_input("Mes B", 1, 12, 1, key="m2")
     s2 = st.number_input("Sensibilidad B", 1, 10, 3, key="s2")
     z  = st.number_input("Zoom", 4, 10, 6)
+    paquete = st.radio("Empaquetado", ["ZIP (imágenes + visor)", "HTML único"])
+    empaquetado = "zip" if paquete.startswith("ZIP") else "base64"
+    sin_navegador = st.checkbox("Renderizar sin navegador (más rápido, sin mapa base)")
+    relativo = st.checkbox("Viajes por mil habitantes")
+    medida = "relativo" if relativo else "viajes"
     if st.button("Generar comparativa"):
-        ruta = Path(show_progress(comparar_mapas(c1, m1, s1, c2, m2, s2, z)))
-        st.success("HTML comparativo ✔")
-        download_button_from_path(ruta, "Descargar HTML")
+        ruta = Path(ejecutar_trabajo(
+            "comparar_mapas",
+            ciudad_1=c1, mes_1=m1, sensibilidad_1=s1,
+            ciudad_2=c2, mes_2=m2, sensibilidad_2=s2, zoom=z,
+            motor="matplotlib" if sin_navegador else "navegador",
+            empaquetado=empaquetado,
+            medida=medida,
+        ))
+        st.success("Comparativa generada ✔")
+        download_button_from_path(ruta, f"Descargar {ruta.suffix[1:].upper()}")
 
 # -------- 5) Mapa relativo --------
 elif choice == menu[4]:
@@ -180,12 +273,42 @@ elif choice == menu[5]:
     s = st.number_input("Sensibilidad color", 1, 10, 3)
     z = st.number_input("Zoom", 4, 10, 6)
     secs = st.number_input("Segundos por frame", 0.05, 2.0, 0.1, step=0.05)
+    formato = st.selectbox("Formato", formatos_animacion())
+    sin_navegador = st.checkbox("Renderizar sin navegador (más rápido, sin mapa base)")
+    relativo = st.checkbox("Viajes por mil habitantes")
+    medida = "relativo" if relativo else "viajes"
     if st.button("Generar GIF"):
-        ruta = Path(show_progress(exportar_mapa_gif(
-            c, m_, s, z, secs,
-            open_browser=False,
-            html_wrapper=False
-        )))
+        ruta = Path(ejecutar_trabajo(
+            "exportar_mapa_gif",
+            ciudad=c, mes=m_, sensibilidad_color=s, zoom=z, duracion_segundos=secs,
+            html_wrapper=False,
+            motor="matplotlib" if sin_navegador else "navegador",
+            formato=formato,
+            medida=medida,
+        ))
         if ruta.exists():
-            st.success("GIF generado ✔")
-            download_button_from_path(ruta, "Descargar GIF")
+            st.success("Animación generada ✔")
+            download_button_from_path(ruta, f"Descargar {formato.upper()}")
+
+# -------- 7) Trabajos en segundo plano --------
+elif choice == menu[6]:
+    if st.button("Actualizar"):
+        st.rerun()
+    trabajos = listar()
+    if not trabajos:
+        st.info("Todavía no hay trabajos.")
+    for t in trabajos:
+        st.markdown(f"**{t['funcion']}** · `{t['id']}` · {t['estado']}")
+        st.caption(", ".join(f"{k}={v}" for k, v in t["params"].items()))
+        if t["estado"] in ("pendiente", "en curso"):
+            st.progress(t["progreso"], text=texto_progreso(t["evento"]))
+        elif t["estado"] == "error":
+            st.error(t["error"])
+        elif t["ruta"]:
+            ruta = ruta_resultado(t)
+            comprimir = (ruta.suffix == ".html" and ruta.exists()
+                         and ruta.stat().st_size > COMPRIMIR_DESDE
+                         and st.checkbox("Descargar como HTML autodescomprimible",
+                                         key=f"comprimir_{t['id']}"))
+            download_button_from_path(ruta, f"Descargar {ruta.name}", key=f"descargar_{t['id']}",
+                                      diferido=True, comprimir=comprimir)
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# ── Cola de trabajos en segundo plano para las exportaciones largas ──
+# Los exportadores de funciones_app son generadores (progreso int y al
+# final la ruta). Aquí se ejecutan en un pool de hilos del proceso y su
+# estado se guarda en resultados/trabajos.sqlite, así que un rerun o una
+# desconexión de Streamlit no tira el trabajo y se puede volver más tarde
+# a descargar el resultado. Dos peticiones idénticas en marcha comparten trabajo.
+
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import inspect
+import logging
+import threading
+from pathlib import Path
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+import funciones_app as fa
+
+log = logging.getLogger(__name__)
+
+# Exportadores que se pueden lanzar como trabajo (por nombre, para la tabla)
+EXPORTADORES = {
+    f.__name__: f for f in (
+        fa.exportar_mapa_interactivo_mes,
+        fa.exportar_mapa_con_imagenes_mes,
+        fa.comparar_mapas,
+        fa.comparar_series,
+        fa.exportar_mapa_gif,
+        fa.mapa_transportes_relativo,
+    )
+}
+
+MAX_TRABAJOS = int(os.environ.get("MOVILIDAD_TRABAJOS", 2))   # trabajos a la vez
+ESTADOS_ACTIVOS = ("pendiente", "en curso")
+
+_pool = None
+_activos = set()                     # ids que ejecuta este proceso
+_cerrojo = threading.Lock()
+_preparadas = set()                  # bases de datos con el esquema al día
+_cerrojo_esquema = threading.Lock()
+
+
+def _ruta_bd():
+    return Path(fa.RESULTADOS_DIR) / "trabajos.sqlite"
+
+
+def _preparar(con, ruta):
+    """
+    Crea la tabla (y migra las antiguas) una sola vez por base de datos
+    y proceso, no en cada conexión.
+    """
+    with _cerrojo_esquema:
+        if ruta in _preparadas:
+            return
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute("""CREATE TABLE IF NOT EXISTS trabajos (
+            id TEXT PRIMARY KEY, funcion TEXT, params TEXT, estado TEXT,
+            progreso INTEGER, ruta TEXT, error TEXT, pid INTEGER,
+            creado REAL, actualizado REAL, evento TEXT, clave TEXT)""")
+        columnas = {c["name"] for c in con.execute("PRAGMA table_info(trabajos)")}
+        for nueva in ("evento", "clave"):   # tablas de versiones anteriores
+            if nueva not in columnas:
+                con.execute(f"ALTER TABLE trabajos ADD COLUMN {nueva} TEXT")
+        _preparadas.add(ruta)
+
+
+def _abrir():
+    ruta = _ruta_bd()
+    ruta.parent.mkdir(parents=True, exist_ok=True)
+    con = sqlite3.connect(ruta, timeout=30, isolation_level=None,
+                          check_same_thread=False)
+    con.row_factory = sqlite3.Row
+    try:
+        _preparar(con, str(ruta.resolve()))
+    except BaseException:
+        con.close()
+        raise
+    return con
+
+
+@contextmanager
+def _conectar(con=None):
+    """
+    Transacción sobre 'con' (la conexión del hilo que la pasa) o sobre
+    una conexión nueva que se cierra al salir.
+    """
+    propia = con is None
+    if propia:
+        con = _abrir()
+    try:
+        with con:                    # commit al salir (o rollback si falla)
+            yield con
+    finally:
+        if propia:
+            con.close()
+
+
+def id_trabajo(funcion, params):
+    """
+    Identificador estable de una petición: mismo exportador y mismos
+    parámetros (salvo los que no cambian el resultado) → mismo id.
+    """
+    params = {k: v for k, v in params.items() if k not in fa._PARAMS_SIN_EFECTO}
+    texto = json.dumps([funcion, params], sort_keys=True, default=str)
+    return hashlib.sha256(texto.encode()).hexdigest()[:16]
+
+
+def _vivo(fila):
+    """
+    Un trabajo activo sigue vivo si lo ejecuta este proceso o si el
+    proceso que lo lanzó (otra sesión del servidor) sigue en marcha.
+    """
+    if fila["pid"] == os.getpid():
+        return fila["id"] in _activos
+    return fa._proceso_vivo(fila["pid"])
+
+
+def _actualizar(id_, con=None, **campos):
+    campos["actualizado"] = time.time()
+    with _conectar(con) as con:
+        con.execute(f"UPDATE trabajos SET {', '.join(f'{k} = ?' for k in campos)} WHERE id = ?",
+                    (*campos.values(), id_))
+
+
+def _ejecutar(id_, funcion, params):
+    con = _abrir()                   # una conexión para todo el trabajo
+    ultimo = (-1, None)
+    try:
+        _actualizar(id_, con, estado="en curso")
+        ruta = None
+        for chunk in EXPORTADORES[funcion](**params):
+            if isinstance(chunk, int):
+                etapa = getattr(chunk, "etapa", None)
+                if (chunk, etapa) != ultimo:
+                    evento = chunk.a_dict() if isinstance(chunk, fa.Progreso) else None
+                    _actualizar(id_, con, progreso=int(chunk), evento=json.dumps(evento))
+                    ultimo = (chunk, etapa)
+            else:
+                ruta = chunk
+        _actualizar(id_, con, estado="hecho", progreso=100, ruta=str(ruta),
+                    clave=fa.clave_ultimo_resultado())
+    except Exception as exc:
+        log.exception("Trabajo %s (%s) fallido", id_, funcion)
+        _actualizar(id_, con, estado="error", error=f"{type(exc).__name__}: {exc}")
+    finally:
+        con.close()
+        with _cerrojo:
+            _activos.discard(id_)
+
+
+@fa.proteger_cache
+def _claves_en_uso():
+    """
+    Entradas de la caché a las que apunta algún trabajo: no se expulsan
+    mientras su fila exista.
+    """
+    with _conectar() as con:
+        return [f["clave"] for f in con.execute(
+            "SELECT clave FROM trabajos WHERE clave IS NOT NULL")]
+
+
+def lanzar(funcion, **params):
+    """
+    Encola el exportador 'funcion' (nombre en EXPORTADORES) con 'params'
+    y devuelve el id del trabajo. Si ya hay uno idéntico pendiente o en
+    curso se devuelve ese mismo id. Uno ya terminado se vuelve a lanzar:
+    la caché de resultados lo sirve al instante si los datos no cambiaron
+    y lo regenera si cambiaron.
+    """
+    global _pool
+    if funcion not in EXPORTADORES:
+        raise ValueError(f"Exportador desconocido: {funcion}")
+    if "open_browser" in inspect.signature(EXPORTADORES[funcion]).parameters:
+        params["open_browser"] = False
+    id_ = id_trabajo(funcion, params)
+    ahora = time.time()
+    with _cerrojo, _conectar() as con:
+        con.execute("BEGIN IMMEDIATE")
+        fila = con.execute("SELECT * FROM trabajos WHERE id = ?", (id_,)).fetchone()
+        if fila is not None:
+            if fila["estado"] in ESTADOS_ACTIVOS and _vivo(fila):
+                return id_
+        con.execute("INSERT OR REPLACE INTO trabajos (id, funcion, params, estado, progreso, "
+                    "pid, creado, actualizado) VALUES (?,?,?,?,?,?,?,?)",
+                    (id_, funcion, json.dumps(params, default=str), "pendiente", 0,
+                     os.getpid(), ahora, ahora))
+        _activos.add(id_)
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=MAX_TRABAJOS, thread_name_prefix="trabajo")
+    _pool.submit(_ejecutar, id_, funcion, params)
+    return id_
+
+
+def estado(id_):
+    """
+    Fila del trabajo como dict (id, funcion, params, estado, progreso,
+    ruta, error, creado, actualizado, evento) o None si no existe.
+    'evento' es el último fa.Progreso emitido (o None). Los trabajos
+    activos cuyo proceso ya no existe se marcan como interrumpidos.
+    """
+    with _conectar() as con:
+        fila = con.execute("SELECT * FROM trabajos WHERE id = ?", (id_,)).fetchone()
+    if fila is None:
+        return None
+    if fila["estado"] in ESTADOS_ACTIVOS and not _vivo(fila):
+        _actualizar(id_, estado="error", error="Interrumpido (el servidor se reinició)")
+        return estado(id_)
+    info = dict(fila)
+    info["params"] = json.loads(info["params"])
+    evento = json.loads(info["evento"] or "null")
+    info["evento"] = fa.Progreso.desde_dict(evento) if evento else None
+    return info
+
+
+def listar(limite=20):
+    """
+    Últimos 'limite' trabajos, del más reciente al más antiguo.
+    """
+    with _conectar() as con:
+        ids = [f["id"] for f in con.execute(
+            "SELECT id FROM trabajos ORDER BY creado DESC LIMIT ?", (limite,))]
+    return [estado(i) for i in ids]
+
+
+def ruta_resultado(info):
+    """
+    Ruta del resultado de un trabajo terminado ('info' como en estado()).
+    Se vuelve a publicar desde la caché por si otra exportación con el
+    mismo nombre de fichero la ha sustituido entretanto.
+    """
+    ruta = fa.publicar_resultado(info["clave"]) if info["clave"] else None
+    return ruta or Path(info["ruta"])
+
+
+def seguir(id_, intervalo=0.5):
+    """
+    Generador con el mismo protocolo que los exportadores: emite el
+    progreso del trabajo (el último fa.Progreso guardado, o el int si no
+    lo hay) hasta que termina y al final su ruta (ver ruta_resultado).
+    Si el trabajo falla lanza RuntimeError con el error guardado.
+    """
+    ultimo = None
+    while True:
+        info = estado(id_)
+        if info is None:
+            raise KeyError(id_)
+        evento = info["evento"] or info["progreso"]
+        if evento != ultimo or getattr(evento, "etapa", None) != getattr(ultimo, "etapa", None):
+            ultimo = evento
+            yield evento
+        if info["estado"] == "hecho":
+            yield ruta_resultado(info)
+            return
+        if info["estado"] == "error":
+            raise RuntimeError(info["error"])
+        time.sleep(intervalo)